@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from pgvector.django import CosineDistance
+
+from .metrics import CACHE_LOOKUPS
+from .models import AnswerCache
+
+logger = logging.getLogger(__name__)
+
+# hits counted in memory, added to AnswerCache.hits in batches: {pk: n}
+_hits = Counter()
+_hits_lock = threading.Lock()
+_hits_flushed = time.monotonic()
+
+
+def _key(document_id, document_version, k, mode, rerank):
+    """
+    The filter an entry has to match: same document version and k, retrieved the same way
+    (mode and re-ranking pick different chunks, so their answers aren't interchangeable).
+    """
+    return {"document_id": document_id, "document_version": document_version, "k": k, "mode": mode, "rerank": rerank}
+
+
+def _candidates(key, max_distance, q_emb):
+    """Entries of a key that are fresh enough, with a best source within max_distance, nearest question first."""
+    entries = AnswerCache.objects.filter(**key, best_distance__lte=max_distance)
+    if settings.RAG_ANSWER_CACHE_TTL_SECONDS > 0:
+        entries = entries.filter(created_at__gte=timezone.now() - timedelta(seconds=settings.RAG_ANSWER_CACHE_TTL_SECONDS))
+    return (
+        entries
+        .annotate(distance=CosineDistance("question_embedding", q_emb))
+        .filter(distance__lte=settings.RAG_ANSWER_CACHE_DISTANCE)
+        .order_by("distance")
+    )
+
+
+def _count_hit(pk):
+    """Counts a hit in memory; True when the batch is due for flush_hits."""
+    with _hits_lock:
+        _hits[pk] += 1
+        return (
+            sum(_hits.values()) >= settings.RAG_ANSWER_CACHE_HIT_BATCH
+            or time.monotonic() - _hits_flushed >= settings.RAG_ANSWER_CACHE_HIT_FLUSH_SECONDS
+        )
+
+
+def pending_hits():
+    """Hits counted in memory and not written yet."""
+    with _hits_lock:
+        return sum(_hits.values())
+
+
+def flush_hits():
+    """
+    Adds the hits counted since the last flush to AnswerCache.hits, in one UPDATE.
+    Best-effort: the counts are only statistics, so a failed write drops them.
+    """
+    global _hits_flushed
+    with _hits_lock:
+        pending = dict(_hits)
+        _hits.clear()
+        _hits_flushed = time.monotonic()
+    if not pending:
+        return 0
+
+    try:
+        # a savepoint inside a request transaction, so a failure here doesn't abort it
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE api_answercache a SET hits = a.hits + v.n
+                FROM unnest(%s::bigint[], %s::int[]) AS v(id, n)
+                WHERE a.id = v.id
+                """,
+                [list(pending), list(pending.values())],
+            )
+    except DatabaseError:
+        logger.exception("counting %d answer cache hits failed", sum(pending.values()))
+        return 0
+    return len(pending)
+
+
+def prune_answers(key):
+    """
+    Drops a key's entries past RAG_ANSWER_CACHE_MAX_ENTRIES (oldest first) or older than
+    RAG_ANSWER_CACHE_TTL_SECONDS, so lookups never scan more than the cap.
+    """
+    entries = AnswerCache.objects.filter(**key)
+    newest = entries.order_by("-id").values("id")[:settings.RAG_ANSWER_CACHE_MAX_ENTRIES]
+    stale = entries.exclude(id__in=newest)
+    if settings.RAG_ANSWER_CACHE_TTL_SECONDS > 0:
+        expired = entries.filter(created_at__lt=timezone.now() - timedelta(seconds=settings.RAG_ANSWER_CACHE_TTL_SECONDS))
+        stale = stale | expired
+    return stale.delete()[0]
+
+
+def lookup_answer(document_id, document_version, q_emb, k, mode, rerank, max_distance):
+    """
+    Returns the closest cached answer for this document version, k, mode and rerank whose
+    question is within RAG_ANSWER_CACHE_DISTANCE of q_emb, or None.
+    Entries whose best source was further than max_distance are skipped,
+    so the "I don't know" guardrail still holds for stricter requests.
+    """
+    if settings.RAG_ANSWER_CACHE_DISTANCE <= 0:
+        return None
+
+    hit = _candidates(_key(document_id, document_version, k, mode, rerank), max_distance, q_emb).first()
+    CACHE_LOOKUPS.inc(cache="answer", result="hit" if hit else "miss")
+    if hit and _count_hit(hit.pk):
+        flush_hits()
+    return hit
+
+
+def store_answer(document_id, document_version, question, q_emb, k, mode, rerank, best_distance, answer, sources):
+    """
+    Caches a generated answer. Best-effort: it runs after generation, so a failed write
+    is logged and returns None instead of failing the request.
+    """
+    if settings.RAG_ANSWER_CACHE_DISTANCE <= 0:
+        return None
+
+    key = _key(document_id, document_version, k, mode, rerank)
+    try:
+        with transaction.atomic():
+            entry = AnswerCache.objects.create(
+                **key,
+                question=question,
+                question_embedding=q_emb,
+                best_distance=best_distance,
+                answer=answer,
+                sources=sources,
+            )
+            prune_answers(key)
+    except DatabaseError:
+        logger.exception("caching an answer for document %s failed", document_id)
+        return None
+    return entry
+
+
+def store_answers(entries):
+    """store_answer for many answers (dicts of its arguments), in one INSERT; also best-effort."""
+    if settings.RAG_ANSWER_CACHE_DISTANCE <= 0 or not entries:
+        return []
+
+    try:
+        with transaction.atomic():
+            created = AnswerCache.objects.bulk_create([
+                AnswerCache(
+                    **_key(e["document_id"], e["document_version"], e["k"], e["mode"], e["rerank"]),
+                    question=e["question"],
+                    question_embedding=e["q_emb"],
+                    best_distance=e["best_distance"],
+                    answer=e["answer"],
+                    sources=e["sources"],
+                )
+                for e in entries
+            ])
+            for key in {tuple(_key(e["document_id"], e["document_version"], e["k"], e["mode"], e["rerank"]).items()) for e in entries}:
+                prune_answers(dict(key))
+    except DatabaseError:
+        logger.exception("caching %d answers failed", len(entries))
+        return []
+    return created
+
+
+async def alookup_answer(document_id, document_version, q_emb, k, mode, rerank, max_distance):
+    """lookup_answer for async views."""
+    if settings.RAG_ANSWER_CACHE_DISTANCE <= 0:
+        return None
+
+    hit = await _candidates(_key(document_id, document_version, k, mode, rerank), max_distance, q_emb).afirst()
+    CACHE_LOOKUPS.inc(cache="answer", result="hit" if hit else "miss")
+    if hit and _count_hit(hit.pk):
+        await sync_to_async(flush_hits)()
+    return hit
+
+
+async def astore_answer(document_id, document_version, question, q_emb, k, mode, rerank, best_distance, answer, sources):
+    """store_answer for async views."""
+    return await sync_to_async(store_answer)(
+        document_id, document_version, question, q_emb, k, mode, rerank, best_distance, answer, sources,
+    )
+
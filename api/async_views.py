@@ -0,0 +1,318 @@
+"""
+Async (ASGI) versions of ask, retrieve and the ingest views, served under /api/async/.
+OpenAI calls are awaited and the ORM is used through its async API, so a single
+uvicorn worker can keep many questions in flight instead of pinning a thread each.
+Run with: uvicorn config.asgi:application
+"""
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from .answer_cache import alookup_answer, astore_answer
+from .ingest import aingest_chunks, chunk_blocks, chunk_pages, chunk_text, upload_path
+from .llm import async_client
+from .metrics import PROMPT_TOKENS, Stages
+from .models import Document, QueryLog
+from .pdf import iter_pdf_pages
+from .query_cache import aembed_query
+from .query_log import query_logs
+from .rerank import rerank_search
+from .retrieval import document_state, min_distance, resolve_mode, search_chunks, search_params
+from .views import (
+    _answer_input, _chunk_source, _error_response, _log_stages, _release_connection, _resolve_document_id, _upload_too_large,
+)
+
+
+@csrf_exempt
+async def retrieve(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    body = json.loads(request.body.decode("utf-8"))
+    query = body.get("query", "")
+    k = int(body.get("k", 5))
+
+    try:
+        mode = resolve_mode(body.get("mode"), query)
+        index_params = search_params(body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    stages = Stages("async_retrieve")
+    with stages("embed"):
+        q_emb = await aembed_query(query) if mode != "lexical" else None
+
+    with stages("retrieve"):
+        chunks = await sync_to_async(search_chunks)(query, q_emb, k, mode=mode, **index_params)
+    stages.finish()
+
+    return JsonResponse({
+        "query": query,
+        "mode": mode,
+        "results": [_chunk_source(c) for c in chunks]
+    })
+
+
+@csrf_exempt
+async def ask(request):
+    t0 = time.perf_counter()
+    stages = Stages("async_ask")
+    log = None
+
+    try:
+        if request.method != "POST":
+            return JsonResponse({"error": "POST only"}, status=405)
+
+        body = json.loads(request.body.decode("utf-8"))
+        question = (body.get("question") or "").strip()
+        k = int(body.get("k", 5))
+
+        if not question:
+            return JsonResponse({"error": "question is required"}, status=400)
+
+        # session + latest-doc lookups are sync, run them off the event loop
+        effective_document_id, error = await sync_to_async(_resolve_document_id)(request, body, question)
+        if error:
+            return error
+
+        max_distance = float(body.get("max_distance", 0.95))  # scoped default
+
+        try:
+            mode = resolve_mode(body.get("mode"), question)
+            index_params = search_params(body)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        # the answer cache is keyed on the question embedding, which lexical mode skips
+        use_cache = body.get("cache", True) is not False and mode != "lexical"
+        rerank = body.get("rerank", True) is not False
+
+        # 1) embed question (cached) like the document's chunks; lexical mode doesn't need it
+        doc_version, generation = await sync_to_async(document_state)(effective_document_id)
+        with stages("embed"):
+            q_emb = await aembed_query(question, generation) if mode != "lexical" else None
+
+        # 2) reuse the answer to a near-identical question on the same document version
+        hit = None
+        if use_cache and doc_version is not None:
+            with stages("answer_cache"):
+                hit = await alookup_answer(effective_document_id, doc_version, q_emb, k, mode, rerank, max_distance)
+
+        if hit:
+            log = QueryLog(
+                question=question,
+                k=k,
+                document_id=effective_document_id,
+                max_distance=max_distance,
+                best_distance=hit.best_distance,
+                answer=hit.answer,
+                sources=hit.sources,
+                latency_ms=int((time.perf_counter() - t0) * 1000),
+                cached=True,
+            )
+            return JsonResponse({"question": question, "answer": hit.answer, "sources": hit.sources, "cached": True})
+
+        # 3) retrieve top-k (scoped), re-ranked for diversity
+        with stages("retrieve"):
+            chunks = await sync_to_async(rerank_search)(
+                question, q_emb, k, rerank=rerank, document_id=effective_document_id, mode=mode, generation=generation, **index_params,
+            )
+        best_distance = min_distance(chunks)
+
+        # log early (written once, by the query log writer, when the request is done)
+        log = QueryLog(
+            question=question,
+            k=k,
+            document_id=effective_document_id,
+            max_distance=max_distance,
+            best_distance=best_distance,
+        )
+
+        if not chunks or (best_distance is not None and best_distance > max_distance):
+            log.answer = "I don't know."
+            log.sources = []
+            log.latency_ms = int((time.perf_counter() - t0) * 1000)
+            return JsonResponse({"answer": "I don't know.", "sources": []})
+
+        # 4) answer grounded in the sources that fit the token budget
+        with stages("context"):
+            answer_input, sources, prompt_stats = _answer_input(question, chunks)
+        PROMPT_TOKENS.observe(prompt_stats["prompt_tokens"], view="async_ask")
+        await sync_to_async(_release_connection)()
+        with stages("generate"):
+            resp = await async_client.responses.create(
+                model="gpt-4.1-mini",
+                input=answer_input,
+            )
+
+        answer = resp.output_text
+
+        log.answer = answer
+        log.sources = sources
+        log.latency_ms = int((time.perf_counter() - t0) * 1000)
+        log.prompt_tokens = prompt_stats["prompt_tokens"]
+        log.context_chunks = prompt_stats["context_chunks"]
+
+        if use_cache and doc_version is not None:
+            await astore_answer(effective_document_id, doc_version, question, q_emb, k, mode, rerank, best_distance, answer, sources)
+
+        return JsonResponse({"question": question, "answer": answer, "sources": sources, "cached": False})
+
+    except Exception as e:
+        if log:
+            log.error = repr(e)
+            log.latency_ms = int((time.perf_counter() - t0) * 1000)
+        return _error_response(e)
+
+    finally:
+        if log:
+            _log_stages(log, stages)
+            with stages("log_write"):
+                await query_logs.asubmit(log)
+        stages.finish()
+
+
+@csrf_exempt
+async def ingest_text(request):
+    try:
+        if request.method != "POST":
+            return JsonResponse({"error": "POST only"}, status=405)
+
+        try:
+            body = json.loads(request.body.decode("utf-8") or "{}")
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "invalid_json"}, status=400)
+
+        title = (body.get("title") or "Untitled").strip()
+        text = body.get("text") or ""
+
+        stages = Stages("async_ingest_text")
+        with stages("chunk"):
+            parts = chunk_text(text)
+        if not parts:
+            return JsonResponse({"error": "No text to ingest"}, status=400)
+
+        doc, created = await Document.objects.aget_or_create(title=title, source="ingested_text")
+        await request.session.aset("current_document_id", doc.id)
+
+        stats = await aingest_chunks(doc, parts, stages=stages)
+        stages.finish()
+
+        return JsonResponse({
+            "document_id": doc.id,
+            **stats,
+            "title": doc.title,
+            "status": "created" if created else "updated",
+            "current_document_id": doc.id,
+        })
+
+    except Exception as e:
+        return JsonResponse({"error": "internal_error", "details": repr(e)}, status=500)
+
+
+def _chunk_pdf_upload(request, stages):
+    """
+    The blocking part of ingest_pdf, run in a thread: parsing the multipart body (request.FILES
+    reads the upload and spools it to disk), then extraction and chunking.
+    Returns (title, [(chunk, page)], error response).
+    """
+    if "file" not in request.FILES:
+        return None, None, JsonResponse({"error": "Missing file field"}, status=400)
+
+    uploaded = request.FILES["file"]
+    title = (request.POST.get("title") or uploaded.name or "Untitled").strip()
+
+    with upload_path(uploaded, suffix=".pdf") as path:
+        extracted = stages.iterate("pdf_extract", iter_pdf_pages(path))
+        chunked = list(stages.iterate("chunk", chunk_pages(extracted)))
+    if not chunked:
+        return title, None, JsonResponse({"error": "Could not extract text from PDF"}, status=400)
+    return title, chunked, None
+
+
+def _chunk_text_upload(request, stages):
+    """The blocking part of ingest_file (see _chunk_pdf_upload). Returns (title, parts, error response)."""
+    if "file" not in request.FILES:
+        return None, None, JsonResponse({"error": "Missing file field"}, status=400)
+
+    uploaded = request.FILES["file"]
+    title = (request.POST.get("title") or uploaded.name or "Untitled").strip()
+
+    filename = (uploaded.name or "").lower()
+    if not (filename.endswith(".txt") or filename.endswith(".md")):
+        return title, None, JsonResponse({"error": "Only .txt or .md supported"}, status=400)
+
+    try:
+        with stages("chunk"):
+            parts = chunk_blocks(uploaded.chunks(settings.RAG_UPLOAD_READ_BYTES))
+    except Exception as e:
+        return title, None, JsonResponse({"error": "Could not read file", "details": repr(e)}, status=400)
+    if not parts:
+        return title, None, JsonResponse({"error": "Empty file"}, status=400)
+    return title, parts, None
+
+
+@csrf_exempt
+async def ingest_pdf(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    too_large = _upload_too_large(request)
+    if too_large:
+        return too_large
+
+    # body parsing, extraction (process pool) and chunking block: keep them off the event loop
+    stages = Stages("async_ingest_pdf")
+    title, chunked, error = await sync_to_async(_chunk_pdf_upload)(request, stages)
+    if error:
+        return error
+
+    parts = [chunk_str for chunk_str, _ in chunked]
+    pages = [page for _, page in chunked]
+
+    doc, created = await Document.objects.aget_or_create(title=title, source="pdf")
+    await request.session.aset("current_document_id", doc.id)
+
+    stats = await aingest_chunks(doc, parts, pages=pages, stages=stages)
+    stages.finish()
+
+    return JsonResponse({
+        "document_id": doc.id,
+        "title": doc.title,
+        **stats,
+        "status": "created" if created else "updated",
+        "current_document_id": doc.id,
+    })
+
+
+@csrf_exempt
+async def ingest_file(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    too_large = _upload_too_large(request)
+    if too_large:
+        return too_large
+
+    stages = Stages("async_ingest_file")
+    title, parts, error = await sync_to_async(_chunk_text_upload)(request, stages)
+    if error:
+        return error
+
+    doc, created = await Document.objects.aget_or_create(title=title, source="text_file")
+    await request.session.aset("current_document_id", doc.id)
+
+    stats = await aingest_chunks(doc, parts, stages=stages)
+    stages.finish()
+
+    return JsonResponse({
+        "document_id": doc.id,
+        "title": doc.title,
+        **stats,
+        "status": "created" if created else "updated",
+        "current_document_id": doc.id,
+    })
@@ -0,0 +1,164 @@
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .context import tiktoken_encoding
+
+# the capture group keeps the separators, so offsets can be tracked through re.split
+_SPLIT_RE = re.compile(r'((?<=[.!?])\s+|\n+)')
+
+
+class CharTokenizer:
+    """Sizes in characters (the original chunk_text unit); parts are joined by one space."""
+    separator = 1
+
+    def count(self, text):
+        return len(text)
+
+    def tail(self, text, n):
+        return text[-n:]
+
+
+class ApproxTokenizer:
+    """~4 characters per token, for RAG_CHUNK_TOKENIZER=tiktoken without tiktoken installed."""
+    separator = 0
+
+    def count(self, text):
+        return (len(text) + 3) // 4
+
+    def tail(self, text, n):
+        return text[-n * 4:]
+
+
+class TiktokenTokenizer:
+    """tiktoken tokens; the joining space is absorbed into the next token, so it costs nothing."""
+    separator = 0
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def tail(self, text, n):
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[-n:])
+
+
+def get_tokenizer(name=None):
+    """Tokenizer for RAG_CHUNK_TOKENIZER ("chars" or "tiktoken")."""
+    name = name or settings.RAG_CHUNK_TOKENIZER
+    if name == "chars":
+        return CharTokenizer()
+    if name == "tiktoken":
+        encoding = tiktoken_encoding(settings.RAG_TOKENIZER_ENCODING)
+        return TiktokenTokenizer(encoding) if encoding is not None else ApproxTokenizer()
+    raise ImproperlyConfigured(f"Unknown RAG_CHUNK_TOKENIZER {name!r} (expected 'chars' or 'tiktoken')")
+
+
+def split_parts(pieces, offset=0, tag=None):
+    """
+    Splits a stream of text pieces into sentence-ish parts, yielding (part, start, end, tag).
+    - start/end are character offsets of the stripped part in the concatenated stream (+ offset)
+    - only the unfinished last part is kept between pieces, never the whole text
+    - each piece is scanned once: pending holds no separator, so one can only start in the new
+      piece (its last character is enough context for the lookbehind), and pending is joined
+      and split only when the piece has one; a long text without separators stays O(n)
+    """
+    pending = []
+    last = ""
+    for piece in pieces:
+        if not _SPLIT_RE.search(last + piece, len(last)):
+            if piece:
+                pending.append(piece)
+                last = piece[-1]
+            continue
+        # split() alternates part, separator, ..., part; the last part may continue in the next piece
+        items = _SPLIT_RE.split("".join(pending) + piece)
+        for i in range(0, len(items) - 1, 2):
+            part = items[i]
+            stripped = part.strip()
+            if stripped:
+                start = offset + len(part) - len(part.lstrip())
+                yield stripped, start, start + len(stripped), tag
+            offset += len(part) + len(items[i + 1])
+        pending = [items[-1]]
+        last = items[-1][-1:]
+    pending = "".join(pending)
+    stripped = pending.strip()
+    if stripped:
+        start = offset + len(pending) - len(pending.lstrip())
+        yield stripped, start, start + len(stripped), tag
+
+
+def _tail_parts(parts, starts, pos):
+    """
+    The buffered parts from pos (a position in " ".join(parts)) on, the first one cut and
+    left-stripped, with their source offsets: the overlap stays a list of parts, so offsets
+    stay exact however many chunks it is carried through.
+    """
+    at = 0
+    for i, p in enumerate(parts):
+        if pos - at < len(p):
+            first = p[max(pos - at, 0):].lstrip()
+            return [first, *parts[i + 1:]], [starts[i] + len(p) - len(first), *starts[i + 1:]]
+        at += len(p) + 1
+    return [], []
+
+
+def pack_parts(parts, max_size, overlap, tokenizer):
+    """
+    Packs (part, start, end, tag) tuples into (chunk, start, end, tag) chunks of up to max_size
+    tokenizer units, repeating the last `overlap` units of each chunk at the start of the next.
+    - the buffer is a list of parts with a running size, joined once per chunk; the overlap
+      carried into the next chunk is kept as the parts it came from (see _tail_parts)
+    - a chunk's tag is the tag of its first new part (the overlap tail doesn't count)
+    - a part larger than max_size still becomes one chunk
+    """
+    count, separator = tokenizer.count, tokenizer.separator
+    buf = []
+    starts = []
+    size = 0
+    end = 0
+    tag = None
+    fresh = True
+
+    for p, p_start, p_end, p_tag in parts:
+        n = count(p)
+        if not fresh and size + separator + n > max_size:
+            chunk = " ".join(buf)
+            yield chunk, starts[0], end, tag
+            tail = tokenizer.tail(chunk, overlap) if overlap > 0 else ""
+            buf, starts = _tail_parts(buf, starts, len(chunk) - len(tail)) if tail.strip() else ([], [])
+            size = count(tail.lstrip()) if buf else 0  # the parts join back to the stripped tail
+            fresh = True
+
+        if fresh:
+            tag = p_tag
+            fresh = False
+        if buf:
+            size += separator
+        buf.append(p)
+        starts.append(p_start)
+        size += n
+        end = p_end
+
+    if not fresh:
+        yield " ".join(buf), starts[0], end, tag
+
+
+def iter_chunks(pieces, max_size=None, overlap=None, tokenizer=None):
+    """
+    Lazily chunks a stream of text pieces (e.g. decoded file blocks), yielding (chunk, start, end)
+    with the chunk's character offsets in the concatenated text.
+    - sizes are in tokenizer units: RAG_CHUNK_TOKENIZER, RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP by default
+    - with the "chars" tokenizer the chunks are exactly the original chunk_text ones
+    """
+    if isinstance(pieces, str):
+        pieces = [pieces]
+    max_size = settings.RAG_CHUNK_SIZE if max_size is None else max_size
+    overlap = settings.RAG_CHUNK_OVERLAP if overlap is None else overlap
+    tokenizer = tokenizer or get_tokenizer()
+
+    for chunk, start, end, _ in pack_parts(split_parts(pieces), max_size, overlap, tokenizer):
+        yield chunk, start, end
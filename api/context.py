@@ -0,0 +1,100 @@
+from functools import lru_cache
+
+from django.conf import settings
+
+# shortest suffix/prefix match treated as chunk overlap (shorter ones are likely coincidence)
+_MIN_OVERLAP = 8
+
+
+@lru_cache(maxsize=None)
+def tiktoken_encoding(name):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text):
+    """Tokens in text with tiktoken (RAG_TOKENIZER_ENCODING), or ~4 chars per token without it."""
+    encoding = tiktoken_encoding(settings.RAG_TOKENIZER_ENCODING)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncate_tokens(text, max_tokens):
+    encoding = tiktoken_encoding(settings.RAG_TOKENIZER_ENCODING)
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def _join(left, right):
+    # consecutive chunks repeat the end of the previous one (chunk_text overlap); keep it once
+    probe = right[:_MIN_OVERLAP]
+    start = left.find(probe, max(0, len(left) - len(right)))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return left + right[len(left) - start:]
+        start = left.find(probe, start + 1)
+    return f"{left} {right}"
+
+
+def _spans(chunks):
+    """
+    Groups chunks into runs of consecutive chunk_index in the same document.
+    Spans are ordered by their best-ranked chunk; chunks inside a span by chunk_index.
+    """
+    spans = []
+    for c in chunks:
+        touching = [s for s in spans if s[0].document_id == c.document_id
+                    and any(abs(o.chunk_index - c.chunk_index) == 1 for o in s)]
+        if not touching:
+            spans.append([c])
+            continue
+        # a chunk between two spans joins them
+        first = touching[0]
+        first.append(c)
+        for other in touching[1:]:
+            first.extend(other)
+            spans.remove(other)
+    return [sorted(s, key=lambda c: c.chunk_index) for s in spans]
+
+
+def span_text(span):
+    """The text of a span (chunks in chunk_index order) with each overlap kept once."""
+    text = span[0].text
+    for c in span[1:]:
+        text = _join(text, c.text)
+    return text
+
+
+def _render(spans):
+    return "\n\n".join(f"[source {i + 1}] {span_text(span)}" for i, span in enumerate(spans))
+
+
+def build_context(chunks, budget=None):
+    """
+    Sources text for the answer prompt, at most budget tokens (default RAG_CONTEXT_TOKEN_BUDGET).
+    - chunks are added in rank order; ones that would overflow the budget are skipped
+    - neighbouring chunks of a document are merged into one span, without the repeated overlap
+    - the top chunk is always included, cut to the budget if needed
+    Returns {"text", "chunks" (the ones used, rank order), "spans" (lists of chunks, in
+    "[source N]" order), "tokens"}.
+    """
+    budget = budget or settings.RAG_CONTEXT_TOKEN_BUDGET
+    used, text, tokens = [], "", 0
+
+    for c in chunks:
+        candidate = _render(_spans(used + [c]))
+        candidate_tokens = count_tokens(candidate)
+        if candidate_tokens <= budget:
+            used.append(c)
+            text, tokens = candidate, candidate_tokens
+        elif not used:
+            text = truncate_tokens(candidate, budget)
+            used.append(c)
+            tokens = count_tokens(text)
+
+    return {"text": text, "chunks": used, "spans": _spans(used), "tokens": tokens}
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import re
+import threading
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def active_generation():
+    """
+    (model, dimensions) that new chunks and unscoped questions are embedded with.
+    Models of non-OpenAI providers are stored as "<provider>:<model>".
+    """
+    provider = settings.RAG_EMBEDDING_PROVIDER
+    if provider not in PROVIDERS:
+        raise ImproperlyConfigured(f"RAG_EMBEDDING_PROVIDER must be one of {sorted(PROVIDERS)}, got {provider!r}")
+    model = settings.RAG_EMBEDDING_MODEL
+    if provider != "openai":
+        model = f"{provider}:{model}"
+    return model, settings.RAG_EMBEDDING_DIMENSIONS
+
+
+def embedding_kwargs(generation=None):
+    """model (+ dimensions) arguments for embeddings.create."""
+    model, dimensions = generation or active_generation()
+    kwargs = {"model": model}
+    # text-embedding-3 models can shorten their vectors; older ones have a fixed size
+    if model.startswith("text-embedding-3"):
+        kwargs["dimensions"] = dimensions
+    return kwargs
+
+
+def fit_dimensions(vectors, dimensions):
+    """Keeps the first `dimensions` components of each row and L2-normalizes it."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.shape[1] < dimensions:
+        raise ValueError(f"model returns {vectors.shape[1]} dimensions, {dimensions} were requested")
+    vectors = vectors[:, :dimensions]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).tolist()
+
+
+class OpenAIEmbeddings:
+    """Remote embeddings API (one round trip per call)."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def embed(self, texts, dimensions):
+        from .llm import client  # imported on use: models import this module, and need no API key
+
+        data = client.embeddings.create(input=texts, **embedding_kwargs((self.model, dimensions))).data
+        return [item.embedding for item in data]
+
+    async def aembed(self, texts, dimensions):
+        from .llm import async_client
+
+        resp = await async_client.embeddings.create(input=texts, **embedding_kwargs((self.model, dimensions)))
+        return [item.embedding for item in resp.data]
+
+
+class LocalEmbeddings:
+    """
+    sentence-transformers model running on this machine (`pip install sentence-transformers`).
+    - loaded on first use, once per process; RAG_LOCAL_EMBEDDING_BACKEND=onnx uses ONNX Runtime
+    - smaller dimensions keep the leading components (Matryoshka-style) and re-normalize
+    - CPU-bound, so async callers run it in a thread
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    def encoder(self):
+        with self._lock:
+            if self._encoder is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    raise ImproperlyConfigured(
+                        "RAG_EMBEDDING_PROVIDER=local needs the sentence-transformers package"
+                    ) from e
+                self._encoder = SentenceTransformer(
+                    self.model,
+                    device=settings.RAG_LOCAL_EMBEDDING_DEVICE,
+                    backend=settings.RAG_LOCAL_EMBEDDING_BACKEND,
+                )
+            return self._encoder
+
+    def embed(self, texts, dimensions):
+        if not texts:
+            return []
+        return fit_dimensions(self.encoder().encode(list(texts), convert_to_numpy=True), dimensions)
+
+    async def aembed(self, texts, dimensions):
+        return await asyncio.to_thread(self.embed, texts, dimensions)
+
+
+class HashEmbeddings:
+    """
+    Deterministic fake for tests and benchmarks: no model, no network.
+    Words are hashed into signed buckets, so texts sharing words end up close.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def embed(self, texts, dimensions):
+        if not texts:
+            return []
+        vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.casefold()) or [text]
+            digests = [hashlib.blake2b(f"{self.model}:{w}".encode("utf-8"), digest_size=8).digest() for w in words]
+            buckets = np.array([int.from_bytes(d, "little") for d in digests], dtype=np.uint64)
+            signs = np.where(buckets & np.uint64(1), 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], (buckets >> np.uint64(1)) % np.uint64(dimensions), signs)
+        return fit_dimensions(vectors, dimensions)
+
+    async def aembed(self, texts, dimensions):
+        return self.embed(texts, dimensions)
+
+
+PROVIDERS = {"openai": OpenAIEmbeddings, "local": LocalEmbeddings, "hash": HashEmbeddings}
+
+
+@lru_cache(maxsize=None)
+def provider_for(model):
+    """Provider for a generation's model name (cached, so a local model is loaded once)."""
+    name, sep, rest = model.partition(":")
+    if sep and name != "openai" and name in PROVIDERS:
+        return PROVIDERS[name](rest)
+    return OpenAIEmbeddings(model)
+
+
+def embed(texts, generation=None):
+    """Embeds a list of texts with the provider of generation (default the active one)."""
+    model, dimensions = generation or active_generation()
+    return provider_for(model).embed(texts, dimensions)
+
+
+async def aembed(texts, generation=None):
+    """embed for async views."""
+    model, dimensions = generation or active_generation()
+    return await provider_for(model).aembed(texts, dimensions)
@@ -0,0 +1,384 @@
+import asyncio
+import codecs
+import hashlib
+import os
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice, repeat
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from .chunker import get_tokenizer, iter_chunks, pack_parts, split_parts
+from .embeddings import active_generation, aembed, embed
+from .metrics import CACHE_LOOKUPS, Stages
+from .models import AnswerCache, Chunk, Document, EmbeddingCache
+
+
+def chunk_text(text: str, max_chars: int = None, overlap: int = None, tokenizer=None):
+    """
+    - splits on sentences/paragraphs
+    - packs into chunks up to max_chars (RAG_CHUNK_TOKENIZER units, characters by default)
+    - overlaps the last 'overlap' units between chunks
+    """
+    return [chunk for chunk, _, _ in iter_chunks([text or ""], max_chars, overlap, tokenizer)]
+
+
+def chunk_pages(pages, max_chars: int = None, overlap: int = None, tokenizer=None):
+    """
+    Same packing as chunk_text, but consumes (page_number, text) pairs lazily
+    and yields (chunk, page_number), so the full document text is never built.
+    """
+    def tagged():
+        # offsets as if the pages were joined with newlines
+        offset = 0
+        for page_no, text in pages:
+            text = text or ""
+            yield from split_parts([text], offset, tag=page_no)
+            offset += len(text) + 1
+
+    max_chars = settings.RAG_CHUNK_SIZE if max_chars is None else max_chars
+    overlap = settings.RAG_CHUNK_OVERLAP if overlap is None else overlap
+    for chunk, _, _, page in pack_parts(tagged(), max_chars, overlap, tokenizer or get_tokenizer()):
+        yield chunk, page
+
+
+def chunk_blocks(blocks, max_chars: int = None, overlap: int = None):
+    """
+    chunk_text for a stream of UTF-8 byte blocks (an upload's chunks(), a file read piecewise).
+    Decoding is incremental, so the file's text is never held whole; invalid bytes are dropped.
+    """
+    text = codecs.iterdecode(blocks, "utf-8", errors="ignore")
+    return [chunk for chunk, _, _ in iter_chunks(text, max_chars, overlap)]
+
+
+@contextmanager
+def upload_path(uploaded, suffix=""):
+    """
+    Yields a filesystem path for an uploaded file.
+    Large uploads already live in a temp file; small in-memory ones are written out.
+    """
+    if hasattr(uploaded, "temporary_file_path"):
+        yield uploaded.temporary_file_path()
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        for piece in uploaded.chunks():
+            f.write(piece)
+    try:
+        yield f.name
+    finally:
+        os.remove(f.name)
+
+
+def embed_texts(texts, on_batch=None, generation=None):
+    """
+    Embeds texts in batches of RAG_EMBED_BATCH_SIZE with the generation's provider.
+    - generation is (model, dimensions), default the active one from settings
+    - on_batch(done, total) is called after each batch
+    """
+    batch_size = settings.RAG_EMBED_BATCH_SIZE
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.extend(embed(texts[start:start + batch_size], generation))
+        if on_batch:
+            on_batch(len(vectors), len(texts))
+    return vectors
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def cached_embeddings(hashes, generation=None):
+    """Returns {text_hash: vector} for the hashes already in EmbeddingCache."""
+    model, dimensions = generation or active_generation()
+    rows = EmbeddingCache.objects.filter(model=model, dimensions=dimensions, text_hash__in=list(hashes))
+    return {r.text_hash: r.embedding for r in rows.only("text_hash", "embedding")}
+
+
+def cache_embeddings(vectors, generation=None):
+    """Saves {text_hash: vector} to EmbeddingCache, skipping hashes another ingest already stored."""
+    model, dimensions = generation or active_generation()
+    EmbeddingCache.objects.bulk_create(
+        [EmbeddingCache(model=model, dimensions=dimensions, text_hash=h, embedding=v) for h, v in vectors.items()],
+        batch_size=settings.RAG_INGEST_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def store_chunks(doc, parts, embeddings, replace=False, batch_size=None, pages=None, indexes=None, generation=None):
+    """
+    Writes a document's chunks with bulk_create, batch_size rows per INSERT.
+    - pages is an optional page number per chunk (PDFs)
+    - indexes overrides the chunk_index of each row (default 0..n-1)
+    - generation is the (model, dimensions) the embeddings came from (default the active one)
+    - old chunks are deleted in the same transaction when replace=True,
+      so a failed ingest never leaves the document half-written
+    - returns row count and insert throughput for the API response
+    """
+    batch_size = batch_size or settings.RAG_INGEST_BATCH_SIZE
+    model, dimensions = generation or active_generation()
+    t0 = time.perf_counter()
+
+    rows = (
+        Chunk(
+            document=doc, chunk_index=i, text=chunk_str, text_hash=text_hash(chunk_str), page=page,
+            embedding=emb, embedding_model=model, embedding_dimensions=dimensions,
+        )
+        for i, chunk_str, emb, page in zip(indexes or range(len(parts)), parts, embeddings, pages or repeat(None))
+    )
+    total = 0
+    with transaction.atomic():
+        if replace:
+            Chunk.objects.filter(document=doc).delete()
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            Chunk.objects.bulk_create(batch, batch_size=batch_size)
+            total += len(batch)
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "rows": total,
+        "insert_ms": int(elapsed * 1000),
+        "rows_per_sec": round(total / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def plan_chunks(doc, parts, pages=None, generation=None):
+    """
+    Diffs parts against doc's existing chunks. Returns a plan dict with:
+    - keep: {new chunk_index: existing row with the same text and embedding generation}
+    - stale_ids: rows whose text is gone (or embedded with another generation)
+    - new_indexes: chunk indexes that need a new row
+    - vectors: {text_hash: vector} already known from EmbeddingCache
+    - missing: {text_hash: text} still to be embedded
+    - version: the document version the plan was made against
+    """
+    generation = generation or active_generation()
+    # read before the rows: a writer committing in between makes the plan stale, not wrong
+    version = Document.objects.values_list("version", flat=True).get(pk=doc.pk)
+    pages = list(pages) if pages else [None] * len(parts)
+    hashes = [text_hash(p) for p in parts]
+
+    existing = defaultdict(list)
+    rows = Chunk.objects.filter(document=doc).only("id", "chunk_index", "page", "text_hash", "embedding_model", "embedding_dimensions")
+    for row in rows.order_by("chunk_index"):
+        same_generation = (row.embedding_model, row.embedding_dimensions) == tuple(generation)
+        existing[row.text_hash if same_generation else None].append(row)
+
+    keep = {}
+    for i, h in enumerate(hashes):
+        if existing.get(h):
+            keep[i] = existing[h].pop(0)
+    stale_ids = [row.id for rows in existing.values() for row in rows]
+
+    new_indexes = [i for i in range(len(parts)) if i not in keep]
+    vectors = cached_embeddings({hashes[i] for i in new_indexes}, generation)
+    if new_indexes:
+        CACHE_LOOKUPS.inc(len(vectors), cache="embedding", result="hit")
+        CACHE_LOOKUPS.inc(len({hashes[i] for i in new_indexes}) - len(vectors), cache="embedding", result="miss")
+
+    return {
+        "generation": generation,
+        "parts": parts,
+        "pages": pages,
+        "hashes": hashes,
+        "keep": keep,
+        "stale_ids": stale_ids,
+        "new_indexes": new_indexes,
+        "vectors": vectors,
+        "cache_hits": len(vectors),
+        "missing": {hashes[i]: parts[i] for i in new_indexes if hashes[i] not in vectors},
+        "version": version,
+    }
+
+
+def _replan(doc, plan):
+    """Redoes a stale plan against doc's current rows, embedding texts that neither plan covers."""
+    replanned = plan_chunks(doc, plan["parts"], plan["pages"], plan["generation"])
+    missing = replanned["missing"]
+    if missing:
+        fresh = dict(zip(missing, embed_texts(list(missing.values()), generation=plan["generation"])))
+        cache_embeddings(fresh, plan["generation"])
+        replanned["vectors"].update(fresh)
+    replanned["cache_hits"] = plan["cache_hits"]
+    replanned["missing"] = {**plan["missing"], **missing}
+    return replanned
+
+
+def apply_chunks(doc, plan, fresh):
+    """
+    Writes a plan from plan_chunks, with fresh = {text_hash: vector} for its missing texts.
+    Everything is written in one transaction; if anything changed, the document's
+    version is bumped and its cached answers are dropped.
+    The document row is locked for the transaction, so writers of one document (job workers,
+    upload views, re-embeds) go one at a time; a plan made before another writer committed
+    is redone against the rows that writer left.
+    """
+    generation = plan["generation"]
+    if fresh:
+        cache_embeddings(fresh, generation)
+
+    with transaction.atomic():
+        version = Document.objects.select_for_update().values_list("version", flat=True).get(pk=doc.pk)
+        if version != plan["version"]:
+            plan = _replan(doc, plan)
+
+        parts, pages, hashes = plan["parts"], plan["pages"], plan["hashes"]
+        keep, stale_ids, new_indexes = plan["keep"], plan["stale_ids"], plan["new_indexes"]
+        vectors = {**plan["vectors"], **fresh}
+
+        Chunk.objects.filter(id__in=stale_ids).delete()
+
+        # Move kept rows in two steps: (document, chunk_index) is unique and
+        # Postgres checks it row by row, so shifting rows in place could collide
+        moved = [(i, row) for i, row in keep.items() if row.chunk_index != i or row.page != pages[i]]
+        for i, row in moved:
+            row.chunk_index = -(i + 1)
+        Chunk.objects.bulk_update([row for _, row in moved], ["chunk_index"], batch_size=settings.RAG_INGEST_BATCH_SIZE)
+        for i, row in moved:
+            row.chunk_index = i
+            row.page = pages[i]
+        Chunk.objects.bulk_update([row for _, row in moved], ["chunk_index", "page"], batch_size=settings.RAG_INGEST_BATCH_SIZE)
+
+        stats = store_chunks(
+            doc,
+            [parts[i] for i in new_indexes],
+            [vectors[hashes[i]] for i in new_indexes],
+            pages=[pages[i] for i in new_indexes],
+            indexes=new_indexes,
+            generation=generation,
+        )
+
+        # Any change to the chunk set makes cached answers for this document stale
+        if stale_ids or moved or new_indexes:
+            Document.objects.filter(pk=doc.pk).update(
+                version=F("version") + 1,
+                chunk_count=len(parts),
+                embedding_model=generation[0],
+                embedding_dimensions=generation[1],
+            )
+            AnswerCache.objects.filter(document=doc).delete()
+
+    return {
+        "chunks_created": len(parts),
+        "chunks_reused": len(keep),
+        "chunks_deleted": len(stale_ids),
+        "embedding_cache_hits": plan["cache_hits"],
+        "embeddings_requested": len(plan["missing"]),
+        "insert_ms": stats["insert_ms"],
+        "rows_per_sec": stats["rows_per_sec"],
+    }
+
+
+def ingest_chunks(doc, parts, pages=None, on_embed=None, generation=None, stages=None):
+    """
+    Makes doc's chunks match parts, embedding as little as possible:
+    - existing chunks with unchanged text keep their row and vector (only chunk_index/page move)
+    - other texts are looked up in EmbeddingCache by (model, dimensions, sha256 of text)
+    - only what's left goes to the embeddings API, and is cached for next time
+    - stages (api.metrics.Stages) times the plan, embed and bulk_insert stages
+    """
+    stages = stages or Stages()
+    with stages("plan"):
+        plan = plan_chunks(doc, parts, pages, generation)
+    missing = plan["missing"]
+    texts = list(missing.values())
+    with stages("embed"):
+        fresh = dict(zip(missing, embed_texts(texts, on_batch=on_embed, generation=plan["generation"]))) if missing else {}
+    with stages("bulk_insert"):
+        return apply_chunks(doc, plan, fresh)
+
+
+def reembed_document(doc, generation, on_embed=None):
+    """
+    Moves doc's chunks to another embedding generation (model, dimensions) without a gap:
+    - texts missing from EmbeddingCache for that generation are embedded batch by batch and cached
+    - then every chunk takes its new vector from the cache in one UPDATE, in one transaction
+      with the document's generation/version (questions follow the document's generation)
+    """
+    model, dimensions = generation
+    cached = EmbeddingCache.objects.filter(model=model, dimensions=dimensions).values("text_hash")
+    missing = (
+        Chunk.objects.filter(document=doc)
+        .exclude(text_hash__in=cached)
+        .values_list("text_hash", "text")
+        .order_by("text_hash")
+        .distinct()
+    )
+    # distinct texts already embedded for the generation, counted like plan_chunks' cache_hits
+    cache_hits = Chunk.objects.filter(document=doc, text_hash__in=cached).values("text_hash").distinct().count()
+
+    requested = 0
+    batch = {}
+    for h, text in missing.iterator(chunk_size=settings.RAG_EMBED_BATCH_SIZE):
+        batch[h] = text
+        if len(batch) >= settings.RAG_EMBED_BATCH_SIZE:
+            cache_embeddings(dict(zip(batch, embed_texts(list(batch.values()), generation=generation))), generation)
+            requested += len(batch)
+            batch = {}
+            if on_embed:
+                on_embed(requested)
+    if batch:
+        cache_embeddings(dict(zip(batch, embed_texts(list(batch.values()), generation=generation))), generation)
+        requested += len(batch)
+        if on_embed:
+            on_embed(requested)
+
+    with transaction.atomic():
+        Document.objects.select_for_update().only("id").get(pk=doc.pk)  # one writer per document, see apply_chunks
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE api_chunk c
+                SET embedding = e.embedding, embedding_model = e.model, embedding_dimensions = e.dimensions
+                FROM api_embeddingcache e
+                WHERE c.document_id = %s AND e.model = %s AND e.dimensions = %s AND e.text_hash = c.text_hash
+                """,
+                [doc.pk, model, dimensions],
+            )
+            updated = cursor.rowcount
+        total = Chunk.objects.filter(document=doc).count()
+        if updated != total:
+            # rolls back: a chunk without a cached vector would drop out of search
+            raise RuntimeError(f"document {doc.pk}: {total - updated} chunk(s) have no cached embedding")
+        Document.objects.filter(pk=doc.pk).update(
+            version=F("version") + 1,
+            embedding_model=model,
+            embedding_dimensions=dimensions,
+        )
+        AnswerCache.objects.filter(document=doc).delete()
+
+    CACHE_LOOKUPS.inc(cache_hits, cache="embedding", result="hit")
+    CACHE_LOOKUPS.inc(requested, cache="embedding", result="miss")
+    return {"chunks": total, "embeddings_requested": requested, "embedding_cache_hits": cache_hits}
+
+
+async def aembed_texts(texts, generation=None):
+    """embed_texts for async views: the batches run concurrently."""
+    batch_size = settings.RAG_EMBED_BATCH_SIZE
+    batches = await asyncio.gather(*[
+        aembed(texts[start:start + batch_size], generation)
+        for start in range(0, len(texts), batch_size)
+    ])
+    return [vector for batch in batches for vector in batch]
+
+
+async def aingest_chunks(doc, parts, pages=None, stages=None):
+    """ingest_chunks for async views: the DB work runs in a thread, embedding is awaited."""
+    stages = stages or Stages()
+    with stages("plan"):
+        plan = await sync_to_async(plan_chunks)(doc, parts, pages)
+    missing = plan["missing"]
+    with stages("embed"):
+        fresh = dict(zip(missing, await aembed_texts(list(missing.values()), plan["generation"]))) if missing else {}
+    with stages("bulk_insert"):
+        return await sync_to_async(apply_chunks)(doc, plan, fresh)
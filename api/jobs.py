@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from .ingest import chunk_blocks, chunk_pages, ingest_chunks
+from .models import Document, IngestJob
+from .pdf import iter_pdf_pages
+
+
+def enqueue_upload(uploaded, title, kind):
+    """
+    Spools an uploaded file to RAG_JOB_UPLOAD_DIR and queues an IngestJob for it.
+    The Document is created up front so callers get its id immediately.
+    """
+    source = "pdf" if kind == "pdf" else "text_file"
+    doc, _ = Document.objects.get_or_create(title=title, source=source)
+
+    upload_dir = Path(settings.RAG_JOB_UPLOAD_DIR)
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    path = upload_dir / f"{uuid.uuid4().hex}{Path(uploaded.name or '').suffix.lower()}"
+
+    with open(path, "wb") as f:
+        for piece in uploaded.chunks(settings.RAG_UPLOAD_READ_BYTES):
+            f.write(piece)
+
+    return IngestJob.objects.create(kind=kind, document=doc, upload_path=str(path))
+
+
+def _remove_upload(job):
+    try:
+        os.remove(job.upload_path)
+    except OSError:
+        pass
+
+
+def requeue_stale_jobs():
+    """
+    Puts running jobs whose heartbeat is older than RAG_JOB_LEASE_SECONDS (their worker died)
+    back in the queue, or fails them once they have been claimed RAG_JOB_MAX_ATTEMPTS times.
+    Returns the number of jobs requeued or failed.
+    """
+    lease_start = timezone.now() - timedelta(seconds=settings.RAG_JOB_LEASE_SECONDS)
+    with transaction.atomic():
+        stale = list(
+            IngestJob.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=IngestJob.STATUS_RUNNING, heartbeat_at__lt=lease_start)
+        )
+        for job in stale:
+            if job.attempts >= settings.RAG_JOB_MAX_ATTEMPTS:
+                job.status = IngestJob.STATUS_FAILED
+                job.error = f"worker {job.worker} stopped responding ({job.attempts} attempts)"
+                job.finished_at = timezone.now()
+                _remove_upload(job)
+            else:
+                job.status = IngestJob.STATUS_QUEUED
+            job.save(update_fields=["status", "error", "finished_at"])
+    return len(stale)
+
+
+def claim_next_job(worker):
+    """
+    Marks the oldest queued job as running and returns it (None if the queue is empty).
+    SKIP LOCKED lets several workers poll the same table without blocking each other.
+    Stale running jobs are requeued first, so a killed worker's job is picked up again.
+    """
+    requeue_stale_jobs()
+    with transaction.atomic():
+        job = (
+            IngestJob.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=IngestJob.STATUS_QUEUED)
+            .order_by("id")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = IngestJob.STATUS_RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.worker = worker
+        job.attempts += 1
+        job.save(update_fields=["status", "started_at", "heartbeat_at", "worker", "attempts"])
+
+    return job
+
+
+class Heartbeat:
+    """
+    Bumps a running job's heartbeat_at from a background thread every interval seconds,
+    so long embedding calls or big pages don't let the lease run out. Use as a context manager.
+    """
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"job-{job.pk}-heartbeat", daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                IngestJob.objects.filter(
+                    pk=self.job.pk, status=IngestJob.STATUS_RUNNING, worker=self.job.worker,
+                ).update(heartbeat_at=timezone.now())
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class JobProgress:
+    """
+    Records {stage: {"done", "total"}} on the job row.
+    Writes are throttled to one per min_interval seconds, except when a stage completes.
+    """
+
+    def __init__(self, job, min_interval=0.5):
+        self.job = job
+        self.min_interval = min_interval
+        self._last_write = 0.0
+
+    def __call__(self, stage, done, total):
+        self.job.stage = stage
+        self.job.progress[stage] = {"done": done, "total": total}
+
+        now = time.monotonic()
+        if done < total and now - self._last_write < self.min_interval:
+            return
+        self._last_write = now
+        IngestJob.objects.filter(pk=self.job.pk).update(stage=stage, progress=self.job.progress)
+
+
+def run_job(job):
+    """
+    Runs extract -> chunk -> embed -> store for a claimed job (PDF pages and text blocks stream into the chunker).
+    Failures are recorded on the job instead of raised, so the worker keeps going; database
+    errors are raised without touching the job, which is requeued when its lease runs out.
+    """
+    progress = JobProgress(job)
+
+    with Heartbeat(job, settings.RAG_JOB_LEASE_SECONDS / 3):
+        try:
+            if job.kind == "pdf":
+                pages_iter = iter_pdf_pages(job.upload_path, on_page=lambda done, total: progress("extract", done, total))
+                chunked = list(chunk_pages(pages_iter))
+                parts = [chunk_str for chunk_str, _ in chunked]
+                pages = [page for _, page in chunked]
+            else:
+                with open(job.upload_path, "rb") as f:
+                    parts = chunk_blocks(iter(partial(f.read, settings.RAG_UPLOAD_READ_BYTES), b""))
+                progress("extract", 1, 1)
+                pages = None
+
+            if not parts:
+                raise ValueError("No text could be extracted from the upload")
+            progress("chunk", len(parts), len(parts))
+
+            stats = ingest_chunks(
+                job.document,
+                parts,
+                pages=pages,
+                on_embed=lambda done, total: progress("embed", done, total),
+            )
+            progress("embed", stats["embeddings_requested"], stats["embeddings_requested"])
+            progress("store", len(parts), len(parts))
+
+            job.status = IngestJob.STATUS_DONE
+            job.result = stats
+        except DatabaseError:
+            # not the upload's fault: leave the job running, its lease runs out and it is retried
+            raise
+        except Exception as e:
+            job.status = IngestJob.STATUS_FAILED
+            job.error = repr(e)
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "stage", "progress", "result", "error", "finished_at"])
+    # only once the outcome is saved: until then a retry may still need the upload
+    _remove_upload(job)
+    return job
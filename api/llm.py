@@ -0,0 +1,214 @@
+"""
+Gateway to the OpenAI API, shared by the sync views/worker (client) and the async views (async_client).
+- one pooled HTTP client per process: at most RAG_OPENAI_MAX_CONNECTIONS requests in flight,
+  kept-alive connections, and RAG_OPENAI_MAX_RETRIES retries with backoff on 429/5xx/network errors
+- per-operation timeouts (embeddings are short, generation is long)
+- a token bucket per operation caps the request rate, so bursts queue here instead of becoming 429s
+- identical embedding requests in flight at the same time share one upstream call
+The gateways expose the SDK calls the app uses (embeddings.create, responses.create).
+"""
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI, RateLimitError
+
+
+class GatewayBusy(Exception):
+    """The rate limit queue is longer than RAG_OPENAI_MAX_QUEUE_SECONDS."""
+
+
+# upstream overload: our queue is full, or OpenAI still answers 429 after the retries
+OVERLOADED = (GatewayBusy, RateLimitError)
+
+
+class TokenBucket:
+    """
+    rate requests per second with bursts of up to burst; rate <= 0 means unlimited.
+    Callers reserve a token and sleep until it's theirs, so waiters are served in arrival order.
+    A caller that would wait more than max_wait seconds gets GatewayBusy instead.
+    """
+
+    def __init__(self, rate, burst=None, max_wait=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.max_wait = max_wait
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if self.max_wait is not None and wait > self.max_wait:
+                raise GatewayBusy(f"rate limit queue is {wait:.1f}s long")
+            self.tokens -= 1
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket(operation):
+    """The process-wide TokenBucket of an operation ("embed" or "generate"), sync and async callers share it."""
+    with _buckets_lock:
+        if operation not in _buckets:
+            rate = settings.RAG_OPENAI_EMBED_RPS if operation == "embed" else settings.RAG_OPENAI_GENERATE_RPS
+            _buckets[operation] = TokenBucket(rate, max_wait=settings.RAG_OPENAI_MAX_QUEUE_SECONDS)
+        return _buckets[operation]
+
+
+def _timeout(operation):
+    seconds = settings.RAG_OPENAI_EMBED_TIMEOUT if operation == "embed" else settings.RAG_OPENAI_GENERATE_TIMEOUT
+    return httpx.Timeout(seconds, connect=settings.RAG_OPENAI_CONNECT_TIMEOUT, pool=settings.RAG_OPENAI_POOL_TIMEOUT)
+
+
+def _limits():
+    n = settings.RAG_OPENAI_MAX_CONNECTIONS
+    return httpx.Limits(max_connections=n, max_keepalive_connections=n, keepalive_expiry=30)
+
+
+def _coalesce_key(input, kwargs):
+    return json.dumps([input, kwargs], sort_keys=True)
+
+
+class _Embeddings:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def create(self, *, input, **kwargs):
+        return self._gateway._coalesced(
+            _coalesce_key(input, kwargs),
+            lambda: self._gateway._call("embed", lambda c: c.embeddings.create(input=input, **kwargs)),
+        )
+
+
+class _Responses:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def create(self, **kwargs):
+        return self._gateway._call("generate", lambda c: c.responses.create(**kwargs))
+
+
+class Gateway:
+    """
+    Sync gateway. The OpenAI client is built on first use from settings (OPENAI_API_KEY etc.
+    from the environment); client_kwargs (base_url, api_key...) override them.
+    """
+
+    def __init__(self, **client_kwargs):
+        self._client_kwargs = client_kwargs
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.embeddings = _Embeddings(self)
+        self.responses = _Responses(self)
+
+    def _client(self, operation):
+        with self._lock:
+            if not self._clients:
+                self._clients[None] = OpenAI(
+                    max_retries=settings.RAG_OPENAI_MAX_RETRIES,
+                    http_client=DefaultHttpxClient(limits=_limits()),
+                    **self._client_kwargs,
+                )
+            if operation not in self._clients:
+                # with_options copies the client but keeps its connection pool
+                self._clients[operation] = self._clients[None].with_options(timeout=_timeout(operation))
+            return self._clients[operation]
+
+    def _call(self, operation, fn):
+        bucket(operation).acquire()
+        return fn(self._client(operation))
+
+    def _coalesced(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+
+class _AsyncEmbeddings(_Embeddings):
+    async def create(self, *, input, **kwargs):
+        async def call():
+            return await self._gateway._call("embed", lambda c: c.embeddings.create(input=input, **kwargs))
+
+        return await self._gateway._coalesced(_coalesce_key(input, kwargs), call)
+
+
+class _AsyncResponses(_Responses):
+    async def create(self, **kwargs):
+        return await self._gateway._call("generate", lambda c: c.responses.create(**kwargs))
+
+
+class AsyncGateway(Gateway):
+    """Gateway for the async views; coalescing is per event loop."""
+
+    def __init__(self, **client_kwargs):
+        super().__init__(**client_kwargs)
+        self.embeddings = _AsyncEmbeddings(self)
+        self.responses = _AsyncResponses(self)
+
+    def _client(self, operation):
+        with self._lock:
+            if not self._clients:
+                self._clients[None] = AsyncOpenAI(
+                    max_retries=settings.RAG_OPENAI_MAX_RETRIES,
+                    http_client=DefaultAsyncHttpxClient(limits=_limits()),
+                    **self._client_kwargs,
+                )
+            if operation not in self._clients:
+                self._clients[operation] = self._clients[None].with_options(timeout=_timeout(operation))
+            return self._clients[operation]
+
+    async def _call(self, operation, fn):
+        await bucket(operation).aacquire()
+        return await fn(self._client(operation))
+
+    async def _coalesced(self, key, fn):
+        key = (id(asyncio.get_running_loop()), key)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shielded: one caller giving up doesn't cancel the call the others wait on
+        return await asyncio.shield(task)
+
+
+# Shared gateways for embeddings + generation (sync views/worker, async views)
+client = Gateway()
+async_client = AsyncGateway()
@@ -0,0 +1,94 @@
+from django.db import connection
+
+# date_trunc units and their length in seconds
+BUCKETS = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+MAX_BUCKETS = 1000
+LATENCY_PERCENTILES = (0.5, 0.95, 0.99)
+DISTANCE_PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# One pass over the window's rows (an index range scan on created_at, or on
+# (document_id, created_at) for one document) computes three groupings at once.
+# The bucket is whitelisted and inlined: GROUP BY has to see the same expression as the SELECT.
+_STATS_SQL = """
+SELECT
+    GROUPING(document_id) = 0 AS per_document,
+    GROUPING(date_trunc('{bucket}', created_at)) = 0 AS per_bucket,
+    document_id,
+    date_trunc('{bucket}', created_at) AS bucket,
+    count(*),
+    percentile_cont(%(latency_percentiles)s::float8[]) WITHIN GROUP (ORDER BY latency_ms),
+    avg((error <> '')::int),
+    avg((answer = 'I don''t know.')::int),
+    avg(cached::int),
+    percentile_cont(%(distance_percentiles)s::float8[]) WITHIN GROUP (ORDER BY best_distance)
+FROM api_querylog
+WHERE created_at >= %(since)s AND created_at < %(until)s {document_filter}
+GROUP BY GROUPING SETS ((), (document_id), (date_trunc('{bucket}', created_at)))
+"""
+
+
+def _rate(value):
+    return round(float(value), 4) if value is not None else None
+
+
+def _percentiles(names, values):
+    if values is None:
+        return {name: None for name in names}
+    return {name: round(v, 4) if v is not None else None for name, v in zip(names, values)}
+
+
+def query_stats(since, until, bucket="hour", document_id=None, max_documents=100):
+    """
+    Aggregates QueryLog rows with since <= created_at < until, in SQL:
+    - overall, per document (the max_documents busiest) and per time bucket (date_trunc unit)
+    - latency p50/p95/p99, error rate, "I don't know" rate, answer cache hit rate
+      and best_distance percentiles, each over the rows of the group
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    if until <= since:
+        raise ValueError("since must be before until")
+    if (until - since).total_seconds() / BUCKETS[bucket] > MAX_BUCKETS:
+        raise ValueError(f"more than {MAX_BUCKETS} {bucket} buckets: use a larger bucket or a shorter window")
+
+    sql = _STATS_SQL.format(
+        bucket=bucket,
+        document_filter="AND document_id = %(document_id)s" if document_id is not None else "",
+    )
+    params = {
+        "since": since,
+        "until": until,
+        "document_id": document_id,
+        "latency_percentiles": list(LATENCY_PERCENTILES),
+        "distance_percentiles": list(DISTANCE_PERCENTILES),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    overall = None
+    per_document = []
+    per_bucket = []
+    for is_document, is_bucket, doc_id, bucket_start, count, latency, errors, idk, cached, distance in rows:
+        stats = {
+            "count": count,
+            "latency_ms": _percentiles(("p50", "p95", "p99"), latency),
+            "error_rate": _rate(errors),
+            "idk_rate": _rate(idk),
+            "cache_hit_rate": _rate(cached),
+            "best_distance": _percentiles(("p10", "p25", "p50", "p75", "p90"), distance),
+        }
+        if is_document:
+            per_document.append({"document_id": doc_id, **stats})
+        elif is_bucket:
+            per_bucket.append({"bucket": bucket_start.isoformat(), **stats})
+        else:
+            overall = stats
+
+    per_document.sort(key=lambda s: (-s["count"], s["document_id"] is None, s["document_id"] or 0))
+    per_bucket.sort(key=lambda s: s["bucket"])
+    return {
+        "overall": overall,
+        "by_document": per_document[:max_documents],
+        "by_bucket": per_bucket,
+    }
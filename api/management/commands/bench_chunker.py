@@ -0,0 +1,142 @@
+import json
+import random
+import re
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.chunker import CharTokenizer, get_tokenizer, iter_chunks
+
+WORDS = (
+    "vector index query chunk document embedding retrieval answer source model token "
+    "distance cosine postgres search recall latency batch cache prompt context page"
+).split()
+
+# chunk_text as it was before api/chunker.py: whole-text split + string concatenation
+_LEGACY_SPLIT_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+
+
+def legacy_chunk_text(text, max_chars=900, overlap=200):
+    text = (text or "").strip()
+    if not text:
+        return []
+    parts = [p.strip() for p in _LEGACY_SPLIT_RE.split(text) if p.strip()]
+    chunks = []
+    buf = ""
+    for p in parts:
+        if not buf:
+            buf = p
+        elif len(buf) + 1 + len(p) <= max_chars:
+            buf = f"{buf} {p}"
+        else:
+            chunks.append(buf.strip())
+            tail = buf[-overlap:] if overlap > 0 else ""
+            buf = f"{tail} {p}".strip()
+    if buf.strip():
+        chunks.append(buf.strip())
+    return chunks
+
+
+def synthetic_text(rng, n_chars):
+    paragraphs = []
+    total = 0
+    while total < n_chars:
+        sentences = [
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 30))).capitalize() + rng.choice(".!?")
+            for _ in range(rng.randint(1, 8))
+        ]
+        paragraphs.append(" ".join(sentences))
+        total += len(paragraphs[-1]) + 2
+    return "\n\n".join(paragraphs)
+
+
+def pieces_of(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def best_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return round(min(times) * 1000, 3)
+
+
+def peak_kb(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+class Command(BaseCommand):
+    help = (
+        "Microbenchmark of the streaming chunker (api/chunker.py) against the previous chunk_text "
+        "on synthetic text (no database, no network): time, peak memory and whether the chunks match. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100000,1000000,10000000", help="Comma-separated text sizes in characters.")
+        parser.add_argument("--max-chars", type=int, default=900)
+        parser.add_argument("--overlap", type=int, default=200)
+        parser.add_argument("--piece-size", type=int, default=1 << 16, help="Characters per piece fed to the streaming path.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the best is reported.")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(s) for s in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be comma-separated integers")
+
+        rng = random.Random(options["seed"])
+        max_chars, overlap, piece_size, repeat = (
+            options["max_chars"], options["overlap"], options["piece_size"], options["repeat"]
+        )
+        chars = CharTokenizer()
+        tokens = get_tokenizer("tiktoken")
+
+        def legacy(text):
+            return legacy_chunk_text(text, max_chars, overlap)
+
+        def streaming(text):
+            return [c for c, _, _ in iter_chunks(pieces_of(text, piece_size), max_chars, overlap, chars)]
+
+        def streaming_tokens(text):
+            # same chunk size in tokens (~4 characters each)
+            return [c for c, _, _ in iter_chunks(pieces_of(text, piece_size), max_chars // 4, overlap // 4, tokens)]
+
+        report = {
+            "max_chars": max_chars,
+            "overlap": overlap,
+            "piece_size": piece_size,
+            "token_tokenizer": type(tokens).__name__,
+            "results": [],
+        }
+        for size in sizes:
+            text = synthetic_text(rng, size)
+            expected = legacy(text)
+            result = {
+                "chars": len(text),
+                "chunks": len(expected),
+                "identical": streaming(text) == expected,
+                "legacy_ms": best_ms(lambda: legacy(text), repeat),
+                "chunker_ms": best_ms(lambda: streaming(text), repeat),
+                "chunker_tokens_ms": best_ms(lambda: streaming_tokens(text), repeat),
+                # peak allocations while chunking (the input text itself is excluded)
+                "legacy_peak_kb": peak_kb(lambda: legacy(text)),
+                "chunker_peak_kb": peak_kb(lambda: streaming(text)),
+            }
+            report["results"].append(result)
+            self.stderr.write(f"size {size}: {json.dumps(result)}")
+
+        out = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(out)
+        self.stdout.write(out)
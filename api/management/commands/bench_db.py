@@ -0,0 +1,96 @@
+import json
+import time
+
+import numpy as np
+import psycopg
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from pgvector import Vector
+
+from api.embeddings import active_generation
+from api.retrieval import _CHUNK_FIELDS, _prepared_vector_sql
+
+from .bench_retrieval import latency_stats
+
+# what the documents view runs: the cheap query whose latency connection setup dominates
+DOCUMENTS_SQL = "SELECT id, title, source, chunk_count, created_at FROM api_document ORDER BY id DESC LIMIT 20"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks per-request database overhead (no network besides Postgres): a new connection "
+        "per request vs the psycopg pool, and the vector search query unprepared vs as a "
+        "server-side prepared statement. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        n = options["requests"]
+        # the same connection parameters Django uses (adapters, cursor class), minus the pool
+        params = connection.get_connection_params()
+        params.pop("prepare_threshold", None)
+
+        report = {
+            "requests": n,
+            "connect_per_request": latency_stats(self._connect_per_request(params, n)),
+            "pooled": latency_stats(self._pooled(params, n)),
+        }
+        report["connection_setup_saved_ms"] = round(
+            report["connect_per_request"]["p50_ms"] - report["pooled"]["p50_ms"], 3
+        )
+
+        unprepared, prepared = self._vector_query(params, n, options["k"])
+        report["vector_query"] = {"unprepared": latency_stats(unprepared), "prepared": latency_stats(prepared)}
+
+        out = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(out)
+        self.stdout.write(out)
+
+    def _connect_per_request(self, params, n):
+        times = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            with psycopg.connect(**params) as conn:
+                conn.execute(DOCUMENTS_SQL).fetchall()
+            times.append(time.perf_counter() - t0)
+        return times
+
+    def _pooled(self, params, n):
+        from psycopg_pool import ConnectionPool
+
+        times = []
+        with ConnectionPool(kwargs=params, min_size=1, max_size=1) as pool:
+            pool.wait()
+            for _ in range(n):
+                t0 = time.perf_counter()
+                with pool.connection() as conn:
+                    conn.execute(DOCUMENTS_SQL).fetchall()
+                times.append(time.perf_counter() - t0)
+        return times
+
+    def _vector_query(self, params, n, k):
+        model, dims = active_generation()
+        columns = ", ".join(f"c.{f}" for f in _CHUNK_FIELDS)
+        sql = _prepared_vector_sql(columns, model, dims, "", "global")
+        rng = np.random.default_rng(0)
+
+        results = []
+        # server-side binding, which prepared statements need (Django binds client-side)
+        with psycopg.connect(**{**params, "cursor_factory": psycopg.Cursor}) as conn:
+            conn.execute("SELECT set_config('hnsw.ef_search', %s, false)", [str(max(settings.RAG_HNSW_EF_SEARCH, k))])
+            for prepare in (False, True):
+                times = []
+                for _ in range(n):
+                    emb = Vector(rng.standard_normal(dims).astype(np.float32)).to_text()
+                    t0 = time.perf_counter()
+                    conn.execute(sql, {"emb": emb, "document_id": None, "k": k}, prepare=prepare).fetchall()
+                    times.append(time.perf_counter() - t0)
+                results.append(times)
+        return results
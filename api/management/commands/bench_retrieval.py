@@ -0,0 +1,154 @@
+import json
+import statistics
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.ingest import store_chunks
+from api.models import Chunk, Document
+from api.retrieval import search_chunks, vector_queryset
+
+from .vector_index import index_name
+
+BENCH_TITLE = "__bench_retrieval__"
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def latency_stats(seconds):
+    ms = sorted(s * 1000 for s in seconds)
+    return {
+        "p50_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "qps": round(len(ms) / (sum(ms) / 1000), 1),
+    }
+
+
+def random_unit_vectors(rng, n):
+    v = rng.standard_normal((n, settings.RAG_EMBEDDING_DIMENSIONS)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the vector retrieval query on a synthetic corpus (no network): "
+        "latency percentiles, QPS, recall@k and size of the vector index (HNSW or IVFFlat, "
+        "full/halfvec/binary storage) vs exact search. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000", help="Comma-separated corpus sizes, run in increasing order.")
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--ef-search", type=int, help="hnsw.ef_search for the index path (default RAG_HNSW_EF_SEARCH).")
+        parser.add_argument("--probes", type=int, help="ivfflat.probes for the index path (default RAG_IVFFLAT_PROBES).")
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic document afterwards.")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted(int(s) for s in options["sizes"].split(","))
+        except ValueError:
+            raise CommandError("--sizes must be comma-separated integers")
+
+        k = options["k"]
+        rng = np.random.default_rng(options["seed"])
+
+        Document.objects.filter(title=BENCH_TITLE).delete()
+        doc = Document.objects.create(title=BENCH_TITLE, source="bench_retrieval")
+        corpus = np.empty((0, settings.RAG_EMBEDDING_DIMENSIONS), dtype=np.float32)
+
+        effort = {"ef_search": options["ef_search"], "probes": options["probes"]}
+        report = {
+            "k": k,
+            "queries": options["queries"],
+            "seed": options["seed"],
+            "index": settings.RAG_VECTOR_INDEX,
+            "storage": settings.RAG_VECTOR_STORAGE,
+            "dimensions": settings.RAG_EMBEDDING_DIMENSIONS,
+            "ef_search": effort["ef_search"] or settings.RAG_HNSW_EF_SEARCH,
+            "probes": effort["probes"] or settings.RAG_IVFFLAT_PROBES,
+            "results": [],
+        }
+        try:
+            for size in sizes:
+                corpus = self._grow_corpus(doc, corpus, size, rng)
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE api_chunk")
+
+                # queries are perturbed corpus vectors, so each has real near neighbours
+                picks = corpus[rng.integers(0, len(corpus), options["queries"])]
+                noise = rng.standard_normal(picks.shape).astype(np.float32) * 0.02
+                queries = [q.tolist() for q in picks + noise]
+
+                self._run(queries[:5], k, effort, exact=False)  # warm up caches
+                ann_ids, ann_times = self._run(queries, k, effort, exact=False)
+                exact_ids, exact_times = self._run(queries, k, effort, exact=True)
+
+                recall = statistics.mean(
+                    len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(ann_ids, exact_ids)
+                )
+                result = {
+                    "corpus_size": Chunk.objects.exclude(embedding=None).count(),
+                    "index_bytes": self._index_bytes(),
+                    "index": latency_stats(ann_times),
+                    "exact": latency_stats(exact_times),
+                    f"recall@{k}": round(recall, 4),
+                }
+                report["results"].append(result)
+                self.stderr.write(f"size {size}: {json.dumps(result)}")
+        finally:
+            if not options["keep"]:
+                doc.delete()
+
+        out = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(out)
+        self.stdout.write(out)
+
+    def _grow_corpus(self, doc, corpus, size, rng, batch=2000):
+        start = len(corpus)
+        while len(corpus) < size:
+            n = min(batch, size - len(corpus))
+            vectors = random_unit_vectors(rng, n)
+            indexes = range(len(corpus), len(corpus) + n)
+            store_chunks(doc, [f"bench chunk {i}" for i in indexes], list(vectors), indexes=list(indexes))
+            corpus = np.vstack([corpus, vectors])
+        if len(corpus) > start:
+            self.stderr.write(f"corpus at {len(corpus)} chunks")
+        return corpus
+
+    def _run(self, queries, k, effort, exact):
+        ids, times = [], []
+        for q in queries:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    if exact:
+                        # with index scans off Postgres falls back to a full scan: exact top-k
+                        cursor.execute("SET LOCAL enable_indexscan = off")
+                    else:
+                        # small corpora would otherwise get a seq scan and never touch the index
+                        cursor.execute("SET LOCAL enable_seqscan = off")
+                t0 = time.perf_counter()
+                if exact:
+                    # full-precision distances even when the index is halfvec/binary
+                    chunks = list(vector_queryset(q).only("id").order_by("distance")[:k])
+                else:
+                    chunks = search_chunks("", q, k, mode="vector", **effort)
+                times.append(time.perf_counter() - t0)
+            ids.append([c.id for c in chunks])
+        return ids, times
+
+    def _index_bytes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_relation_size(%s::regclass)", [index_name()])
+            return cursor.fetchone()[0]
@@ -0,0 +1,52 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+
+from api.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Processes queued ingestion jobs. Start several workers to run ingests in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty.")
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=settings.RAG_WORKER_POLL_SECONDS,
+            help="Seconds to sleep when there is nothing to do.",
+        )
+
+    def handle(self, *args, **options):
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.stdout.write(f"ingest worker {worker} started")
+
+        while True:
+            # drop a connection the database closed (restart, idle timeout) instead of dying on it
+            close_old_connections()
+            try:
+                job = claim_next_job(worker)
+            except DatabaseError as e:
+                self.stderr.write(f"claiming a job failed: {e!r}")
+                time.sleep(options["poll"])
+                continue
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll"])
+                continue
+
+            try:
+                job = run_job(job)
+            except DatabaseError as e:
+                # the job stays running until its lease runs out, then another claim retries it
+                self.stderr.write(f"job {job.id} lost its database connection: {e!r}")
+                continue
+            if job.status == job.STATUS_DONE:
+                self.stdout.write(f"job {job.id} done: {job.result}")
+            else:
+                self.stderr.write(f"job {job.id} failed: {job.error}")
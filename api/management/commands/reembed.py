@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from api.embeddings import active_generation
+from api.ingest import reembed_document
+from api.models import Chunk, Document
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-embeds documents with another embedding model / size (default: the RAG_EMBEDDING_* "
+        "settings), one document at a time. Each document switches in a single transaction and "
+        "questions about it follow its current generation, so the app keeps answering meanwhile."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", help='Default: the active model ("local:..." / "hash:..." for other providers).')
+        parser.add_argument("--dimensions", type=int, help="Default: RAG_EMBEDDING_DIMENSIONS.")
+        parser.add_argument("--document", type=int, action="append", help="Only this document (repeatable).")
+        parser.add_argument("--dry-run", action="store_true", help="List the documents that would be re-embedded.")
+
+    def handle(self, *args, **options):
+        model, dimensions = active_generation()
+        generation = (options["model"] or model, options["dimensions"] or dimensions)
+
+        pending = Chunk.objects.exclude(embedding_model=generation[0], embedding_dimensions=generation[1])
+        if options["document"]:
+            pending = pending.filter(document_id__in=options["document"])
+        doc_ids = sorted(set(pending.values_list("document_id", flat=True)))
+
+        self.stdout.write(f"{len(doc_ids)} document(s) to move to {generation[0]} @ {generation[1]} dims")
+        if options["dry_run"]:
+            for doc in Document.objects.filter(id__in=doc_ids).order_by("id"):
+                self.stdout.write(f"  {doc.id}: {doc.title} ({doc.embedding_model} @ {doc.embedding_dimensions})")
+            return
+
+        for doc in Document.objects.filter(id__in=doc_ids).order_by("id"):
+            stats = reembed_document(
+                doc,
+                generation,
+                on_embed=lambda done: self.stderr.write(f"  document {doc.id}: {done} texts embedded"),
+            )
+            self.stdout.write(f"document {doc.id} done: {stats}")
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.models import Document
+
+from .vector_index import index_method, index_target
+
+INDEX_PREFIX = "chunk_emb_doc_"
+
+
+def _predicate(document_id, model, dims):
+    quoted_model = "'" + model.replace("'", "''") + "'"
+    return (
+        f"document_id = {int(document_id)} "
+        f"AND embedding_model = {quoted_model} AND embedding_dimensions = {int(dims)}"
+    )
+
+
+def partial_index_sql(name, document_id, model, dims):
+    """
+    CREATE INDEX for one document's chunks (in its embedding generation), with the same
+    expression and build settings as the global index.
+    """
+    method, params = index_method()
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON api_chunk "
+        f"USING {method} ({index_target(dims)}) WITH ({', '.join(f'{k} = {v}' for k, v in params.items())}) "
+        f"WHERE {_predicate(document_id, model, dims)}"
+    )
+
+
+def _storage_of(indexdef):
+    if "halfvec_cosine_ops" in indexdef:
+        return "halfvec"
+    if "bit_hamming_ops" in indexdef:
+        return "binary"
+    return "full"
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds a partial vector index (WHERE document_id = ...) for each large document, so "
+        "document-scoped questions use a small index of their own. Drops indexes of documents "
+        "that shrank or were deleted. Safe to re-run, e.g. after big ingests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-chunks", type=int, help="Default: RAG_SCOPED_INDEX_MIN_CHUNKS.")
+        parser.add_argument("--dry-run", action="store_true", help="Print the changes without applying them.")
+
+    def handle(self, *args, **options):
+        min_chunks = options["min_chunks"] or settings.RAG_SCOPED_INDEX_MIN_CHUNKS
+        method, _ = index_method()
+
+        docs = Document.objects.filter(chunk_count__gte=min_chunks).exclude(embedding_model="")
+        wanted = {
+            f"{INDEX_PREFIX}{doc_id}": (doc_id, model, dims)
+            for doc_id, model, dims in docs.values_list("id", "embedding_model", "embedding_dimensions")
+        }
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'api_chunk'")
+            existing = {name: indexdef for name, indexdef in cursor.fetchall() if name.startswith(INDEX_PREFIX)}
+
+        # indexes built for another index type, storage or embedding generation are rebuilt
+        stale = [
+            name for name, indexdef in existing.items()
+            if name not in wanted
+            or f"USING {method} " not in indexdef
+            or _storage_of(indexdef) != settings.RAG_VECTOR_STORAGE
+            or f"embedding_dimensions = {wanted[name][2]})" not in indexdef
+            or "'" + wanted[name][1].replace("'", "''") + "'" not in indexdef
+        ]
+        missing = [name for name in wanted if name not in existing or name in stale]
+
+        # CONCURRENTLY can't run in a transaction; management commands run in autocommit
+        with connection.cursor() as cursor:
+            for name in sorted(stale):
+                self.stdout.write(f"drop {name}")
+                if not options["dry_run"]:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            for name in sorted(missing):
+                self.stdout.write(f"create {name}")
+                if not options["dry_run"]:
+                    cursor.execute(partial_index_sql(name, *wanted[name]))
+
+        verb = "would be" if options["dry_run"] else "were"
+        self.stdout.write(f"{len(wanted)} partial index(es) wanted; {len(missing)} {verb} created, {len(stale)} {verb} dropped")
@@ -0,0 +1,145 @@
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.embeddings import active_generation
+from api.models import Chunk
+
+INDEX_PREFIX = "chunk_embedding_"
+
+# the WHERE clause of index_sql (or of the migrated index) as pg_indexes shows it
+_MODEL_RE = re.compile(r"\(embedding_model\)::text = '((?:[^']|'')*)'::text")
+_DIMS_RE = re.compile(r"\(embedding_dimensions = (\d+)\)")
+
+
+def index_target(dims):
+    """The indexed expression and operator class for RAG_VECTOR_STORAGE."""
+    dims = int(dims)
+    return {
+        "halfvec": f"(embedding::halfvec({dims})) halfvec_cosine_ops",
+        "binary": f"(binary_quantize(embedding)::bit({dims})) bit_hamming_ops",
+    }.get(settings.RAG_VECTOR_STORAGE, f"(embedding::vector({dims})) vector_cosine_ops")
+
+
+def index_method():
+    """(access method, WITH parameters as pg_indexes shows them) for RAG_VECTOR_INDEX."""
+    if settings.RAG_VECTOR_INDEX == "ivfflat":
+        return "ivfflat", {"lists": int(settings.RAG_IVFFLAT_LISTS)}
+    return "hnsw", {"m": int(settings.RAG_HNSW_M), "ef_construction": int(settings.RAG_HNSW_EF_CONSTRUCTION)}
+
+
+def index_name():
+    """Name of the global ANN index for the current settings (chunk_embedding_hnsw by default)."""
+    method, _ = index_method()
+    storage = settings.RAG_VECTOR_STORAGE
+    return f"{INDEX_PREFIX}{method}" + ("" if storage == "full" else f"_{storage}")
+
+
+def index_sql(name, model, dims):
+    """CREATE INDEX for the chunks of one embedding generation, with the current settings."""
+    method, params = index_method()
+    quoted_model = "'" + model.replace("'", "''") + "'"
+    return (
+        f"CREATE INDEX CONCURRENTLY {name} ON api_chunk "
+        f"USING {method} ({index_target(dims)}) "
+        f"WITH ({', '.join(f'{k} = {v}' for k, v in params.items())}) "
+        f"WHERE embedding_model = {quoted_model} AND embedding_dimensions = {int(dims)}"
+    )
+
+
+def matches(indexdef, model, dims):
+    """Whether an index definition from pg_indexes was built with the current settings for (model, dims)."""
+    method, params = index_method()
+    return (
+        f"USING {method} " in indexdef
+        and f") {index_target(dims).split()[-1]}" in indexdef  # operator class, i.e. storage
+        and all(f"{k}='{v}'" in indexdef for k, v in params.items())
+        and f"embedding_dimensions = {int(dims)})" in indexdef
+        and "'" + model.replace("'", "''") + "'" in indexdef
+    )
+
+
+def index_generation(indexdef):
+    """(model, dims) of the embedding generation an index definition covers, or None if it isn't partial."""
+    model, dims = _MODEL_RE.search(indexdef), _DIMS_RE.search(indexdef)
+    return (model.group(1).replace("''", "'"), int(dims.group(1))) if model and dims else None
+
+
+def in_use(indexdef, model, dims):
+    """Whether the index covers another embedding generation that chunks still use (e.g. during reembed)."""
+    generation = index_generation(indexdef)
+    return (
+        generation is not None
+        and generation != (model, int(dims))
+        and Chunk.objects.filter(embedding_model=generation[0], embedding_dimensions=generation[1]).exists()
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the vector index on Chunk.embedding from RAG_VECTOR_INDEX, RAG_HNSW_* / RAG_IVFFLAT_*, "
+        "RAG_VECTOR_STORAGE and the active embedding generation, then drops the index it replaces. "
+        "Migrations create the default HNSW index; run this after changing any of those settings. "
+        "Indexes of an older generation that chunks still use are kept until reembed is done. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Print the changes without applying them.")
+
+    def handle(self, *args, **options):
+        model, dims = active_generation()
+        name = index_name()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisvalid
+                FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = 'api_chunk'::regclass
+                """
+            )
+            existing = {n: (indexdef, valid) for n, indexdef, valid in cursor.fetchall() if n.startswith(INDEX_PREFIX)}
+
+        steps = []
+        outdated = False
+        if name not in existing:
+            steps.append((f"create {name}", [index_sql(name, model, dims)]))
+        elif not existing[name][1] or not matches(existing[name][0], model, dims):
+            if in_use(existing[name][0], model, dims):
+                # the old generation is still searched: move its index aside, a later run drops it
+                if f"{name}_prev" in existing:
+                    self.stderr.write(f"keeping {name}: chunks still use its embedding generation and {name}_prev exists")
+                    outdated = True
+                else:
+                    steps.append((f"keep {name} as {name}_prev, create {name}", [
+                        f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new",
+                        index_sql(f"{name}_new", model, dims),
+                        f"ALTER INDEX {name} RENAME TO {name}_prev",
+                        f"ALTER INDEX {name}_new RENAME TO {name}",
+                    ]))
+            else:
+                # build the replacement first, so searches keep an index while it builds
+                steps.append((f"rebuild {name}", [
+                    f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new",  # left INVALID by an interrupted run
+                    index_sql(f"{name}_new", model, dims),
+                    f"DROP INDEX CONCURRENTLY {name}",
+                    f"ALTER INDEX {name}_new RENAME TO {name}",
+                ]))
+        for other in sorted(set(existing) - {name, f"{name}_new"}):
+            if in_use(existing[other][0], model, dims):
+                self.stderr.write(f"keeping {other}: chunks still use its embedding generation")
+            else:
+                steps.append((f"drop {other}", [f"DROP INDEX CONCURRENTLY IF EXISTS {other}"]))
+
+        # CONCURRENTLY can't run in a transaction; management commands run in autocommit
+        with connection.cursor() as cursor:
+            for label, statements in steps:
+                self.stdout.write(label)
+                if not options["dry_run"]:
+                    for sql in statements:
+                        cursor.execute(sql)
+
+        if not steps and not outdated:
+            self.stdout.write(f"{name} is up to date")
@@ -0,0 +1,158 @@
+"""
+In-process metrics in the Prometheus text format, served by /metrics.
+- Counter and Histogram are the two types the app needs; values are per process,
+  so with several workers scrape each one (or sum them in Prometheus)
+- Stages times the stages of one request and feeds rag_stage_seconds
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds: sub-millisecond context builds up to minute-long generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+_registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[n] for n in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels -> [count per bucket (+Inf last), sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[n] for n in self.labelnames))
+        return entry[2] if entry else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += c
+                    lines.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+def render():
+    """All metrics of this process in the Prometheus text exposition format."""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = Histogram("rag_request_seconds", "Time to answer a request, by view.", ["view"])
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Time spent in each stage of a request (embed, retrieve, context, generate, pdf_extract, chunk...).",
+    ["view", "stage"],
+)
+PROMPT_TOKENS = Histogram("rag_prompt_tokens", "Tokens in each answer prompt.", ["view"], buckets=TOKEN_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    "rag_cache_lookups_total",
+    "Cache lookups by cache (answer, query_embedding, embedding) and result (hit, miss).",
+    ["cache", "result"],
+)
+
+
+class Stages:
+    """
+    Times the stages of one request: `with stages("embed"): ...`.
+    - stages are exclusive: time in a stage nested in another isn't counted in the outer one
+    - iterate() times a lazy producer (PDF pages, chunks) as it is consumed
+    - finish() observes each stage total in rag_stage_seconds and the time since the Stages
+      was created in rag_request_seconds; a Stages without a view observes nothing
+    """
+
+    def __init__(self, view=None):
+        self.view = view
+        self.seconds = {}
+        self._stack = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def __call__(self, stage):
+        self._stack.append(stage)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self._stack.pop()
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+            if self._stack:
+                parent = self._stack[-1]
+                self.seconds[parent] = self.seconds.get(parent, 0.0) - elapsed
+
+    def iterate(self, stage, iterable):
+        it = iter(iterable)
+        while True:
+            with self(stage):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def ms(self, stage):
+        """A stage's total in milliseconds (None if it didn't run), as stored in QueryLog."""
+        seconds = self.seconds.get(stage)
+        return round(seconds * 1000, 2) if seconds is not None else None
+
+    def finish(self):
+        if self.view is None:
+            return
+        REQUEST_SECONDS.observe(time.perf_counter() - self._started, view=self.view)
+        for stage, seconds in self.seconds.items():
+            STAGE_SECONDS.observe(seconds, view=self.view, stage=stage)
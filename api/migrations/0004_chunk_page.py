@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_ingestjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='page',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 6.0 on 2026-10-17 06:25
+
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_chunk_page'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='text_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='EmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=64)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('embedding', pgvector.django.vector.VectorField(dimensions=1536)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('model', 'text_hash')},
+            },
+        ),
+        # Hash existing chunks and seed the cache with their vectors,
+        # so the first re-ingest after upgrading doesn't re-embed everything
+        migrations.RunSQL(
+            sql=[
+                "UPDATE api_chunk SET text_hash = encode(sha256(convert_to(text, 'UTF8')), 'hex') WHERE text_hash = '';",
+                """
+                INSERT INTO api_embeddingcache (model, text_hash, embedding, created_at)
+                SELECT DISTINCT ON (text_hash) 'text-embedding-3-small', text_hash, embedding, now()
+                FROM api_chunk
+                WHERE embedding IS NOT NULL;
+                """,
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 6.0 on 2026-10-17 06:40
+
+import django.db.models.deletion
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_embedding_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='AnswerCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document_version', models.IntegerField()),
+                ('k', models.IntegerField()),
+                ('question', models.TextField()),
+                ('question_embedding', pgvector.django.vector.VectorField(dimensions=1536)),
+                ('best_distance', models.FloatField()),
+                ('answer', models.TextField()),
+                ('sources', models.JSONField(default=list)),
+                ('hits', models.IntegerField(default=0)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cached_answers', to='api.document')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['document', 'document_version', 'k'], name='answercache_doc_version')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 07:40
+
+import pgvector.django.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_chunk_search_vector'),
+    ]
+
+    # m=16 / ef_construction=64 are pgvector's defaults, which the existing index
+    # was already built with: record them in the model state without a rebuild
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name='chunk',
+                    name='chunk_embedding_hnsw',
+                ),
+                migrations.AddIndex(
+                    model_name='chunk',
+                    index=pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding'], m=16, name='chunk_embedding_hnsw', opclasses=['vector_cosine_ops']),
+                ),
+            ],
+        ),
+    ]
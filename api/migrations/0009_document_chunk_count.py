@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-17 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_chunk_embedding_index_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='chunk_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE api_document d
+                SET chunk_count = (SELECT count(*) FROM api_chunk c WHERE c.document_id = d.id)
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 6.0 on 2026-10-17 09:20
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+import pgvector.django.indexes
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_document_chunk_count'),
+    ]
+
+    operations = [
+        # the index needs a fixed size; it's rebuilt below on embedding::vector(1536)
+        migrations.RemoveIndex(
+            model_name='chunk',
+            name='chunk_embedding_hnsw',
+        ),
+        migrations.AlterField(
+            model_name='chunk',
+            name='embedding',
+            field=pgvector.django.vector.VectorField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='embeddingcache',
+            name='embedding',
+            field=pgvector.django.vector.VectorField(),
+        ),
+        migrations.AlterField(
+            model_name='answercache',
+            name='question_embedding',
+            field=pgvector.django.vector.VectorField(),
+        ),
+        migrations.AddField(
+            model_name='chunk',
+            name='embedding_model',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='chunk',
+            name='embedding_dimensions',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='embedding_model',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='embedding_dimensions',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='embeddingcache',
+            name='dimensions',
+            field=models.IntegerField(default=1536),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name='embeddingcache',
+            unique_together={('model', 'dimensions', 'text_hash')},
+        ),
+        # everything so far was embedded with text-embedding-3-small at full size
+        migrations.RunSQL(
+            sql="""
+                UPDATE api_chunk
+                SET embedding_model = 'text-embedding-3-small', embedding_dimensions = vector_dims(embedding)
+                WHERE embedding IS NOT NULL;
+
+                UPDATE api_document d
+                SET embedding_model = c.embedding_model, embedding_dimensions = c.embedding_dimensions
+                FROM (
+                    SELECT DISTINCT ON (document_id) document_id, embedding_model, embedding_dimensions
+                    FROM api_chunk
+                    WHERE embedding IS NOT NULL
+                ) c
+                WHERE c.document_id = d.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='chunk',
+            index=pgvector.django.indexes.HnswIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.comparison.Cast('embedding', pgvector.django.vector.VectorField(dimensions=1536)), name='vector_cosine_ops'), condition=models.Q(('embedding_dimensions', 1536), ('embedding_model', 'text-embedding-3-small')), ef_construction=64, m=16, name='chunk_embedding_hnsw'),
+        ),
+    ]
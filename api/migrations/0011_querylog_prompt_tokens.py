@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_embedding_generations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querylog',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='context_chunks',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-17 12:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_querylog_prompt_tokens'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='querylog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
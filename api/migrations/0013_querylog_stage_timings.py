@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-17 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_querylog_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querylog',
+            name='context_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='embed_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='generate_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='retrieve_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-17 14:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # built without locking out the query log writer on a large table
+    atomic = False
+
+    dependencies = [
+        ('api', '0013_querylog_stage_timings'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='querylog',
+            index=models.Index(fields=['created_at'], name='querylog_created_at'),
+        ),
+        AddIndexConcurrently(
+            model_name='querylog',
+            index=models.Index(fields=['document_id', 'created_at'], name='querylog_document_created_at'),
+        ),
+    ]
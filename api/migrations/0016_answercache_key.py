@@ -0,0 +1,36 @@
+# Generated by Django 6.0 on 2026-10-17 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_ingestjob_heartbeat'),
+    ]
+
+    # existing entries don't record the mode/rerank they were answered with: start empty
+    operations = [
+        migrations.RunSQL(
+            "DELETE FROM api_answercache",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RemoveIndex(
+            model_name='answercache',
+            name='answercache_doc_version',
+        ),
+        migrations.AddField(
+            model_name='answercache',
+            name='mode',
+            field=models.CharField(default='vector', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='answercache',
+            name='rerank',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='answercache',
+            index=models.Index(fields=['document', 'document_version', 'k', 'mode', 'rerank', 'id'], name='answercache_key'),
+        ),
+    ]
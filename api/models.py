@@ -1,4 +1,8 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models.functions import Cast
+from django.utils import timezone
 from pgvector.django import VectorField, HnswIndex
 
 
@@ -7,6 +11,16 @@ class Document(models.Model):
     source = models.CharField(max_length=1024, blank=True)  # filename, url, etc.
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # bumped whenever the chunk set changes (re-ingest), invalidates AnswerCache
+    version = models.IntegerField(default=0)
+
+    # number of chunks, kept in step by ingestion; picks the scoped retrieval strategy
+    chunk_count = models.IntegerField(default=0)
+
+    # embedding generation of its chunks; questions about it are embedded the same way
+    embedding_model = models.CharField(max_length=64, blank=True, default="")
+    embedding_dimensions = models.IntegerField(null=True, blank=True)
+
     def __str__(self):
         return self.title
 
@@ -15,25 +29,56 @@ class Chunk(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="chunks")
     chunk_index = models.IntegerField()  # ordering within the doc
     text = models.TextField()
+    page = models.IntegerField(null=True, blank=True)  # 1-based, PDFs only
+    text_hash = models.CharField(max_length=64, blank=True, default="")  # sha256 of text, for re-ingest diffs
    
-    # using 1536 as a default
-    embedding = VectorField(dimensions=1536, null=True, blank=True)
+    # no fixed size: vectors of different embedding generations can coexist
+    embedding = VectorField(null=True, blank=True)
+    embedding_model = models.CharField(max_length=64, blank=True, default="")
+    embedding_dimensions = models.IntegerField(null=True, blank=True)
+
+    # full-text index of text, kept in sync by Postgres (lexical/hybrid retrieval)
+    search_vector = models.GeneratedField(
+        expression=SearchVector("text", config="english"),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = [('document', 'chunk_index')]
         indexes = [
+            # The ANN index as migrations create it: HNSW over text-embedding-3-small/1536 rows.
+            # embedding has no fixed size, so it is on a cast, for one generation only.
+            # Another index type, build parameters, storage or generation comes from settings
+            # and is built by `manage.py vector_index`, never through the model state
             HnswIndex(
+                OpClass(Cast('embedding', VectorField(dimensions=1536)), name='vector_cosine_ops'),
                 name='chunk_embedding_hnsw',
-                fields=['embedding'],
-                opclasses=['vector_cosine_ops'],
-            )
+                m=16,
+                ef_construction=64,
+                condition=models.Q(embedding_model='text-embedding-3-small', embedding_dimensions=1536),
+            ),
+            GinIndex(name='chunk_search_vector_gin', fields=['search_vector']),
         ]
 
-class QueryLog(models.Model):
+class EmbeddingCache(models.Model):
+    """Embeddings of chunk texts by (model, dimensions, sha256 of text), reused across ingests."""
+    model = models.CharField(max_length=64)
+    dimensions = models.IntegerField()
+    text_hash = models.CharField(max_length=64)
+    embedding = VectorField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        unique_together = [('model', 'dimensions', 'text_hash')]
+
+
+class QueryLog(models.Model):
+    # set when the row is built, not when the batched writer inserts it
+    created_at = models.DateTimeField(default=timezone.now)
+
     question = models.TextField()
     answer = models.TextField(blank=True, default="")
     
@@ -47,6 +92,90 @@ class QueryLog(models.Model):
     latency_ms = models.IntegerField(null=True, blank=True)
 
     error = models.TextField(blank=True, default="")
+    cached = models.BooleanField(default=False)  # answer served from AnswerCache
+
+    prompt_tokens = models.IntegerField(null=True, blank=True)  # answer prompt, as counted by api.context
+    context_chunks = models.IntegerField(null=True, blank=True)  # retrieved chunks that fit the token budget
+
+    # time per stage of the answer (api.metrics.Stages), null when the stage didn't run
+    embed_ms = models.FloatField(null=True, blank=True)
+    retrieve_ms = models.FloatField(null=True, blank=True)
+    context_ms = models.FloatField(null=True, blank=True)
+    generate_ms = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # /api/logs/stats/ reads a time window, optionally of one document
+            models.Index(fields=["created_at"], name="querylog_created_at"),
+            models.Index(fields=["document_id", "created_at"], name="querylog_document_created_at"),
+        ]
+
+    def __str__(self):
+        return f"{self.created_at: %Y-%m-%d %H:%M:%S} - {self.question[:40]}"
+
+class IngestJob(models.Model):
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # bumped by the running worker; a stale one means it died
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    kind = models.CharField(max_length=16)  # "pdf" or "text_file"
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="ingest_jobs")
+    upload_path = models.CharField(max_length=1024)  # spooled upload, removed when the job ends
+
+    stage = models.CharField(max_length=16, blank=True, default="")  # extract/chunk/embed/store
+    progress = models.JSONField(default=dict)  # {stage: {"done": n, "total": m}}
+    result = models.JSONField(default=dict)
+    error = models.TextField(blank=True, default="")
+    worker = models.CharField(max_length=64, blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)  # times a worker has claimed the job
+
+    class Meta:
+        indexes = [
+            # workers poll for the oldest queued job
+            models.Index(fields=["status", "id"], name="ingestjob_status_id"),
+        ]
 
     def __str__(self):
-        return f"{self.created_at: %Y-%m-%d %H:%M:%S} - {self.question[:40]}"
\ No newline at end of file
+        return f"job {self.id} ({self.kind}, {self.status})"
+
+
+
+class AnswerCache(models.Model):
+    """
+    Generated answers for /ask, matched by question embedding distance.
+    Only entries for the document's current version are used; each (document, version, k, mode, rerank)
+    keeps its RAG_ANSWER_CACHE_MAX_ENTRIES newest entries for up to RAG_ANSWER_CACHE_TTL_SECONDS.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="cached_answers")
+    document_version = models.IntegerField()
+    k = models.IntegerField()
+    mode = models.CharField(max_length=16, default="vector")  # retrieval mode the answer's sources came from
+    rerank = models.BooleanField(default=True)
+
+    question = models.TextField()
+    question_embedding = VectorField()  # same generation as the document version's chunks
+    best_distance = models.FloatField()
+
+    answer = models.TextField()
+    sources = models.JSONField(default=list)
+    hits = models.IntegerField(default=0)  # approximate: counted in memory and written in batches
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["document", "document_version", "k", "mode", "rerank", "id"], name="answercache_key"),
+        ]
@@ -0,0 +1,121 @@
+import mmap
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from itertools import islice
+
+from django.conf import settings
+from pypdf import PdfReader
+
+
+@contextmanager
+def open_pdf(path):
+    """
+    PdfReader over a read-only memory map of the file.
+    Given a path, pypdf reads the whole file into memory (once per pool process); mapped
+    pages are loaded on demand and shared between processes through the OS page cache.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped; let pypdf report them
+            yield PdfReader(f)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield PdfReader(m)
+
+
+def _extract_page_range(path, start, stop):
+    # Runs in a pool process: each task opens its own reader (readers can't be pickled)
+    with open_pdf(path) as reader:
+        return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    """
+    The process-wide extraction pool (RAG_PDF_WORKERS processes), created on first use and
+    shared by every request and job, so its processes start once instead of per upload.
+    They start from a forkserver (spawn where there is none), not by forking this process:
+    a fork would copy a threaded server mid-request, open DB connections and locks included.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.RAG_PDF_WORKERS or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context(method),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _discard_executor(pool):
+    # a pool whose process died can't take work anymore: the next call starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_pdf_pages(path, workers=None, pages_per_task=None, max_inflight=None, on_page=None):
+    """
+    Yields (page_number, text) for every page in page order, page numbers starting at 1.
+    - page ranges are extracted in the shared process pool (pypdf is CPU-bound, see _executor)
+    - at most max_inflight ranges are submitted at once, which caps the text held in memory
+      (and how much of the pool one upload takes)
+    - small PDFs (< RAG_PDF_PARALLEL_MIN_PAGES) are extracted in-process, the pool round trips
+      cost more than they save
+    - the file is memory-mapped (open_pdf), never read into memory whole
+    on_page(done, total) is called after each page is yielded.
+    """
+    workers = workers or settings.RAG_PDF_WORKERS or os.cpu_count() or 1
+    pages_per_task = pages_per_task or settings.RAG_PDF_PAGES_PER_TASK
+    max_inflight = max_inflight or workers * 2
+
+    with open_pdf(path) as reader:
+        total = len(reader.pages)
+        if workers <= 1 or total < settings.RAG_PDF_PARALLEL_MIN_PAGES:
+            for i, page in enumerate(reader.pages):
+                yield i + 1, page.extract_text() or ""
+                if on_page:
+                    on_page(i + 1, total)
+            return
+
+    ranges = iter([(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)])
+    page_no = 0
+
+    pool = _executor()
+    pending = deque()
+    try:
+        pending.extend(pool.submit(_extract_page_range, path, *r) for r in islice(ranges, max_inflight))
+
+        while pending:
+            texts = pending.popleft().result()
+
+            # keep the window full before handing pages to the consumer
+            nxt = next(ranges, None)
+            if nxt is not None:
+                pending.append(pool.submit(_extract_page_range, path, *nxt))
+
+            for text in texts:
+                page_no += 1
+                yield page_no, text
+                if on_page:
+                    on_page(page_no, total)
+    except BrokenProcessPool:
+        _discard_executor(pool)
+        raise
+    finally:
+        # the consumer may stop early (an error, a closed stream): don't leave its ranges queued
+        for future in pending:
+            future.cancel()
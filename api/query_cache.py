@@ -0,0 +1,161 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from .embeddings import active_generation, aembed, embed
+from .metrics import CACHE_LOOKUPS
+
+
+def normalize_query(text):
+    # casefold + collapse whitespace so trivially different spellings share an entry
+    return " ".join((text or "").split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU of question embeddings with a TTL, in front of an optional
+    shared Django cache (so several workers can share hits).
+    Vectors are kept as float32 arrays locally (~6 KB each at 1536 dims).
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, shared_alias=""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared_alias = shared_alias
+        self._entries = OrderedDict()  # key -> (expires_at, vector)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def key(self, text, generation=None):
+        model, dimensions = generation or active_generation()
+        digest = hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+        return f"qemb:{model}:{dimensions}:{digest}"
+
+    def get(self, key):
+        vector = self._get_local(key)
+        if vector is not None:
+            return vector
+        if self.shared_alias:
+            return self._shared_result(key, caches[self.shared_alias].get(key))
+        return self._shared_result(key, None)
+
+    async def aget(self, key):
+        vector = self._get_local(key)
+        if vector is not None:
+            return vector
+        if self.shared_alias:
+            return self._shared_result(key, await caches[self.shared_alias].aget(key))
+        return self._shared_result(key, None)
+
+    def set(self, key, vector):
+        self._set_local(key, vector)
+        if self.shared_alias:
+            caches[self.shared_alias].set(key, list(vector), timeout=self.ttl)
+
+    async def aset(self, key, vector):
+        self._set_local(key, vector)
+        if self.shared_alias:
+            await caches[self.shared_alias].aset(key, list(vector), timeout=self.ttl)
+
+    def _get_local(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, vector = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="query_embedding", result="hit")
+                return vector.tolist()
+            del self._entries[key]
+        return None
+
+    def _shared_result(self, key, vector):
+        # counts a shared hit (and copies it locally) or a miss
+        if vector is not None:
+            self._set_local(key, vector)
+            with self._lock:
+                self.shared_hits += 1
+            CACHE_LOOKUPS.inc(cache="query_embedding", result="hit")
+            return vector
+        with self._lock:
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache="query_embedding", result="miss")
+        return None
+
+    def _set_local(self, key, vector):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, np.asarray(vector, dtype=np.float32))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.shared_hits) / lookups, 4) if lookups else None,
+            }
+
+
+query_cache = QueryEmbeddingCache(
+    maxsize=settings.RAG_QUERY_CACHE_SIZE,
+    ttl=settings.RAG_QUERY_CACHE_TTL,
+    shared_alias=settings.RAG_QUERY_CACHE_SHARED,
+)
+
+
+def embed_query(text, generation=None):
+    """
+    Embedding for a question, served from query_cache when possible.
+    generation is (model, dimensions), default the active one from settings.
+    """
+    key = query_cache.key(text, generation)
+    vector = query_cache.get(key)
+    if vector is None:
+        vector = embed([text], generation)[0]
+        query_cache.set(key, vector)
+    return vector
+
+
+def embed_queries(texts, generation=None):
+    """embed_query for many questions: the cache misses are embedded in a single call."""
+    keys = [query_cache.key(t, generation) for t in texts]
+    vectors = {key: query_cache.get(key) for key in set(keys)}
+    missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+    if missing:
+        for key, vector in zip(missing, embed(list(missing.values()), generation)):
+            vectors[key] = vector
+            query_cache.set(key, vector)
+    return [vectors[key] for key in keys]
+
+
+async def aembed_query(text, generation=None):
+    """embed_query for async views."""
+    key = query_cache.key(text, generation)
+    vector = await query_cache.aget(key)
+    if vector is None:
+        vector = (await aembed([text], generation))[0]
+        await query_cache.aset(key, vector)
+    return vector
@@ -0,0 +1,138 @@
+import atexit
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+
+from .answer_cache import flush_hits, pending_hits
+from .metrics import STAGE_SECONDS
+from .models import QueryLog
+
+logger = logging.getLogger(__name__)
+
+
+class QueryLogWriter:
+    """
+    Buffers finished QueryLog rows and writes them with bulk_create from a background thread,
+    so logging costs the request an append instead of two or three INSERT/UPDATE round trips.
+    - the thread writes when batch_size rows are waiting, and at least every flush_seconds:
+      a crash loses at most that window of logs; close() (run at exit) writes the rest
+    - a submit that finds max_pending rows waiting (e.g. the database is down) writes them itself
+    - inside a transaction (ATOMIC_REQUESTS, tests) and with flush_seconds <= 0 rows are written right away
+    """
+
+    def __init__(self, batch_size=100, flush_seconds=2.0, max_pending=10000):
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.max_pending = max(self.batch_size, max_pending)
+        self._pending = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()  # one writer at a time keeps rows in submit order
+        self._thread = None
+        self._closed = False
+
+    def submit(self, *logs):
+        """Queues unsaved QueryLog instances for writing."""
+        if not logs:
+            return
+        if self._closed or self.flush_seconds <= 0 or connection.in_atomic_block:
+            QueryLog.objects.bulk_create(logs)
+            return
+
+        with self._cond:
+            self._pending.extend(logs)
+            if self._thread is None or not self._thread.is_alive():
+                # (re)started lazily: after a fork the parent's thread is gone
+                self._thread = threading.Thread(target=self._run, name="querylog-writer", daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    async def asubmit(self, *logs):
+        await sync_to_async(self.submit)(*logs)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self):
+        """Writes everything buffered so far, in the calling thread. Returns the number of rows written."""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            t0 = time.perf_counter()
+            try:
+                QueryLog.objects.bulk_create(batch, batch_size=self.batch_size)
+                STAGE_SECONDS.observe(time.perf_counter() - t0, view="query_log", stage="bulk_insert")
+            except Exception:
+                logger.exception("writing %d query logs failed", len(batch))
+                self._requeue(batch)
+                return 0
+            return len(batch)
+
+    def _requeue(self, batch):
+        # put the failed rows back in front for the next flush, dropping the oldest over max_pending
+        with self._cond:
+            self._pending[:0] = batch
+            dropped = len(self._pending) - self.max_pending
+            if dropped > 0:
+                del self._pending[:dropped]
+                logger.error("dropped %d query logs", dropped)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_seconds)
+                closed = self._closed
+            self.flush()
+            if closed:
+                connection.close()
+                return
+            close_old_connections()
+
+    def close(self, timeout=10):
+        """Stops the background thread after a last flush; later submits write right away."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self.flush()
+
+
+# Process-wide writer used by the views; whatever is still buffered is written at exit
+query_logs = QueryLogWriter(
+    batch_size=settings.RAG_QUERYLOG_BATCH_SIZE,
+    flush_seconds=settings.RAG_QUERYLOG_FLUSH_SECONDS,
+    max_pending=settings.RAG_QUERYLOG_MAX_PENDING,
+)
+
+
+def shutdown():
+    """
+    Run at exit: closes query_logs, then writes the answer cache hits still counted in memory.
+    The hits are dropped with a warning when the database can't be reached any more.
+    """
+    query_logs.close()
+    hits = pending_hits()
+    if not hits:
+        return
+    try:
+        connection.ensure_connection()
+    except DatabaseError as e:
+        logger.warning("dropped %d answer cache hits, the database is unavailable: %s", hits, e)
+        return
+    flush_hits()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,90 @@
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .retrieval import search_chunks, search_chunks_batch
+
+
+@lru_cache(maxsize=None)
+def cross_encoder(model):
+    """sentence-transformers CrossEncoder, loaded once per process."""
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError as e:
+        raise ImproperlyConfigured("RAG_CROSS_ENCODER_MODEL needs the sentence-transformers package") from e
+    return CrossEncoder(model, device=settings.RAG_LOCAL_EMBEDDING_DEVICE)
+
+
+def mmr(relevance, vectors, n, lambda_mult):
+    """
+    Indexes of n items picked by Maximal Marginal Relevance: each step takes the item with the
+    best lambda * relevance - (1 - lambda) * (max similarity to the items already picked).
+    vectors is an (items, dims) array; zero rows are never similar to anything.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = unit @ unit.T
+
+    redundancy = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    picked = []
+    for _ in range(min(n, len(relevance))):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        i = int(np.argmax(scores))
+        picked.append(i)
+        available[i] = False
+        redundancy = np.maximum(redundancy, similarity[i])
+    return picked
+
+
+def _relevance(query, chunks):
+    if settings.RAG_CROSS_ENCODER_MODEL:
+        return cross_encoder(settings.RAG_CROSS_ENCODER_MODEL).predict([(query, c.text) for c in chunks])
+    if chunks[0].score is not None:
+        # lexical / hybrid: the rank score the chunks were ordered by, scaled to 0..1
+        top = max(float(c.score) for c in chunks) or 1.0
+        return [float(c.score) / top for c in chunks]
+    return [1.0 - float(c.distance) for c in chunks]
+
+
+def _vectors(chunks):
+    # chunks without a comparable vector (another embedding generation) get a zero row
+    dims = max((len(c.embedding) for c in chunks if c.embedding is not None), default=0)
+    vectors = np.zeros((len(chunks), dims), dtype=np.float32)
+    for row, c in enumerate(chunks):
+        if c.embedding is not None and len(c.embedding) == dims:
+            vectors[row] = c.embedding
+    return vectors
+
+
+def _rerank(query, chunks, k):
+    if len(chunks) <= 1:
+        return chunks
+    picked = mmr(_relevance(query, chunks), _vectors(chunks), k, settings.RAG_MMR_LAMBDA)
+    return [chunks[i] for i in picked]
+
+
+def rerank_search(query, q_emb, k, rerank=True, **search_kwargs):
+    """
+    search_chunks for answer generation.
+    - fetches RAG_MMR_CANDIDATES x k candidates with their stored vectors (no extra embedding calls)
+    - relevance: the cross-encoder if RAG_CROSS_ENCODER_MODEL is set, else the retrieval score
+    - keeps k of them by MMR, so near-duplicate chunks don't fill the prompt
+    """
+    if not rerank or settings.RAG_MMR_CANDIDATES <= 1:
+        return search_chunks(query, q_emb, k, **search_kwargs)
+
+    chunks = search_chunks(query, q_emb, k * settings.RAG_MMR_CANDIDATES, with_embeddings=True, **search_kwargs)
+    return _rerank(query, chunks, k)
+
+
+def rerank_search_batch(queries, k, rerank=True, **search_kwargs):
+    """rerank_search for search_chunks_batch: one chunk list per query."""
+    if not rerank or settings.RAG_MMR_CANDIDATES <= 1:
+        return search_chunks_batch(queries, k, **search_kwargs)
+
+    results = search_chunks_batch(queries, k * settings.RAG_MMR_CANDIDATES, with_embeddings=True, **search_kwargs)
+    return [_rerank(q["query"], chunks, k) for q, chunks in zip(queries, results)]
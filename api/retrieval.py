@@ -0,0 +1,418 @@
+import re
+
+import psycopg
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.functions import Cast
+from pgvector import Vector
+from pgvector.django import CosineDistance, VectorField
+from psycopg.sql import Literal
+
+from .embeddings import active_generation
+from .models import Chunk, Document
+
+MODES = ("vector", "lexical", "hybrid", "auto")
+
+# Only the columns the views need; loading every 1536-dim embedding is wasted work
+_CHUNK_FIELDS = ("id", "document_id", "chunk_index", "page", "text")
+
+# tokens that look like identifiers: hostnames, versions, policy numbers, snake_case...
+_IDENTIFIER_RE = re.compile(r"\d|[\w-]+\.[\w.-]+|_|\b[A-Z]{2,}\b")
+
+# plainto_tsquery ANDs every term; OR them so a question doesn't need every word to match
+_TSQUERY = "replace(plainto_tsquery('english', %(query)s)::text, ' & ', ' | ')::tsquery"
+
+
+def looks_like_keywords(query):
+    """Short, identifier-heavy queries (e.g. "db-prod-01.internal") go lexical-only in auto mode."""
+    words = query.split()
+    return 0 < len(words) <= 4 and not query.rstrip().endswith("?") and bool(_IDENTIFIER_RE.search(query))
+
+
+def resolve_mode(mode, query):
+    """Returns the concrete mode ("vector", "lexical" or "hybrid") for a request."""
+    mode = (mode or settings.RAG_RETRIEVAL_MODE).lower()
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if mode == "auto":
+        return "lexical" if looks_like_keywords(query) else "hybrid"
+    return mode
+
+
+def search_params(source):
+    """
+    Reads per-request "ef_search" (HNSW) / "probes" (IVFFlat) overrides from a request body
+    or query dict. Missing ones are None (settings default). Raises ValueError on bad values.
+    """
+    params = {}
+    for name, upper in (("ef_search", 1000), ("probes", settings.RAG_IVFFLAT_LISTS)):
+        value = source.get(name)
+        if value in (None, ""):
+            params[name] = None
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be an integer")
+        if not 1 <= value <= upper:
+            raise ValueError(f"{name} must be between 1 and {upper}")
+        params[name] = value
+    return params
+
+
+_pgvector_version = None
+
+
+def pgvector_version():
+    """Installed pgvector version as a tuple, e.g. (0, 8, 0). Looked up once per process."""
+    global _pgvector_version
+    if _pgvector_version is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            row = cursor.fetchone()
+        _pgvector_version = tuple(int(n) for n in re.findall(r"\d+", row[0])) if row else ()
+    return _pgvector_version
+
+
+def scoped_strategy(document_id):
+    """
+    Returns (strategy, document chunk count) for a vector search:
+    - "global": no document filter, plain index scan
+    - "exact": small document, its rows are scanned and sorted (an ANN scan would filter most hits away)
+    - "iterative": large document, index scan that continues until k rows pass the filter (pgvector 0.8+)
+    - "index": large document on older pgvector, index scan with a candidate list widened to match
+    """
+    if document_id is None:
+        return "global", None
+    count = Document.objects.filter(pk=document_id).values_list("chunk_count", flat=True).first() or 0
+    if count <= settings.RAG_SCOPED_EXACT_MAX_CHUNKS:
+        return "exact", count
+    if settings.RAG_ITERATIVE_SCAN != "off" and pgvector_version() >= (0, 8):
+        return "iterative", count
+    return "index", count
+
+
+def _table_size_estimate():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'api_chunk'::regclass")
+        return cursor.fetchone()[0]
+
+
+def _prepare_search(document_id, limit, ef_search=None, probes=None, scoped=None):
+    """
+    Sets up the current transaction for a vector search returning up to limit rows
+    (SET LOCAL only, so requests with different settings can share pooled connections):
+    - the index search effort, ef_search raised to limit since HNSW never returns more rows
+    - the document-scoped strategy from scoped_strategy (or scoped, if already looked up)
+    Returns the strategy name.
+    """
+    strategy, doc_chunks = scoped or scoped_strategy(document_id)
+    config = []
+
+    if strategy == "exact":
+        # ANN indexes can't be bitmap-scanned, so this leaves the document_id index + a sort
+        config.append(("enable_indexscan", "off"))
+    else:
+        # before pgvector 0.8 the filter applies after the scan: widen it by the document's share of rows
+        widen = 1
+        if strategy == "index":
+            widen = max(1, _table_size_estimate() // max(doc_chunks, 1))
+
+        if settings.RAG_VECTOR_INDEX == "ivfflat":
+            config.append(("ivfflat.probes", min((probes or settings.RAG_IVFFLAT_PROBES) * widen, settings.RAG_IVFFLAT_LISTS)))
+            if strategy == "iterative":
+                config.append(("ivfflat.iterative_scan", "relaxed_order"))  # the only order IVFFlat supports
+        else:
+            ef = max((ef_search or settings.RAG_HNSW_EF_SEARCH), limit * widen, limit)
+            config.append(("hnsw.ef_search", min(ef, 1000)))
+            if strategy == "iterative":
+                config.append(("hnsw.iterative_scan", settings.RAG_ITERATIVE_SCAN))
+
+    with connection.cursor() as cursor:
+        for name, value in config:
+            cursor.execute("SELECT set_config(%s, %s, true)", [name, str(value)])
+    return strategy
+
+
+def document_state(document_id):
+    """
+    (version, generation) for a question about document_id: the document's version (None if
+    there's no such document) and the (model, dimensions) its chunks were embedded with,
+    which the question has to be embedded with too. Unscoped questions use the active generation.
+    """
+    row = None
+    if document_id is not None:
+        row = Document.objects.filter(pk=document_id).values_list("version", "embedding_model", "embedding_dimensions").first()
+    if row is None:
+        return None, active_generation()
+    version, model, dimensions = row
+    return version, (model, dimensions) if model else active_generation()
+
+
+def vector_queryset(q_emb, generation=None):
+    """
+    Chunks of one embedding generation, annotated with .distance to q_emb.
+    The cast matches the expression the vector index is built on.
+    """
+    model, dims = generation or active_generation()
+    return (
+        Chunk.objects
+        .filter(embedding_model=model, embedding_dimensions=dims)
+        .exclude(embedding=None)
+        .annotate(distance=CosineDistance(Cast("embedding", VectorField(dimensions=dims)), q_emb))
+    )
+
+
+def _compact_order(dims):
+    """
+    ORDER BY expression matching the compact index of RAG_VECTOR_STORAGE
+    (it has to be the indexed expression for Postgres to use the index), or None for full vectors.
+    """
+    if settings.RAG_VECTOR_STORAGE == "halfvec":
+        return f"c.embedding::halfvec({dims}) <=> %(emb)s::halfvec({dims})"
+    if settings.RAG_VECTOR_STORAGE == "binary":
+        return f"binary_quantize(c.embedding)::bit({dims}) <~> binary_quantize(%(emb)s::vector)"
+    return None
+
+
+def _vector_candidates_sql(doc_filter, dims, compact):
+    """
+    SELECT id, dist of the %(candidates)s nearest chunks of the %(model)s / %(dims)s generation
+    by full-precision cosine distance. With a compact index, its %(prefetch)s nearest are
+    fetched first and re-ranked.
+    """
+    sql = f"""
+        SELECT c.id, c.embedding::vector({dims}) <=> %(emb)s::vector AS dist
+        FROM api_chunk c
+        WHERE c.embedding IS NOT NULL
+          AND c.embedding_model = %(model)s AND c.embedding_dimensions = %(dims)s {doc_filter}
+        ORDER BY {compact or "dist"}
+        LIMIT %(prefetch)s
+    """
+    if compact:
+        sql = f"SELECT id, dist FROM ({sql}) p ORDER BY dist LIMIT %(candidates)s"
+    return sql
+
+
+def _prepared_vector_sql(columns, model, dims, doc_filter, strategy):
+    """
+    The vector search query, the hot path, shaped for a prepared statement:
+    - the generation is inlined, so a cached plan can still use that generation's partial index
+      (and for large documents, so is the document: see search_chunks)
+    - the strategy is part of the text: a plan made with the index off ("exact") is a different
+      statement from one made for an index strategy, and is never reused for it
+    """
+    return f"""
+        /* {strategy} */
+        SELECT {columns},
+               c.embedding::vector({dims}) <=> %(emb)s::vector AS distance,
+               NULL::float8 AS score
+        FROM api_chunk c
+        WHERE c.embedding IS NOT NULL
+          AND c.embedding_model = {Literal(model).as_string()} AND c.embedding_dimensions = {int(dims)} {doc_filter}
+        ORDER BY distance
+        LIMIT %(k)s
+    """
+
+
+def _prepared_chunks(sql, params):
+    """
+    Chunks (plus .distance / .score) from a raw SELECT run on a server-side binding cursor.
+    Django's own cursors bind parameters client-side, which psycopg can't prepare; with
+    DATABASES OPTIONS["prepare_threshold"] set, this query becomes a prepared statement on
+    the pooled connection, so later searches skip parsing and (for global searches) planning.
+    """
+    connection.ensure_connection()
+    raw = psycopg.Cursor(connection.connection)
+    with (connection.make_debug_cursor(raw) if connection.queries_logged else connection.make_cursor(raw)) as cursor:
+        cursor.execute(sql, params)
+        names = [col.name for col in cursor.description]
+        rows = cursor.fetchall()
+
+    attnames = [f.attname for f in Chunk._meta.concrete_fields]
+    embedding = Chunk._meta.get_field("embedding")
+    chunks = []
+    for row in rows:
+        values = dict(zip(names, row))
+        if "embedding" in values:
+            values["embedding"] = embedding.from_db_value(values["embedding"], None, connection)
+        loaded = [name for name in attnames if name in values]
+        c = Chunk.from_db(connection.alias, loaded, [values[name] for name in loaded])
+        c.distance, c.score = values["distance"], values["score"]
+        chunks.append(c)
+    return chunks
+
+
+def search_chunks(query, q_emb, k, document_id=None, mode="vector", ef_search=None, probes=None, generation=None,
+                  with_embeddings=False):
+    """
+    Top-k chunks for a query, optionally scoped to one document.
+    - vector: cosine distance on the vector index (needs q_emb, embedded with generation,
+      default the active one; only chunks of that generation are compared)
+    - lexical: Postgres full-text rank on the GIN index (no embedding needed)
+    - hybrid: both candidate lists fused with reciprocal rank fusion, in one SQL round trip
+    - ef_search / probes: per-query index search effort (default RAG_HNSW_EF_SEARCH / RAG_IVFFLAT_PROBES)
+    - with_embeddings also loads each chunk's .embedding (for re-ranking)
+    Each chunk has .distance (None in lexical mode) and .score (None in vector mode).
+    """
+    model, dims = generation or active_generation()
+    compact = _compact_order(dims) if mode != "lexical" else None
+    scoped = None
+    if compact and document_id is not None:
+        scoped = scoped_strategy(document_id)
+        if scoped[0] == "exact":
+            # the document's rows are scanned and sorted anyway: rank them on the full vectors
+            compact = None
+    fields = _CHUNK_FIELDS + ("embedding",) if with_embeddings else _CHUNK_FIELDS
+    columns = ", ".join(f"c.{f}" for f in fields)
+
+    doc_filter = "AND c.document_id = %(document_id)s" if document_id is not None else ""
+
+    if mode == "vector" and not compact:
+        with transaction.atomic():
+            strategy = _prepare_search(document_id, k, ef_search, probes, scoped)
+            if strategy in ("index", "iterative"):
+                # inlined too: once prepared, a generic plan can't prove a bound document_id
+                # matches the document's partial index (scoped_indexes), so it would skip it
+                doc_filter = f"AND c.document_id = {int(document_id)}"
+            sql = _prepared_vector_sql(columns, model, dims, doc_filter, strategy)
+            params = {"emb": Vector(q_emb).to_text(), "document_id": document_id, "k": k}
+            chunks = _prepared_chunks(sql, params)
+        if strategy == "iterative":
+            chunks.sort(key=lambda c: c.distance)  # relaxed_order can return near-ties out of order
+        return chunks
+
+    params = {"query": query, "k": k, "document_id": document_id}
+
+    if mode == "lexical":
+        sql = f"""
+            SELECT {columns},
+                   NULL::float8 AS distance,
+                   ts_rank_cd(c.search_vector, q.tsq) AS score
+            FROM api_chunk c, (SELECT {_TSQUERY} AS tsq) q
+            WHERE c.search_vector @@ q.tsq {doc_filter}
+            ORDER BY score DESC
+            LIMIT %(k)s
+        """
+        return list(Chunk.objects.raw(sql, params))
+
+    candidates = k if mode == "vector" else max(k * settings.RAG_HYBRID_CANDIDATES, k)
+    params.update({
+        "emb": Vector(q_emb).to_text(),
+        "model": model,
+        "dims": dims,
+        "candidates": candidates,
+        "prefetch": candidates * settings.RAG_RERANK_CANDIDATES if compact else candidates,
+        "rrf_k": settings.RAG_RRF_K,
+    })
+
+    if mode == "vector":
+        # compact index: candidates from it, re-ranked on the full vectors
+        sql = f"""
+            SELECT {columns},
+                   v.dist AS distance,
+                   NULL::float8 AS score
+            FROM ({_vector_candidates_sql(doc_filter, dims, compact)}) v
+            JOIN api_chunk c ON c.id = v.id
+            ORDER BY v.dist
+        """
+    else:
+        sql = f"""
+            WITH q AS (
+                SELECT {_TSQUERY} AS tsq
+            ),
+            vec AS (
+                SELECT id, row_number() OVER (ORDER BY dist) AS rank
+                FROM ({_vector_candidates_sql(doc_filter, dims, compact)}) v
+            ),
+            lex AS (
+                SELECT id, row_number() OVER (ORDER BY r DESC) AS rank
+                FROM (
+                    SELECT c.id, ts_rank_cd(c.search_vector, q.tsq) AS r
+                    FROM api_chunk c, q
+                    WHERE c.search_vector @@ q.tsq {doc_filter}
+                    ORDER BY r DESC
+                    LIMIT %(candidates)s
+                ) l
+            ),
+            fused AS (
+                SELECT id, SUM(1.0 / (%(rrf_k)s + rank)) AS score
+                FROM (SELECT id, rank FROM vec UNION ALL SELECT id, rank FROM lex) u
+                GROUP BY id
+            )
+            SELECT {columns},
+                   -- lexical matches from another embedding generation have no comparable distance
+                   CASE WHEN c.embedding_model = %(model)s AND c.embedding_dimensions = %(dims)s
+                        THEN c.embedding::vector({dims}) <=> %(emb)s::vector END AS distance,
+                   f.score
+            FROM fused f
+            JOIN api_chunk c ON c.id = f.id
+            ORDER BY f.score DESC
+            LIMIT %(k)s
+        """
+    with transaction.atomic():
+        _prepare_search(document_id, params["prefetch"], ef_search, probes, scoped)
+        return list(Chunk.objects.raw(sql, params))
+
+
+def search_chunks_batch(queries, k, ef_search=None, probes=None, with_embeddings=False):
+    """
+    search_chunks for many questions. queries are search_chunks keyword dicts
+    (query, q_emb, document_id, mode, generation); returns one chunk list per query, in order.
+    - vector-mode questions about small documents (the "exact" strategy, so no index is
+      involved) share one LATERAL join per embedding generation: a single round trip for all
+    - the rest (large or no document, lexical/hybrid) run search_chunks each
+    """
+    results = [None] * len(queries)
+    doc_ids = {q.get("document_id") for q in queries} - {None}
+    counts = dict(Document.objects.filter(pk__in=doc_ids).values_list("id", "chunk_count"))
+
+    groups = {}  # generation -> [query positions]
+    for i, q in enumerate(queries):
+        generation = q.get("generation") or active_generation()
+        count = counts.get(q.get("document_id"))
+        small = count is not None and count <= settings.RAG_SCOPED_EXACT_MAX_CHUNKS
+        if q.get("mode", "vector") == "vector" and small:
+            groups.setdefault(tuple(generation), []).append(i)
+        else:
+            results[i] = search_chunks(k=k, ef_search=ef_search, probes=probes, with_embeddings=with_embeddings, **q)
+
+    fields = _CHUNK_FIELDS + ("embedding",) if with_embeddings else _CHUNK_FIELDS
+    columns = ", ".join(f"c.{f}" for f in fields)
+    for (model, dims), positions in groups.items():
+        sql = f"""
+            SELECT q.ord, {columns}, c.dist AS distance, NULL::float8 AS score
+            FROM unnest(%(ords)s::int[], %(docs)s::bigint[], %(embs)s::vector[]) AS q(ord, document_id, emb)
+            CROSS JOIN LATERAL (
+                SELECT {columns}, c.embedding::vector({dims}) <=> q.emb AS dist
+                FROM api_chunk c
+                WHERE c.document_id = q.document_id AND c.embedding IS NOT NULL
+                  AND c.embedding_model = %(model)s AND c.embedding_dimensions = %(dims)s
+                ORDER BY dist
+                LIMIT %(k)s
+            ) c
+            ORDER BY q.ord, c.dist
+        """
+        params = {
+            "ords": positions,
+            "docs": [queries[i]["document_id"] for i in positions],
+            "embs": [Vector(queries[i]["q_emb"]).to_text() for i in positions],
+            "model": model,
+            "dims": dims,
+            "k": k,
+        }
+        for i in positions:
+            results[i] = []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # same plan as the "exact" strategy: document_id index + sort
+                cursor.execute("SELECT set_config('enable_indexscan', 'off', true)")
+            for c in Chunk.objects.raw(sql, params):
+                results[c.ord].append(c)
+
+    return results
+
+
+def min_distance(chunks):
+    distances = [c.distance for c in chunks if c.distance is not None]
+    return float(min(distances)) if distances else None
@@ -1,5 +1,43 @@
-from django.test import TestCase
-from .views import chunk_text  
+import asyncio
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+import openai
+from psycopg_pool import PoolTimeout
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .views import _answer_input, chunk_text  
+from .ingest import apply_chunks, cache_embeddings, chunk_pages, ingest_chunks, plan_chunks, reembed_document, store_chunks, text_hash
+from .chunker import ApproxTokenizer, CharTokenizer, iter_chunks
+from . import async_views, chunker, pdf
+from .pdf import iter_pdf_pages, open_pdf
+from .query_cache import QueryEmbeddingCache
+from .query_log import QueryLogWriter, query_logs, shutdown
+from .rerank import mmr, rerank_search
+from .context import build_context, count_tokens
+from .embeddings import HashEmbeddings, LocalEmbeddings, OpenAIEmbeddings, embedding_kwargs, provider_for
+from .retrieval import document_state, looks_like_keywords, pgvector_version, resolve_mode, search_chunks, search_chunks_batch, search_params
+from .management.commands.scoped_indexes import partial_index_sql
+from .jobs import claim_next_job, enqueue_upload, run_job
+from .llm import Gateway, GatewayBusy, TokenBucket
+from .metrics import CACHE_LOOKUPS, STAGE_SECONDS, Stages
+from .answer_cache import flush_hits, lookup_answer, store_answer
+from .models import AnswerCache, Chunk, Document, IngestJob, QueryLog
 
 class ChunkTextTests(TestCase):
     
@@ -30,4 +68,1442 @@ class ChunkTextTests(TestCase):
         
         self.assertEqual(len(chunks), 2)
         self.assertEqual(chunks[0], "This is the first part.")
-        self.assertEqual(chunks[1], "part. And this is the second part.")
\ No newline at end of file
+        self.assertEqual(chunks[1], "part. And this is the second part.")
+
+
+class ChunkerTests(TestCase):
+    text = "First sentence here. Second one follows!\n\nA new paragraph starts. It ends?  Done."
+
+    def test_streamed_pieces_match_whole_text(self):
+        """Pieces cut mid-word and mid-separator give the same chunks and offsets as the whole text."""
+        whole = list(iter_chunks([self.text], 40, 10, CharTokenizer()))
+        pieces = [self.text[i:i + 7] for i in range(0, len(self.text), 7)]
+
+        self.assertEqual(list(iter_chunks(iter(pieces), 40, 10, CharTokenizer())), whole)
+        self.assertEqual([c for c, _, _ in whole], chunk_text(self.text, max_chars=40, overlap=10))
+
+    def test_offsets_point_into_the_source(self):
+        """Each chunk's start/end span its text in the original string."""
+        for chunk, start, end in iter_chunks([self.text], 40, 0, CharTokenizer()):
+            self.assertEqual(" ".join(self.text[start:end].split()), chunk)
+
+    def test_offsets_survive_overlap(self):
+        """With overlap, offsets stay exact even when a tail starts inside the previous chunk's tail."""
+        text = "Aa bb.\n\nCc dd.   Ee ff!\n\n\nGg hh? Ii jj.\n\nKk ll.  Mm nn." * 3
+        for max_size, overlap in ((20, 15), (30, 25), (40, 10)):
+            chunks = list(iter_chunks([text], max_size, overlap, CharTokenizer()))
+            self.assertGreater(len(chunks), 3)
+            for chunk, start, end in chunks:
+                self.assertEqual(" ".join(text[start:end].split()), chunk, (max_size, overlap))
+
+    def test_text_without_separators_is_scanned_once(self):
+        """A long run without separators, fed in small pieces, is searched piece by piece, not re-split each time."""
+        text = "x" * 200_000 + ". End."
+        scanned = []
+        real = chunker._SPLIT_RE
+        split_re = mock.Mock()
+        split_re.search.side_effect = lambda s, pos=0: scanned.append(len(s) - pos) or real.search(s, pos)
+        split_re.split.side_effect = lambda s: scanned.append(len(s)) or real.split(s)
+
+        with mock.patch("api.chunker._SPLIT_RE", split_re):
+            chunks = list(iter_chunks((text[i:i + 100] for i in range(0, len(text), 100)), 900, 0, CharTokenizer()))
+
+        self.assertEqual(chunks, list(iter_chunks([text], 900, 0, CharTokenizer())))
+        self.assertLess(sum(scanned), 3 * len(text))
+
+    def test_token_sizes(self):
+        """With a token tokenizer the chunk size is counted in tokens, not characters."""
+        tokenizer = ApproxTokenizer()
+        chunks = [c for c, _, _ in iter_chunks([self.text], 6, 0, tokenizer)]
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(tokenizer.count(c) <= 6 for c in chunks))
+        self.assertEqual(" ".join(chunks), " ".join(self.text.split()))
+
+    def test_bench_chunker_reports_identical_chunks(self):
+        """The microbenchmark compares against the previous chunk_text and prints JSON."""
+        out = StringIO()
+        call_command("bench_chunker", sizes="5000", repeat=1, stdout=out, stderr=StringIO())
+
+        result = json.loads(out.getvalue())["results"][0]
+        self.assertTrue(result["identical"])
+        self.assertGreater(result["chunks"], 1)
+
+
+class StoreChunksTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Doc", source="ingested_text")
+        self.emb = [0.1] * 1536
+
+    def test_writes_all_chunks_in_batches(self):
+        """Every chunk should be written even when the batch size doesn't divide evenly."""
+        parts = [f"chunk {i}" for i in range(7)]
+
+        stats = store_chunks(self.doc, parts, [self.emb] * 7, batch_size=3)
+
+        self.assertEqual(stats["rows"], 7)
+        self.assertEqual(
+            list(Chunk.objects.filter(document=self.doc).order_by("chunk_index").values_list("text", flat=True)),
+            parts,
+        )
+
+    def test_replace_wipes_old_chunks(self):
+        """Re-ingesting with replace=True should leave only the new chunks."""
+        store_chunks(self.doc, ["old a", "old b", "old c"], [self.emb] * 3)
+        store_chunks(self.doc, ["new a"], [self.emb], replace=True)
+
+        self.assertEqual(
+            list(Chunk.objects.filter(document=self.doc).values_list("text", flat=True)),
+            ["new a"],
+        )
+
+
+
+class IngestJobTests(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        override = override_settings(RAG_JOB_UPLOAD_DIR=tmp.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_queued_job_runs_all_stages(self):
+        """A claimed job should chunk, embed and store the upload, then clean up the spooled file."""
+        upload = SimpleUploadedFile("notes.txt", b"First sentence. Second sentence.")
+        job = enqueue_upload(upload, "Notes", "text_file")
+        self.assertEqual(job.status, IngestJob.STATUS_QUEUED)
+
+        claimed = claim_next_job("test-worker")
+        self.assertEqual(claimed.id, job.id)
+        self.assertIsNone(claim_next_job("test-worker"))
+
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            run_job(claimed)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.STATUS_DONE)
+        self.assertEqual(set(job.progress), {"extract", "chunk", "embed", "store"})
+        self.assertEqual(job.result["chunks_created"], Chunk.objects.filter(document=job.document).count())
+        self.assertFalse(os.path.exists(job.upload_path))
+
+    def test_empty_upload_marks_job_failed(self):
+        """Errors are recorded on the job instead of crashing the worker."""
+        enqueue_upload(SimpleUploadedFile("empty.txt", b"   "), "Empty", "text_file")
+
+        job = run_job(claim_next_job("test-worker"))
+
+        self.assertEqual(job.status, IngestJob.STATUS_FAILED)
+        self.assertIn("No text", job.error)
+
+    def test_stale_running_job_is_claimed_again(self):
+        """A job whose worker stopped heartbeating should be requeued, then failed after max attempts."""
+        job = enqueue_upload(SimpleUploadedFile("notes.txt", b"Some text."), "Notes", "text_file")
+        stale = timezone.now() - timedelta(seconds=settings.RAG_JOB_LEASE_SECONDS + 1)
+
+        for attempt in range(1, settings.RAG_JOB_MAX_ATTEMPTS + 1):
+            claimed = claim_next_job(f"worker-{attempt}")
+            self.assertEqual((claimed.id, claimed.attempts), (job.id, attempt))
+            IngestJob.objects.filter(pk=job.pk).update(heartbeat_at=stale)
+
+        self.assertIsNone(claim_next_job("worker-last"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.STATUS_FAILED)
+        self.assertIn("stopped responding", job.error)
+        self.assertFalse(os.path.exists(job.upload_path))
+
+    def test_database_errors_leave_the_job_for_a_retry(self):
+        """A dropped database connection isn't the upload's fault: the job stays running with its upload."""
+        enqueue_upload(SimpleUploadedFile("notes.txt", b"Some text."), "Notes", "text_file")
+        job = claim_next_job("worker-1")
+
+        with mock.patch("api.jobs.ingest_chunks", side_effect=OperationalError("server closed the connection")):
+            with self.assertRaises(OperationalError):
+                run_job(job)
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed), \
+                mock.patch.object(IngestJob, "save", side_effect=OperationalError("server closed the connection")):
+            with self.assertRaises(OperationalError):
+                run_job(job)
+
+        self.assertTrue(os.path.exists(job.upload_path))
+        IngestJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        retried = claim_next_job("worker-2")
+        self.assertEqual(retried.status, IngestJob.STATUS_RUNNING)
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            self.assertEqual(run_job(retried).status, IngestJob.STATUS_DONE)
+        self.assertFalse(os.path.exists(job.upload_path))
+
+    def test_fresh_running_job_is_not_requeued(self):
+        """A job with a recent heartbeat belongs to its worker."""
+        enqueue_upload(SimpleUploadedFile("notes.txt", b"Some text."), "Notes", "text_file")
+        claim_next_job("worker-1")
+
+        self.assertIsNone(claim_next_job("worker-2"))
+
+    def test_plan_made_before_another_ingest_is_redone(self):
+        """Applying a plan after another write to the document should diff against the rows it left."""
+        doc = Document.objects.create(title="Racy", source="text")
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            ingest_chunks(doc, ["Alpha.", "Beta."])
+            plan = plan_chunks(doc, ["Beta.", "Gamma."])
+            fresh = dict(zip(plan["missing"], fake_embed(list(plan["missing"].values()))))
+            ingest_chunks(doc, ["Gamma.", "Delta.", "Alpha."])
+
+            apply_chunks(doc, plan, fresh)
+
+        self.assertEqual(
+            list(Chunk.objects.filter(document=doc).order_by("chunk_index").values_list("text", flat=True)),
+            ["Beta.", "Gamma."],
+        )
+
+    def test_worker_survives_database_errors(self):
+        """A failed claim should be logged and retried instead of stopping the worker."""
+        err = StringIO()
+        with mock.patch("api.management.commands.ingest_worker.claim_next_job", side_effect=[OperationalError("gone"), None]) as claim, \
+                mock.patch("api.management.commands.ingest_worker.close_old_connections") as close:
+            call_command("ingest_worker", "--once", "--poll", "0", stdout=StringIO(), stderr=err)
+
+        self.assertEqual(claim.call_count, 2)
+        self.assertEqual(close.call_count, 2)
+        self.assertIn("claiming a job failed", err.getvalue())
+
+
+
+class PdfPagesTests(TestCase):
+
+    pdf_path = str(Path(__file__).resolve().parent.parent / "sample_docs" / "RAG_MVP_Demo_PDF.pdf")
+
+    def test_chunk_pages_matches_chunk_text(self):
+        """Streaming pages through the chunker should give the same chunks as joining them first."""
+        pages = [(1, "Alpha one. Alpha two."), (2, "Beta one. Beta two."), (3, "Gamma one.")]
+
+        chunked = list(chunk_pages(iter(pages), max_chars=25, overlap=0))
+
+        self.assertEqual(
+            [c for c, _ in chunked],
+            chunk_text("\n".join(text for _, text in pages), max_chars=25, overlap=0),
+        )
+        self.assertEqual([page for _, page in chunked], [1, 2, 3])
+
+    @override_settings(RAG_PDF_PARALLEL_MIN_PAGES=1)
+    def test_parallel_extraction_keeps_page_order(self):
+        """The process pool path should yield the same pages, in order, as serial extraction."""
+        serial = list(iter_pdf_pages(self.pdf_path, workers=1))
+        parallel = list(iter_pdf_pages(self.pdf_path, workers=2, pages_per_task=1, max_inflight=1))
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual([n for n, _ in serial], list(range(1, len(serial) + 1)))
+
+    @override_settings(RAG_PDF_PARALLEL_MIN_PAGES=1)
+    def test_uploads_share_one_pool_that_doesnt_fork(self):
+        """Every extraction reuses one lazily started pool, whose processes aren't forked from the server."""
+        list(iter_pdf_pages(self.pdf_path, workers=2, pages_per_task=1))
+        pool = pdf._executor()
+        list(iter_pdf_pages(self.pdf_path, workers=2, pages_per_task=1))
+
+        self.assertIs(pdf._executor(), pool)
+        self.assertNotEqual(pool._mp_context.get_start_method(), "fork")
+
+    def test_small_pdfs_stay_in_process(self):
+        """Below RAG_PDF_PARALLEL_MIN_PAGES no pool task is submitted."""
+        with mock.patch("api.pdf._executor") as executor:
+            pages = list(iter_pdf_pages(self.pdf_path, workers=4))
+
+        self.assertTrue(pages)
+        executor.assert_not_called()
+
+class UploadStreamingTests(TestCase):
+
+    text = "Café déjà vu. Ünïcode splits across blocks!\n\nA second paragraph follows."
+
+    @override_settings(RAG_UPLOAD_READ_BYTES=5)
+    def test_text_upload_is_chunked_block_by_block(self):
+        """Multi-byte characters split between read blocks decode the same as the whole file."""
+        upload = SimpleUploadedFile("notes.txt", self.text.encode("utf-8"))
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            res = self.client.post("/api/ingest_file/", {"file": upload})
+
+        self.assertEqual(res.status_code, 200)
+        stored = Chunk.objects.filter(document_id=res.json()["document_id"]).order_by("chunk_index")
+        self.assertEqual([c.text for c in stored], chunk_text(self.text))
+
+    @override_settings(RAG_MAX_UPLOAD_BYTES=100)
+    def test_oversized_upload_is_rejected(self):
+        """Bodies over RAG_MAX_UPLOAD_BYTES get a 413 before anything is ingested."""
+        upload = SimpleUploadedFile("big.txt", b"x. " * 100)
+        res = self.client.post("/api/ingest_file/", {"file": upload})
+
+        self.assertEqual(res.status_code, 413)
+        self.assertFalse(Document.objects.exists())
+
+    @override_settings(RAG_MAX_UPLOAD_BYTES=100)
+    def test_chunked_upload_is_cut_off(self):
+        """Under ASGI a body without Content-Length is counted as it arrives and stopped with a 413."""
+        from config.asgi import application
+
+        scope = {
+            "type": "http", "method": "POST", "path": "/api/async/ingest_file/", "query_string": b"",
+            "headers": [(b"content-type", b"multipart/form-data; boundary=x"), (b"transfer-encoding", b"chunked")],
+        }
+        body = iter([{"type": "http.request", "body": b"x" * 60, "more_body": True}] * 10)
+        read, sent = [], []
+
+        async def receive():
+            read.append(next(body))
+            return read[-1]
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(application(scope, receive, send))
+
+        self.assertEqual(sent[0]["status"], 413)
+        self.assertEqual(json.loads(sent[1]["body"])["max_bytes"], 100)
+        self.assertEqual(len(read), 2)
+        self.assertFalse(Document.objects.exists())
+
+    def test_pdf_is_memory_mapped(self):
+        """The PDF parser reads from a memory map of the file, not an in-memory copy."""
+        with open_pdf(PdfPagesTests.pdf_path) as reader:
+            self.assertIsInstance(reader.stream, mmap.mmap)
+            self.assertGreater(len(reader.pages), 0)
+
+
+
+def fake_embed(texts, on_batch=None, generation=None):
+    if on_batch:
+        on_batch(len(texts), len(texts))
+    dims = generation[1] if generation else 1536
+    return [[0.1] * dims for _ in texts]
+
+
+def ingested_doc(*texts, title="Doc"):
+    """A Document with texts ingested through fake_embed."""
+    doc = Document.objects.create(title=title, source="ingested_text")
+    with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+        ingest_chunks(doc, list(texts))
+    return doc
+
+
+def patch_all(test, *patchers):
+    """Starts mock.patch patchers for the rest of a test; returns their mocks in order."""
+    mocks = [p.start() for p in patchers]
+    for p in patchers:
+        test.addCleanup(p.stop)
+    return mocks
+
+
+def patch_views(test):
+    """Patches the sync views' question embedding and OpenAI client; returns the client mock."""
+    _, client_mock = patch_all(
+        test,
+        mock.patch("api.views.embed_query", return_value=[0.1] * 1536),
+        mock.patch("api.views.client"),
+    )
+    return client_mock
+
+
+class IngestChunksTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Doc", source="ingested_text")
+        patcher = mock.patch("api.ingest.embed_texts", side_effect=fake_embed)
+        self.embed = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reingest_only_embeds_changed_chunks(self):
+        """Unchanged chunks keep their rows; only new text goes to the embeddings API."""
+        ingest_chunks(self.doc, ["a", "b", "c"])
+        old_ids = dict(Chunk.objects.filter(document=self.doc).values_list("text", "id"))
+        self.embed.reset_mock()
+
+        stats = ingest_chunks(self.doc, ["new", "a", "c", "d"])
+
+        self.embed.assert_called_once()
+        self.assertEqual(self.embed.call_args.args[0], ["new", "d"])
+        self.assertEqual(stats["chunks_reused"], 2)
+        self.assertEqual(stats["chunks_deleted"], 1)
+
+        rows = list(Chunk.objects.filter(document=self.doc).order_by("chunk_index").values_list("chunk_index", "text", "id"))
+        self.assertEqual([(i, t) for i, t, _ in rows], [(0, "new"), (1, "a"), (2, "c"), (3, "d")])
+        self.assertEqual(rows[1][2], old_ids["a"])
+        self.assertEqual(rows[2][2], old_ids["c"])
+
+    def test_cached_embeddings_are_reused_across_documents(self):
+        """Text embedded for one document shouldn't be embedded again for another."""
+        ingest_chunks(self.doc, ["shared text"])
+        other = Document.objects.create(title="Other", source="ingested_text")
+        self.embed.reset_mock()
+
+        stats = ingest_chunks(other, ["shared text"])
+
+        self.embed.assert_not_called()
+        self.assertEqual(stats["embedding_cache_hits"], 1)
+
+
+
+class QueryEmbeddingCacheTests(TestCase):
+
+    def test_normalized_questions_share_an_entry(self):
+        """Case and whitespace differences should hit the same cached vector."""
+        cache = QueryEmbeddingCache(maxsize=10, ttl=60)
+        cache.set(cache.key("What is RAG?"), [0.5, 0.25])
+
+        self.assertEqual(cache.get(cache.key("  what   is rag? ")), [0.5, 0.25])
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_lru_eviction_and_ttl(self):
+        """Oldest entries are evicted past maxsize, and expired ones count as misses."""
+        cache = QueryEmbeddingCache(maxsize=2, ttl=60)
+        for q in ["a", "b", "c"]:
+            cache.set(cache.key(q), [1.0])
+        self.assertIsNone(cache.get(cache.key("a")))
+
+        expired = QueryEmbeddingCache(maxsize=2, ttl=-1)
+        expired.set(expired.key("a"), [1.0])
+        self.assertIsNone(expired.get(expired.key("a")))
+        self.assertEqual(expired.stats()["misses"], 1)
+
+    def test_shared_backend_fills_local_cache(self):
+        """A hit in the shared Django cache is copied into the local LRU."""
+        writer = QueryEmbeddingCache(maxsize=10, ttl=60, shared_alias="default")
+        reader = QueryEmbeddingCache(maxsize=10, ttl=60, shared_alias="default")
+        writer.set(writer.key("shared question"), [0.5])
+
+        self.assertEqual(reader.get(reader.key("shared question")), [0.5])
+        self.assertEqual(reader.get(reader.key("shared question")), [0.5])
+        self.assertEqual((reader.stats()["shared_hits"], reader.stats()["hits"]), (1, 1))
+
+
+
+class AnswerCacheTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("Passwords must be 12 characters.")
+        self.client_mock = patch_views(self)
+        self.client_mock.responses.create.return_value.output_text = "12 characters."
+
+    def ask(self, question, **extra):
+        return self.client.post(
+            "/api/ask/",
+            {"question": question, "document_id": self.doc.id, **extra},
+            content_type="application/json",
+        ).json()
+
+    def test_repeat_question_skips_generation(self):
+        """A near-identical question on the same document should reuse the stored answer."""
+        first = self.ask("How long should passwords be?")
+        second = self.ask("how long should passwords be")
+
+        self.assertFalse(first["cached"])
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["answer"], "12 characters.")
+        self.assertEqual(self.client_mock.responses.create.call_count, 1)
+        self.assertTrue(QueryLog.objects.order_by("-id").first().cached)
+
+    def test_reingest_invalidates_cached_answers(self):
+        """Changing the document's chunks should drop its cached answers."""
+        self.ask("How long should passwords be?")
+        self.assertEqual(AnswerCache.objects.count(), 1)
+
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            ingest_chunks(self.doc, ["Passwords must be 16 characters."])
+
+        self.assertEqual(AnswerCache.objects.count(), 0)
+        self.assertFalse(self.ask("How long should passwords be?")["cached"])
+
+    def test_mode_and_rerank_are_part_of_the_key(self):
+        """Answers retrieved another way shouldn't be reused."""
+        self.ask("How long should passwords be?")
+
+        self.assertFalse(self.ask("How long should passwords be?", rerank=False)["cached"])
+        self.assertFalse(self.ask("How long should passwords be?", mode="hybrid")["cached"])
+        self.assertTrue(self.ask("How long should passwords be?", mode="hybrid")["cached"])
+        self.assertEqual(AnswerCache.objects.count(), 3)
+
+    @override_settings(RAG_ANSWER_CACHE_MAX_ENTRIES=2)
+    def test_entries_are_capped_and_expire(self):
+        """Each key keeps its newest entries, and entries older than the TTL are neither used nor kept."""
+        for i in range(3):
+            store_answer(self.doc.id, 1, f"q{i}", unit_vector(i), 5, "vector", True, 0.1, f"a{i}", [])
+        self.assertEqual(list(AnswerCache.objects.order_by("id").values_list("answer", flat=True)), ["a1", "a2"])
+
+        AnswerCache.objects.filter(answer="a1").update(created_at=timezone.now() - timedelta(days=30))
+        self.assertIsNone(lookup_answer(self.doc.id, 1, unit_vector(1), 5, "vector", True, 1.0))
+        store_answer(self.doc.id, 1, "q3", unit_vector(3), 5, "vector", True, 0.1, "a3", [])
+        self.assertEqual(list(AnswerCache.objects.order_by("id").values_list("answer", flat=True)), ["a2", "a3"])
+
+    @override_settings(RAG_ANSWER_CACHE_HIT_BATCH=2, RAG_ANSWER_CACHE_HIT_FLUSH_SECONDS=3600)
+    def test_hits_are_written_in_batches(self):
+        """Cache hits are counted in memory and written every RAG_ANSWER_CACHE_HIT_BATCH hits."""
+        flush_hits()
+        self.ask("How long should passwords be?")
+        entry = AnswerCache.objects.get()
+
+        self.assertTrue(self.ask("How long should passwords be?")["cached"])
+        entry.refresh_from_db()
+        self.assertEqual(entry.hits, 0)
+
+        self.assertTrue(self.ask("How long should passwords be?")["cached"])
+        entry.refresh_from_db()
+        self.assertEqual(entry.hits, 2)
+
+    def test_failed_cache_write_still_answers(self):
+        """The answer is already generated, so a failed cache write is logged and the answer returned."""
+        with mock.patch("api.answer_cache.AnswerCache.objects.create", side_effect=OperationalError("disk full")), \
+                self.assertLogs("api.answer_cache", "ERROR"):
+            data = self.ask("How long should passwords be?")
+
+        self.assertEqual(data["answer"], "12 characters.")
+        self.assertFalse(AnswerCache.objects.exists())
+
+
+class AskStreamTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("MFA is required for admins.")
+        self.client_mock = patch_views(self)
+
+    def test_streams_sources_then_tokens_then_done(self):
+        """Events arrive in order and the QueryLog row gets the full answer."""
+        self.client_mock.responses.create.return_value = [
+            mock.Mock(type="response.output_text.delta", delta="For "),
+            mock.Mock(type="response.output_text.delta", delta="admins."),
+            mock.Mock(type="response.completed"),
+        ]
+
+        resp = self.client.post(
+            "/api/ask/stream/",
+            {"question": "Who needs MFA?", "document_id": self.doc.id},
+            content_type="application/json",
+        )
+        body = b"".join(resp.streaming_content).decode("utf-8")
+
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        events = [block.split("\n")[0] for block in body.strip().split("\n\n")]
+        self.assertEqual(events, ["event: sources", "event: token", "event: token", "event: done"])
+        self.assertEqual(QueryLog.objects.get().answer, "For admins.")
+
+
+
+class AsyncAskTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("PTO should be requested two weeks ahead.")
+        _, self.client_mock = patch_all(
+            self,
+            mock.patch("api.async_views.aembed_query", new=mock.AsyncMock(return_value=[0.1] * 1536)),
+            mock.patch("api.async_views.async_client"),
+        )
+        self.client_mock.responses.create = mock.AsyncMock(return_value=mock.Mock(output_text="Two weeks."))
+
+    async def test_async_ask_answers_and_logs(self):
+        """The ASGI ask path should answer from the same sources and write the QueryLog row."""
+        resp = await self.async_client.post(
+            "/api/async/ask/",
+            {"question": "When should PTO be requested?", "document_id": self.doc.id},
+            content_type="application/json",
+        )
+
+        data = resp.json()
+        self.assertEqual(data["answer"], "Two weeks.")
+        self.assertEqual(data["sources"][0]["text"], "PTO should be requested two weeks ahead.")
+        log = await QueryLog.objects.aget()
+        self.assertEqual(log.answer, "Two weeks.")
+
+    async def test_async_upload_is_parsed_off_the_event_loop(self):
+        """request.FILES (multipart parsing, spooling) is read in a worker thread, not the event loop."""
+        real = async_views._chunk_text_upload
+        on_loop = []
+
+        def chunk_text_upload(request, stages):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return real(request, stages)
+
+        with mock.patch("api.async_views._chunk_text_upload", side_effect=chunk_text_upload), \
+                mock.patch("api.async_views.aingest_chunks", new=mock.AsyncMock(return_value={"chunks_created": 1})):
+            resp = await self.async_client.post(
+                "/api/async/ingest_file/", {"file": SimpleUploadedFile("notes.txt", b"Badges are renewed yearly.")},
+            )
+            missing = await self.async_client.post("/api/async/ingest_file/", {"title": "No file"})
+
+        self.assertEqual(resp.json()["title"], "notes.txt")
+        self.assertEqual(missing.status_code, 400)
+        self.assertEqual(on_loop, [False, False])
+
+
+
+def unit_vector(i, dims=1536):
+    v = [0.0] * dims
+    v[i] = 1.0
+    return v
+
+
+class QueryLogWriterTests(TransactionTestCase):
+    """Outside a transaction, so rows go through the buffer and the background thread."""
+
+    def writer(self, **kwargs):
+        writer = QueryLogWriter(**kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def wait_for_rows(self, n, timeout=5):
+        deadline = time.monotonic() + timeout
+        while QueryLog.objects.count() < n and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return QueryLog.objects.count()
+
+    def test_flushes_full_batches_in_the_background(self):
+        """A full batch should be written by the thread with one INSERT, a partial one should wait."""
+        writer = self.writer(batch_size=3, flush_seconds=60)
+        writer.submit(*[QueryLog(question=f"q{i}") for i in range(3)])
+        self.assertEqual(self.wait_for_rows(3), 3)
+
+        writer.submit(QueryLog(question="q3"))
+        time.sleep(0.1)
+        self.assertEqual(QueryLog.objects.count(), 3)
+        self.assertEqual(writer.pending(), 1)
+
+    def test_flushes_after_the_interval(self):
+        """A lone row should be written within flush_seconds."""
+        writer = self.writer(batch_size=100, flush_seconds=0.2)
+        writer.submit(QueryLog(question="q"))
+        self.assertEqual(self.wait_for_rows(1, timeout=2), 1)
+
+    def test_close_writes_pending_rows(self):
+        """Shutdown should write whatever is still buffered, and later rows right away."""
+        writer = self.writer(batch_size=100, flush_seconds=60)
+        writer.submit(QueryLog(question="before"))
+        writer.close()
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+        writer.submit(QueryLog(question="after"))
+        self.assertEqual(QueryLog.objects.count(), 2)
+
+    def test_shutdown_skips_hits_without_a_database(self):
+        """At exit, counted hits are dropped with a warning (no traceback) when the database is gone."""
+        with mock.patch("api.query_log.query_logs"), \
+                mock.patch("api.query_log.pending_hits", return_value=3), \
+                mock.patch("api.query_log.flush_hits") as flush, \
+                mock.patch.object(connection, "ensure_connection", side_effect=OperationalError("no such database")), \
+                self.assertLogs("api.query_log", "WARNING") as logs:
+            shutdown()
+
+        flush.assert_not_called()
+        self.assertIn("dropped 3 answer cache hits", logs.output[0])
+
+    def test_logs_endpoint_sees_buffered_rows(self):
+        """/api/logs/ should list a question asked a moment ago by this process."""
+        query_logs.submit(QueryLog(question="just asked", answer="yes"))
+
+        data = self.client.get("/api/logs/").json()
+        self.assertEqual([r["question"] for r in data["logs"]], ["just asked"])
+
+
+class LogStatsTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now() - timedelta(minutes=1)
+        rows = [
+            # document 1, two hours ago: 100..400 ms, one error
+            *[QueryLog(question="q", document_id=1, latency_ms=ms, best_distance=0.2, answer="a",
+                       created_at=now - timedelta(hours=2)) for ms in (100, 200, 300)],
+            QueryLog(question="q", document_id=1, latency_ms=400, error="boom", created_at=now - timedelta(hours=2)),
+            # document 2, this hour: one "I don't know."
+            QueryLog(question="q", document_id=2, latency_ms=1000, best_distance=0.9, answer="I don't know.", created_at=now),
+            # outside the window
+            QueryLog(question="q", document_id=2, latency_ms=9999, created_at=now - timedelta(days=3)),
+        ]
+        QueryLog.objects.bulk_create(rows)
+
+    def test_stats_are_aggregated_per_document_and_bucket(self):
+        """Percentiles and rates should cover the window's rows, grouped per document and per hour."""
+        data = self.client.get("/api/logs/stats/", {"bucket": "hour"}).json()
+
+        overall = data["overall"]
+        self.assertEqual(overall["count"], 5)
+        self.assertEqual(overall["latency_ms"]["p50"], 300)
+        self.assertEqual(overall["error_rate"], 0.2)
+        self.assertEqual(overall["idk_rate"], 0.2)
+        self.assertEqual(
+            [(d["document_id"], d["count"]) for d in data["by_document"]], [(1, 4), (2, 1)]
+        )
+        self.assertEqual(data["by_document"][0]["latency_ms"]["p50"], 250)
+        self.assertEqual(data["by_document"][0]["best_distance"]["p50"], 0.2)
+        self.assertEqual([b["count"] for b in data["by_bucket"]], [4, 1])
+
+    def test_stats_for_one_document(self):
+        """?document_id= should restrict every grouping to that document."""
+        data = self.client.get("/api/logs/stats/", {"document_id": 2}).json()
+        self.assertEqual(data["overall"]["count"], 1)
+        self.assertEqual(data["overall"]["idk_rate"], 1.0)
+
+    def test_rejects_too_many_buckets(self):
+        """A window that would need more than MAX_BUCKETS buckets should be a 400."""
+        resp = self.client.get("/api/logs/stats/", {"since": "2020-01-01T00:00:00", "bucket": "minute"})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_logs_pages_with_a_keyset(self):
+        """Raw logs should page by id with one query per page."""
+        with self.assertNumQueries(1):
+            first = self.client.get("/api/logs/", {"limit": 4}).json()
+        second = self.client.get("/api/logs/", {"limit": 4, "before": first["next_before"]}).json()
+
+        ids = [r["id"] for r in first["logs"] + second["logs"]]
+        self.assertEqual(ids, sorted(QueryLog.objects.values_list("id", flat=True), reverse=True))
+        self.assertEqual(second["count"], 2)
+        self.assertIsNone(second["next_before"])
+
+
+class HybridRetrievalTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Infra", source="text_file")
+        texts = [
+            "The primary database runs on host db-prod-07.internal.",
+            "Backups are taken nightly and kept for thirty days.",
+            "Docker Compose starts Postgres with the pgvector extension.",
+        ]
+        store_chunks(self.doc, texts, [unit_vector(i) for i in range(3)])
+        # the question embedding is closest to the backups chunk, not the hostname one
+        self.q_emb = unit_vector(1)
+
+    def test_lexical_mode_finds_exact_identifiers(self):
+        """Full-text search should match a hostname without any embedding."""
+        chunks = search_chunks("db-prod-07.internal", None, 2, mode="lexical")
+
+        self.assertEqual(chunks[0].chunk_index, 0)
+        self.assertIsNone(chunks[0].distance)
+
+    def test_hybrid_mode_fuses_both_rankings(self):
+        """Hybrid results include the lexical match and the nearest vector, with distances."""
+        chunks = search_chunks("which host runs db-prod-07.internal?", self.q_emb, 2, document_id=self.doc.id, mode="hybrid")
+
+        self.assertEqual({c.chunk_index for c in chunks}, {0, 1})
+        self.assertTrue(all(c.distance is not None and c.score > 0 for c in chunks))
+
+    def test_auto_mode_picks_lexical_for_keyword_queries(self):
+        """Identifier-like queries skip the embedding; questions use hybrid."""
+        self.assertTrue(looks_like_keywords("db-prod-07.internal"))
+        self.assertFalse(looks_like_keywords("How are backups handled?"))
+        self.assertEqual(resolve_mode("auto", "POL-2291"), "lexical")
+        self.assertEqual(resolve_mode("auto", "How are backups handled?"), "hybrid")
+        with self.assertRaises(ValueError):
+            resolve_mode("fuzzy", "anything")
+
+
+class SearchEffortTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Doc", source="text_file")
+        store_chunks(self.doc, [f"chunk {i}" for i in range(5)], [unit_vector(i) for i in range(5)])
+
+    def test_ef_search_is_set_for_the_query_transaction_only(self):
+        """The override is raised to k and every query sets its own value (default when absent)."""
+        settings_seen = []
+
+        def capture(execute, sql, params, many, context):
+            if "set_config" in sql:
+                settings_seen.append(tuple(params))
+            return execute(sql, params, many, context)
+
+        # rolled-back rows of earlier tests stay in the HNSW graph and can fill a 3-candidate
+        # list; scan the table instead, only the settings are under test here
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_indexscan = off")
+        with connection.execute_wrapper(capture):
+            chunks = search_chunks("", unit_vector(2), 3, mode="vector", ef_search=1)
+            search_chunks("", unit_vector(2), 3, mode="vector")
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0].chunk_index, 2)
+        self.assertEqual(settings_seen, [("hnsw.ef_search", "3"), ("hnsw.ef_search", "40")])
+
+    def test_invalid_overrides_are_rejected(self):
+        """search_params validates ranges; the views turn errors into 400s."""
+        self.assertEqual(search_params({"ef_search": "200"}), {"ef_search": 200, "probes": None})
+        with self.assertRaises(ValueError):
+            search_params({"ef_search": 0})
+        with self.assertRaises(ValueError):
+            search_params({"probes": "many"})
+
+        resp = self.client.post("/api/retrieve/", {"query": "x", "ef_search": 5000}, content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+
+class PreparedSearchTests(TestCase):
+
+    def test_vector_search_is_a_prepared_statement(self):
+        """The vector query is prepared once per connection and reused by later searches."""
+        doc = Document.objects.create(title="Doc", source="text_file")
+        store_chunks(doc, [f"chunk {i}" for i in range(3)], [unit_vector(i) for i in range(3)])
+
+        first = search_chunks("", unit_vector(1), 2, document_id=doc.id, mode="vector")
+        second = search_chunks("", unit_vector(2), 2, document_id=doc.id, mode="vector")
+
+        self.assertEqual(first[0].chunk_index, 1)
+        self.assertEqual(second[0].chunk_index, 2)
+        self.assertIsNone(second[0].score)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE statement LIKE %s", ["%/* exact */%"])
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_prepared_scoped_search_keeps_the_partial_index(self):
+        """Even with a generic plan, a large document's search should use its partial index."""
+        doc = Document.objects.create(title="Large", source="text_file")
+        store_chunks(doc, [f"chunk {i}" for i in range(4)], [unit_vector(i) for i in range(4)])
+        Document.objects.filter(pk=doc.pk).update(chunk_count=4, embedding_model="text-embedding-3-small", embedding_dimensions=1536)
+        name = f"chunk_emb_doc_{doc.id}"
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")  # fires the pending FK checks CREATE INDEX refuses to run with
+            cursor.execute(partial_index_sql(name, doc.id, "text-embedding-3-small", 1536).replace(" CONCURRENTLY", ""))
+            cursor.execute("DROP INDEX chunk_embedding_hnsw")  # the global index would be just as cheap here
+            cursor.execute("SELECT set_config('plan_cache_mode', 'force_generic_plan', true)")
+            # a few rows: without these a scan and sort always wins over any vector index
+            cursor.execute("SELECT set_config('enable_seqscan', 'off', true)")
+            cursor.execute("SELECT set_config('enable_sort', 'off', true)")
+
+        with override_settings(RAG_SCOPED_EXACT_MAX_CHUNKS=1), \
+                mock.patch("api.retrieval.pgvector_version", return_value=(0, 7, 4)), \
+                mock.patch("api.retrieval._table_size_estimate", return_value=4):
+            for i in range(7):
+                chunks = search_chunks("", unit_vector(i % 4), 2, document_id=doc.id, mode="vector")
+                self.assertEqual(chunks[0].chunk_index, i % 4)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM pg_prepared_statements WHERE statement LIKE %s", ["%/* index */%"])
+            (statement,) = cursor.fetchone()
+            cursor.execute(f"EXPLAIN EXECUTE {statement}(%s, 2)", [str(unit_vector(1))])
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn(name, plan)
+
+    def test_bench_db_reports_pool_and_prepared_latency(self):
+        """The benchmark compares connect-per-request with the pool, and prepared with unprepared."""
+        out = StringIO()
+        call_command("bench_db", requests=3, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report["pooled"]), {"p50_ms", "p95_ms", "p99_ms", "qps"})
+        self.assertIn("connection_setup_saved_ms", report)
+        self.assertEqual(set(report["vector_query"]), {"unprepared", "prepared"})
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("Passwords must be 12 characters.")
+        self.client_mock = patch_views(self)
+
+    def ask(self, question):
+        return self.client.post(
+            "/api/ask/",
+            {"question": question, "document_id": self.doc.id},
+            content_type="application/json",
+        )
+
+    def test_pool_timeout_is_503(self):
+        """Waiting too long for a pooled database connection should be a 503 too."""
+        def pool_exhausted(**kwargs):
+            try:
+                raise PoolTimeout("couldn't get a connection after 10.00 sec")
+            except PoolTimeout as e:
+                raise OperationalError(str(e)) from e
+
+        self.client_mock.responses.create.side_effect = pool_exhausted
+        resp = self.ask("How long should passwords be?")
+        self.assertEqual(resp.status_code, 503)
+
+    def test_connection_is_released_before_generation(self):
+        """With the pool on, the request's connection goes back before the model is called."""
+        conn = mock.Mock(settings_dict={"OPTIONS": {"pool": {"max_size": 10}}}, in_atomic_block=False)
+        released = []
+        self.client_mock.responses.create.side_effect = lambda **kwargs: (
+            released.append(conn.close.called) or mock.Mock(output_text="12 characters.")
+        )
+
+        with mock.patch("api.views.connection", conn):
+            self.ask("How long should passwords be?")
+
+        self.assertEqual(released, [True])
+
+
+class ScopedRetrievalTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Scoped", source="ingested_text")
+        with mock.patch("api.ingest.embed_texts", side_effect=lambda texts, **kwargs: [unit_vector(i) for i in range(len(texts))]):
+            ingest_chunks(self.doc, [f"Section {i} of the handbook." for i in range(4)])
+        other = Document.objects.create(title="Other", source="ingested_text")
+        store_chunks(other, [f"other {i}" for i in range(20)], [unit_vector(i) for i in range(20)])
+
+    def search_config(self, **overrides):
+        """Runs a scoped search and returns (chunk indexes, the set_config calls it made)."""
+        calls = []
+
+        def capture(execute, sql, params, many, context):
+            if "set_config" in sql:
+                calls.append(tuple(params))
+                if params[0].endswith("iterative_scan"):
+                    return None  # needs pgvector 0.8+, which the test database may not have
+            return execute(sql, params, many, context)
+
+        with override_settings(**overrides), connection.execute_wrapper(capture):
+            chunks = search_chunks("", unit_vector(1), 2, document_id=self.doc.id, mode="vector")
+        return [c.chunk_index for c in chunks], calls
+
+    def test_small_documents_are_searched_exactly(self):
+        """Below the threshold the ANN index is switched off for the query."""
+        self.assertEqual(Document.objects.get(pk=self.doc.pk).chunk_count, 4)
+
+        indexes, calls = self.search_config(RAG_SCOPED_EXACT_MAX_CHUNKS=100)
+
+        self.assertEqual(indexes[0], 1)
+        self.assertEqual(calls, [("enable_indexscan", "off")])
+
+    def test_small_documents_skip_the_compact_index(self):
+        """With halfvec/binary storage an exact search still ranks on the full vectors, with no prefetch."""
+        for storage in ("halfvec", "binary"):
+            statements = []
+
+            def capture(execute, sql, params, many, context):
+                statements.append(sql)
+                return execute(sql, params, many, context)
+
+            with self.subTest(storage=storage), connection.execute_wrapper(capture):
+                indexes, calls = self.search_config(RAG_SCOPED_EXACT_MAX_CHUNKS=100, RAG_VECTOR_STORAGE=storage)
+
+            self.assertEqual(indexes, [1, 0])
+            self.assertEqual(calls, [("enable_indexscan", "off")])
+            search = [sql for sql in statements if "FROM api_chunk" in sql]
+            self.assertEqual(len(search), 1)
+            self.assertNotIn("halfvec" if storage == "halfvec" else "binary_quantize", search[0])
+
+    def test_large_documents_use_the_index(self):
+        """Above it, the index is used: iterative scans on pgvector 0.8+, a wider ef_search before."""
+        with mock.patch("api.retrieval.pgvector_version", return_value=(0, 8, 0)):
+            _, calls = self.search_config(RAG_SCOPED_EXACT_MAX_CHUNKS=1)
+        self.assertIn(("hnsw.iterative_scan", "relaxed_order"), calls)
+
+        with mock.patch("api.retrieval.pgvector_version", return_value=(0, 7, 4)), \
+             mock.patch("api.retrieval._table_size_estimate", return_value=4000):
+            _, calls = self.search_config(RAG_SCOPED_EXACT_MAX_CHUNKS=1)
+        # the document is 4 of ~4000 rows: 2 results need a candidate list of 2000 (capped at 1000)
+        self.assertEqual(calls, [("hnsw.ef_search", "1000")])
+
+
+class CompactStorageTests(TestCase):
+
+    def setUp(self):
+        if pgvector_version() < (0, 7):
+            self.skipTest("halfvec / binary_quantize need pgvector 0.7+")
+        self.doc = Document.objects.create(title="Doc", source="text_file")
+        # chunk 1 points exactly along the query, chunk 0 nearly, chunk 2 is orthogonal
+        near = [0.9, 0.09] + [0.0] * 1534
+        store_chunks(self.doc, ["close", "exact", "orthogonal"], [unit_vector(0), near, unit_vector(2)])
+        self.q_emb = [1.0, 0.1] + [0.0] * 1534
+
+    def test_compact_candidates_are_reranked_on_full_vectors(self):
+        """Results are ordered, and distances reported, by the full-precision vectors."""
+        for storage in ("halfvec", "binary"):
+            with self.subTest(storage=storage), override_settings(RAG_VECTOR_STORAGE=storage):
+                chunks = search_chunks("", self.q_emb, 2, mode="vector")
+
+                self.assertEqual([c.chunk_index for c in chunks], [1, 0])
+                self.assertAlmostEqual(chunks[0].distance, 0.0, places=5)
+
+
+class EmbeddingGenerationTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("api.ingest.embed_texts", side_effect=fake_embed)
+        self.embed_texts = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.moved = Document.objects.create(title="Moved", source="ingested_text")
+        self.kept = Document.objects.create(title="Kept", source="ingested_text")
+        ingest_chunks(self.moved, ["Badges are renewed yearly.", "Visitors sign in at reception."])
+        ingest_chunks(self.kept, ["Laptops are encrypted."])
+
+    def test_reembed_switches_one_document_and_keeps_others_searchable(self):
+        """Moved chunks get the new size; each generation is only compared with its own questions."""
+        stats = reembed_document(self.moved, ("text-embedding-3-small", 512))
+
+        self.assertEqual(stats["chunks"], 2)
+        self.assertEqual(stats["embeddings_requested"], 2)
+        version, generation = document_state(self.moved.id)
+        self.assertEqual((version, generation), (2, ("text-embedding-3-small", 512)))
+
+        scoped = search_chunks("", [0.1] * 512, 5, document_id=self.moved.id, generation=generation)
+        self.assertEqual(len(scoped), 2)
+        unscoped = search_chunks("", [0.1] * 1536, 5)
+        self.assertEqual({c.document_id for c in unscoped}, {self.kept.id})
+
+    def test_reembed_counts_cache_hits_per_cached_text(self):
+        """Only texts already in EmbeddingCache count as hits, however many chunks repeat them."""
+        doc = Document.objects.create(title="Repeats", source="ingested_text")
+        ingest_chunks(doc, ["Same line.", "Same line.", "Same line.", "Cached line.", "New line."])
+        generation = ("text-embedding-3-small", 512)
+        cache_embeddings({text_hash("Cached line."): [0.1] * 512}, generation)
+
+        stats = reembed_document(doc, generation)
+
+        self.assertEqual(stats["chunks"], 5)
+        self.assertEqual(stats["embeddings_requested"], 2)
+        self.assertEqual(stats["embedding_cache_hits"], 1)
+
+    def test_reingest_after_a_model_change_replaces_old_generation_rows(self):
+        """Rows embedded with another generation aren't reused, so a document never mixes sizes."""
+        with override_settings(RAG_EMBEDDING_DIMENSIONS=256):
+            stats = ingest_chunks(self.kept, ["Laptops are encrypted."])
+
+        self.assertEqual((stats["chunks_reused"], stats["chunks_deleted"], stats["embeddings_requested"]), (0, 1, 1))
+        self.assertEqual(set(Chunk.objects.filter(document=self.kept).values_list("embedding_dimensions", flat=True)), {256})
+
+    def test_dimensions_are_only_sent_to_models_that_support_them(self):
+        """Older embedding models reject the dimensions parameter."""
+        self.assertEqual(embedding_kwargs(("text-embedding-3-large", 1024)), {"model": "text-embedding-3-large", "dimensions": 1024})
+        self.assertEqual(embedding_kwargs(("text-embedding-ada-002", 1536)), {"model": "text-embedding-ada-002"})
+
+
+class EmbeddingProviderTests(TestCase):
+
+    def test_provider_follows_the_generation_model(self):
+        """Prefixed models go to their provider (loaded once); plain names go to OpenAI."""
+        self.assertIsInstance(provider_for("text-embedding-3-small"), OpenAIEmbeddings)
+        self.assertIsInstance(provider_for("local:all-MiniLM-L6-v2"), LocalEmbeddings)
+        self.assertIs(provider_for("hash:words"), provider_for("hash:words"))
+
+    def test_hash_provider_is_deterministic_and_normalized(self):
+        """Same text, same unit vector; shared words make texts closer."""
+        provider = HashEmbeddings("words")
+        a, b, c = provider.embed(["VPN access needs a token", "VPN access needs a token", "Lunch is at noon"], 64)
+        q = provider.embed(["how do I get VPN access"], 64)[0]
+
+        self.assertEqual(a, b)
+        self.assertEqual(len(a), 64)
+        self.assertAlmostEqual(sum(x * x for x in a), 1.0, places=5)
+        self.assertGreater(sum(x * y for x, y in zip(q, a)), sum(x * y for x, y in zip(q, c)))
+
+    def test_local_provider_truncates_and_renormalizes(self):
+        """Smaller sizes keep the leading components; larger ones than the model's are an error."""
+        provider = LocalEmbeddings("tiny")
+        provider._encoder = mock.Mock()
+        provider._encoder.encode.return_value = [[3.0, 4.0, 12.0], [0.0, 2.0, 0.0]]
+
+        vectors = provider.embed(["a", "b"], 2)
+        self.assertEqual([[round(x, 5) for x in v] for v in vectors], [[0.6, 0.8], [0.0, 1.0]])
+        with self.assertRaises(ValueError):
+            provider.embed(["a"], 4)
+
+    @override_settings(RAG_EMBEDDING_PROVIDER="hash", RAG_EMBEDDING_MODEL="words", RAG_EMBEDDING_DIMENSIONS=128)
+    def test_ingest_and_retrieve_go_through_the_configured_provider(self):
+        """With the hash provider the whole ingest -> retrieve path runs without the API."""
+        with mock.patch("api.llm.client") as api:
+            for title, text in [("IT", "VPN access needs a hardware token."), ("Canteen", "Lunch is served at noon.")]:
+                self.client.post("/api/ingest_text/", {"title": title, "text": text}, content_type="application/json")
+            resp = self.client.post("/api/retrieve/", {"query": "VPN hardware token", "k": 1}, content_type="application/json")
+
+        api.embeddings.create.assert_not_called()
+        doc = Document.objects.get(title="IT")
+        self.assertEqual((doc.embedding_model, doc.embedding_dimensions), ("hash:words", 128))
+        self.assertEqual(resp.json()["results"][0]["document_id"], doc.id)
+
+
+class RerankTests(TestCase):
+
+    def setUp(self):
+        self.doc = Document.objects.create(title="Onboarding", source="ingested_text")
+        near = [0.0] * 1536
+        near[0], near[1] = 0.995, 0.0999
+        # chunk 1 is an overlap near-duplicate of chunk 0; chunk 2 is less relevant but new
+        store_chunks(self.doc, ["Laptops ship on day one.", "Laptops ship on day one, imaged.", "Badges are at reception."],
+                     [unit_vector(0), near, unit_vector(2)])
+        self.q_emb = [0.0] * 1536
+        self.q_emb[0], self.q_emb[2] = 0.8, 0.6
+
+    def test_mmr_skips_near_duplicates(self):
+        """With lambda < 1 the second pick is the diverse item, with lambda = 1 it's plain top-k."""
+        vectors = [[1.0, 0.0], [0.99, 0.14], [0.5, 0.866]]
+        self.assertEqual(mmr([0.9, 0.89, 0.8], vectors, 2, 0.7), [0, 2])
+        self.assertEqual(mmr([0.9, 0.89, 0.8], vectors, 2, 1.0), [0, 1])
+
+    def test_rerank_search_replaces_duplicates_with_diverse_chunks(self):
+        """Over-fetched candidates are narrowed to k by MMR; rerank=False keeps the top-k."""
+        plain = rerank_search("", self.q_emb, 2, rerank=False, document_id=self.doc.id)
+        diverse = rerank_search("", self.q_emb, 2, document_id=self.doc.id)
+
+        self.assertEqual([c.chunk_index for c in plain], [0, 1])
+        self.assertEqual([c.chunk_index for c in diverse], [0, 2])
+
+    @override_settings(RAG_CROSS_ENCODER_MODEL="tiny-cross-encoder")
+    def test_cross_encoder_scores_relevance(self):
+        """When configured, the cross-encoder decides which candidate comes first."""
+        encoder = mock.Mock()
+        encoder.predict.side_effect = lambda pairs: [0.9 if "Badges" in text else 0.1 for _, text in pairs]
+
+        with mock.patch("api.rerank.cross_encoder", return_value=encoder):
+            chunks = rerank_search("where are badges?", self.q_emb, 1, document_id=self.doc.id)
+
+        self.assertEqual(chunks[0].chunk_index, 2)
+
+
+class ContextBuilderTests(TestCase):
+
+    def chunks(self, document_id, texts, start=0):
+        return [Chunk(document_id=document_id, chunk_index=start + i, text=t) for i, t in enumerate(texts)]
+
+    def test_neighbouring_chunks_merge_without_repeated_overlap(self):
+        """Adjacent chunks of one document become a single span that reads like the original text."""
+        text = " ".join(f"Sentence number {i} talks about the quarterly security review." for i in range(12))
+        parts = chunk_text(text, max_chars=200, overlap=60)
+        chunks = self.chunks(1, parts)
+
+        context = build_context([chunks[1], chunks[0], chunks[2]], budget=10_000)
+
+        self.assertEqual(len(context["spans"]), 1)
+        merged = context["text"].removeprefix("[source 1] ")
+        self.assertTrue(text.startswith(merged))
+        self.assertTrue(merged.endswith(parts[2]))
+        self.assertEqual([c.chunk_index for c in context["chunks"]], [1, 0, 2])
+
+    def test_budget_is_filled_in_rank_order(self):
+        """Chunks that don't fit are skipped; an oversized top chunk is cut to the budget."""
+        a, b, c = self.chunks(1, ["a" * 200]) + self.chunks(2, ["b" * 400]) + self.chunks(3, ["c" * 100])
+
+        context = build_context([a, b, c], budget=100)
+        self.assertEqual([x.document_id for x in context["chunks"]], [1, 3])
+        self.assertLessEqual(context["tokens"], 100)
+        self.assertEqual(count_tokens(context["text"]), context["tokens"])
+
+        cut = build_context([b], budget=20)
+        self.assertEqual((len(cut["chunks"]), cut["tokens"] <= 20), (1, True))
+
+    def test_sources_match_the_prompt_labels(self):
+        """Merged neighbours ranked apart become one source, so "[source N]" is sources[N - 1]."""
+        c3, c4, c9 = Chunk(document_id=1, chunk_index=3, text="Three."), Chunk(document_id=1, chunk_index=4, text="Four."), Chunk(document_id=1, chunk_index=9, text="Nine.")
+        for i, c in enumerate([c9, c3, c4]):
+            c.distance, c.score = 0.1 * (i + 1), None
+
+        messages, sources, stats = _answer_input("q", [c9, c3, c4])
+
+        prompt = messages[1]["content"]
+        self.assertIn("[source 1] Nine.\n\n[source 2] Three. Four.", prompt)
+        self.assertEqual([(s["chunk_index"], s["chunk_index_end"], s["text"]) for s in sources], [(9, 9, "Nine."), (3, 4, "Three. Four.")])
+        self.assertAlmostEqual(sources[1]["distance"], 0.2)
+        self.assertEqual(stats["context_chunks"], 3)
+
+    @override_settings(RAG_CONTEXT_TOKEN_BUDGET=60)
+    def test_ask_logs_prompt_stats(self):
+        """The QueryLog row records the prompt size and how many chunks made it in."""
+        doc = Document.objects.create(title="Doc", source="ingested_text")
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            ingest_chunks(doc, ["Passwords must be 12 characters.", "x" * 400])
+
+        with mock.patch("api.views.embed_query", return_value=[0.1] * 1536), mock.patch("api.views.client") as client:
+            client.responses.create.return_value.output_text = "12 characters."
+            resp = self.client.post(
+                "/api/ask/", {"question": "How long?", "document_id": doc.id, "cache": False}, content_type="application/json",
+            ).json()
+
+        log = QueryLog.objects.get()
+        self.assertEqual(log.context_chunks, 1)
+        self.assertEqual(len(resp["sources"]), 1)
+        self.assertGreater(log.prompt_tokens, 0)
+
+
+class AskBatchTests(TestCase):
+
+    def setUp(self):
+        self.hr = Document.objects.create(title="HR", source="ingested_text")
+        self.it = Document.objects.create(title="IT", source="ingested_text")
+        store_chunks(self.hr, ["Vacation requests go to your manager.", "Payroll runs monthly."], [unit_vector(0), unit_vector(1)])
+        store_chunks(self.it, ["Laptops are encrypted.", "VPN needs a token."], [unit_vector(2), unit_vector(3)])
+        for doc in (self.hr, self.it):
+            Document.objects.filter(pk=doc.pk).update(chunk_count=2)
+
+    def test_batch_search_matches_single_searches_in_one_query(self):
+        """Vector questions about small documents share one LATERAL query with the same results."""
+        queries = [
+            {"query": "", "q_emb": unit_vector(1), "document_id": self.hr.id},
+            {"query": "", "q_emb": unit_vector(3), "document_id": self.it.id},
+            {"query": "VPN", "q_emb": None, "document_id": self.it.id, "mode": "lexical"},
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            batch = search_chunks_batch(queries, 1)
+
+        self.assertEqual(sum("LATERAL" in q["sql"] for q in ctx.captured_queries), 1)
+        for q, chunks in zip(queries, batch):
+            single = search_chunks(k=1, **q)
+            self.assertEqual([c.id for c in chunks], [c.id for c in single])
+        self.assertEqual([chunks[0].text for chunks in batch], ["Payroll runs monthly.", "VPN needs a token.", "VPN needs a token."])
+
+    def test_answers_every_question_with_one_embedding_call_and_one_log_insert(self):
+        """Items come back in order; a bad item gets an error without failing the batch."""
+        vectors = {"When is payroll?": unit_vector(1), "How do I use the VPN?": unit_vector(3)}
+        with mock.patch("api.query_cache.embed", side_effect=lambda texts, generation=None: [vectors[t] for t in texts]) as embed, \
+             mock.patch("api.views.client") as client:
+            client.responses.create.return_value.output_text = "Answer."
+            resp = self.client.post("/api/ask/batch/", {
+                "document_id": self.hr.id,
+                "rerank": False,
+                "questions": ["When is payroll?", {"question": "How do I use the VPN?", "document_id": self.it.id}, {"question": ""}],
+            }, content_type="application/json")
+
+        results = resp.json()["results"]
+        embed.assert_called_once()
+        self.assertEqual(client.responses.create.call_count, 2)
+        self.assertEqual([r.get("document_id") for r in results], [self.hr.id, self.it.id, None])
+        # the document's two neighbouring chunks come back as one merged source
+        self.assertEqual(results[0]["sources"][0]["text"], "Vacation requests go to your manager. Payroll runs monthly.")
+        self.assertEqual(results[1]["answer"], "Answer.")
+        self.assertEqual(results[2]["error"], "question is required")
+        self.assertEqual(QueryLog.objects.count(), 2)
+
+    def test_rejects_oversized_batches(self):
+        """The batch size is capped by RAG_ASK_BATCH_MAX_QUESTIONS."""
+        with override_settings(RAG_ASK_BATCH_MAX_QUESTIONS=2):
+            resp = self.client.post("/api/ask/batch/", {"questions": ["a", "b", "c"]}, content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+
+class BenchRetrievalTests(TestCase):
+    def test_reports_latency_and_recall_per_size(self):
+        """The benchmark prints one JSON result per corpus size and cleans up its document."""
+        out = StringIO()
+        call_command("bench_retrieval", sizes="40,80", queries=5, k=3, stdout=out, stderr=StringIO())
+
+        report = json.loads(out.getvalue())
+        self.assertEqual([r["corpus_size"] for r in report["results"]], [40, 80])
+        for result in report["results"]:
+            self.assertEqual(set(result["index"]), {"p50_ms", "p95_ms", "p99_ms", "qps"})
+            self.assertTrue(0 <= result["recall@3"] <= 1)
+            self.assertGreater(result["index_bytes"], 0)
+        self.assertFalse(Document.objects.filter(source="bench_retrieval").exists())
+
+
+class VectorIndexTests(TestCase):
+
+    def plan(self):
+        out = StringIO()
+        call_command("vector_index", "--dry-run", stdout=out)
+        return out.getvalue().splitlines()
+
+    def test_migrations_match_the_models(self):
+        """Index settings live outside the model state, so there is nothing to makemigrations."""
+        with override_settings(RAG_VECTOR_STORAGE="halfvec", RAG_HNSW_M=32):
+            call_command("makemigrations", "api", "--check", "--dry-run", stdout=StringIO())
+
+    def test_default_settings_keep_the_migrated_index(self):
+        """Migrations already built the index the default settings describe."""
+        self.assertEqual(self.plan(), ["chunk_embedding_hnsw is up to date"])
+
+    def test_changed_settings_replace_the_index(self):
+        """Other storage gets a new index (then the old one goes); other build parameters a rebuild."""
+        with override_settings(RAG_VECTOR_STORAGE="halfvec"):
+            self.assertEqual(self.plan(), ["create chunk_embedding_hnsw_halfvec", "drop chunk_embedding_hnsw"])
+        with override_settings(RAG_HNSW_M=24):
+            self.assertEqual(self.plan(), ["rebuild chunk_embedding_hnsw"])
+
+    def test_index_of_a_generation_in_use_is_kept(self):
+        """A new generation doesn't drop the old one's index while chunks (e.g. mid reembed) still use it."""
+        new_generation = override_settings(RAG_EMBEDDING_MODEL="text-embedding-3-large", RAG_EMBEDDING_DIMENSIONS=512)
+        with new_generation:
+            self.assertEqual(self.plan(), ["rebuild chunk_embedding_hnsw"])
+
+        ingested_doc("Embedded with the previous model.")
+        with new_generation:
+            self.assertEqual(self.plan(), ["keep chunk_embedding_hnsw as chunk_embedding_hnsw_prev, create chunk_embedding_hnsw"])
+            with connection.cursor() as cursor:  # what that step leaves behind (CONCURRENTLY can't run in a test)
+                cursor.execute("ALTER INDEX chunk_embedding_hnsw RENAME TO chunk_embedding_hnsw_prev")
+            out, err = StringIO(), StringIO()
+            call_command("vector_index", "--dry-run", stdout=out, stderr=err)
+            self.assertEqual(out.getvalue().splitlines(), ["create chunk_embedding_hnsw"])
+            self.assertEqual(err.getvalue(), "keeping chunk_embedding_hnsw_prev: chunks still use its embedding generation\n")
+
+            Chunk.objects.all().delete()
+            self.assertEqual(self.plan(), ["create chunk_embedding_hnsw", "drop chunk_embedding_hnsw_prev"])
+
+
+class MockOpenAI(BaseHTTPRequestHandler):
+    """Local stand-in for /v1/embeddings: counts requests, answers 429 `fail` times, then after `delay` seconds."""
+    requests = 0
+    fail = 0
+    delay = 0.0
+
+    def do_POST(self):
+        cls = type(self)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        cls.requests += 1
+        if cls.fail:
+            cls.fail -= 1
+            self.reply(429, {"error": {"message": "slow down", "type": "rate_limit"}}, {"retry-after-ms": "10"})
+            return
+        time.sleep(cls.delay)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.reply(200, {
+            "object": "list",
+            "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": [0.5, 0.5]} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        })
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except BrokenPipeError:
+            pass  # the client timed out
+
+    def log_message(self, *args):
+        pass
+
+
+class LLMGatewayTests(TestCase):
+
+    def setUp(self):
+        handler = type("Handler", (MockOpenAI,), {})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.handler = handler
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def embed(self, gateway, text="hello"):
+        return gateway.embeddings.create(model="text-embedding-3-small", input=[text])
+
+    def test_identical_embeddings_in_flight_are_coalesced(self):
+        """Concurrent identical embedding requests should share one upstream call."""
+        self.handler.delay = 0.3
+        gateway = Gateway(base_url=self.base_url, api_key="x")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.embed(gateway))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.handler.requests, 1)
+        self.assertEqual([r.data[0].embedding for r in results], [[0.5, 0.5]] * 5)
+        self.embed(gateway, "other text")
+        self.assertEqual(self.handler.requests, 2)
+
+    def test_rate_limited_requests_are_retried(self):
+        """A 429 from upstream should be retried by the pooled client."""
+        self.handler.fail = 2
+        with override_settings(RAG_OPENAI_MAX_RETRIES=3):
+            result = self.embed(Gateway(base_url=self.base_url, api_key="x"))
+
+        self.assertEqual(result.data[0].embedding, [0.5, 0.5])
+        self.assertEqual(self.handler.requests, 3)
+
+    def test_slow_upstream_times_out(self):
+        """The per-operation timeout should bound a slow upstream call."""
+        self.handler.delay = 1.0
+        with override_settings(RAG_OPENAI_EMBED_TIMEOUT=0.2, RAG_OPENAI_MAX_RETRIES=0):
+            with self.assertRaises(openai.APITimeoutError):
+                self.embed(Gateway(base_url=self.base_url, api_key="x"))
+
+    def test_token_bucket_spaces_and_sheds_requests(self):
+        """The token bucket should queue requests at its rate and refuse ones that would wait too long."""
+        spaced = TokenBucket(rate=20, burst=1)
+        t0 = time.monotonic()
+        for _ in range(3):
+            spaced.acquire()
+        self.assertGreaterEqual(time.monotonic() - t0, 0.09)
+
+        shedding = TokenBucket(rate=1, burst=1, max_wait=0.5)
+        shedding.acquire()
+        with self.assertRaises(GatewayBusy):
+            shedding.acquire()
+
+
+class GatewayBusyTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("Passwords must be 12 characters.")
+        self.client_mock = patch_views(self)
+
+    def test_gateway_overload_is_503(self):
+        """A full rate limit queue should surface as a retryable 503, not a 500."""
+        self.client_mock.responses.create.side_effect = GatewayBusy("rate limit queue is 12.0s long")
+        resp = self.client.post(
+            "/api/ask/",
+            {"question": "How long should passwords be?", "document_id": self.doc.id},
+            content_type="application/json",
+        )
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.json()["error"], "busy")
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.doc = ingested_doc("Badges are renewed every year.")
+        self.client_mock = patch_views(self)
+        self.client_mock.responses.create.return_value.output_text = "Every year."
+
+    def test_nested_stages_are_exclusive(self):
+        """Time in an inner stage or a timed iterator shouldn't be counted in the outer stage."""
+        stages = Stages()
+        with stages("outer"):
+            with stages("inner"):
+                time.sleep(0.05)
+            items = list(stages.iterate("produce", (time.sleep(0.02) for _ in range(2))))
+
+        self.assertEqual(len(items), 2)
+        self.assertGreaterEqual(stages.seconds["inner"], 0.05)
+        self.assertGreaterEqual(stages.seconds["produce"], 0.04)
+        self.assertLess(stages.seconds["outer"], 0.02)
+
+    def test_ask_records_stage_timings(self):
+        """An answer should store its per-stage times and feed the /metrics histograms."""
+        generated = STAGE_SECONDS.count(view="ask", stage="generate")
+        misses = CACHE_LOOKUPS.value(cache="answer", result="miss")
+
+        self.client.post(
+            "/api/ask/",
+            {"question": "When are badges renewed?", "document_id": self.doc.id},
+            content_type="application/json",
+        )
+
+        log = QueryLog.objects.get()
+        for field in ("embed_ms", "retrieve_ms", "context_ms", "generate_ms"):
+            self.assertIsNotNone(getattr(log, field), field)
+        self.assertEqual(STAGE_SECONDS.count(view="ask", stage="generate"), generated + 1)
+        self.assertEqual(CACHE_LOOKUPS.value(cache="answer", result="miss"), misses + 1)
+
+        resp = self.client.get("/metrics")
+        self.assertTrue(resp["Content-Type"].startswith("text/plain"))
+        body = resp.content.decode()
+        self.assertIn("# TYPE rag_stage_seconds histogram", body)
+        self.assertIn('rag_stage_seconds_bucket{view="ask",stage="retrieve",le="+Inf"}', body)
+        self.assertIn('rag_prompt_tokens_count{view="ask"}', body)
+
+    def test_ingest_times_chunk_embed_and_insert(self):
+        """Ingest views should time chunking, embedding and the bulk insert."""
+        before = {s: STAGE_SECONDS.count(view="ingest_text", stage=s) for s in ("chunk", "embed", "bulk_insert")}
+
+        with mock.patch("api.ingest.embed_texts", side_effect=fake_embed):
+            self.client.post("/api/ingest_text/", {"title": "T", "text": "One. Two."}, content_type="application/json")
+
+        for stage, count in before.items():
+            self.assertEqual(STAGE_SECONDS.count(view="ingest_text", stage=stage), count + 1, stage)
+
+
+def tearDownModule():
+    # hits counted by these tests belong to the test database, not to whatever DATABASES names at exit
+    flush_hits()
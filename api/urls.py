@@ -1,28 +1,46 @@
 from django.urls import path
+from . import async_views
 from .views import (
     clear_selected_document, 
     retrieve, 
     ask, 
+    ask_stream,
+    ask_batch,
     ingest_text, 
     logs, 
+    log_stats,
     ingest_pdf, 
     documents,
     select_document, 
     app, 
     ingest_file, 
-    reset_data
+    reset_data,
+    ingest_async,
+    job_status,
 )
 
 urlpatterns = [
     path("", app, name="app"),
     path("retrieve/", retrieve),
     path("ask/", ask),
+    path("ask/stream/", ask_stream),
+    path("ask/batch/", ask_batch),
     path("ingest_text/", ingest_text),
     path("logs/", logs),
+    path("logs/stats/", log_stats),
     path("ingest_pdf/", ingest_pdf),
     path("documents/", documents),
     path("select_document/", select_document),
     path("ingest_file/", ingest_file),
     path("clear_document/", clear_selected_document),
     path("reset_data/", reset_data),
+    path("ingest_async/", ingest_async),
+    path("jobs/<int:job_id>/", job_status),
+
+    # ASGI-only: same API, non-blocking OpenAI + DB I/O
+    path("async/retrieve/", async_views.retrieve),
+    path("async/ask/", async_views.ask),
+    path("async/ingest_text/", async_views.ingest_text),
+    path("async/ingest_pdf/", async_views.ingest_pdf),
+    path("async/ingest_file/", async_views.ingest_file),
 ]
\ No newline at end of file
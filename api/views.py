@@ -1,16 +1,28 @@
 from django.views.decorators.http import require_GET
 import json, time
-from django.http import JsonResponse
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from openai import OpenAI
-from pgvector.django import CosineDistance
-from .models import Chunk, Document, QueryLog
+from .models import Chunk, Document, IngestJob, QueryLog
+from .answer_cache import lookup_answer, store_answer, store_answers
+from .context import build_context, count_tokens, span_text
+from .ingest import chunk_blocks, chunk_pages, chunk_text, ingest_chunks, upload_path
+from .jobs import enqueue_upload
+from .llm import OVERLOADED, client
+from .log_stats import query_stats
+from .metrics import PROMPT_TOKENS, Stages, render as render_metrics
+from .pdf import iter_pdf_pages
+from .query_cache import embed_queries, embed_query
+from .query_log import query_logs
+from .rerank import rerank_search, rerank_search_batch
+from .retrieval import document_state, min_distance, resolve_mode, search_chunks, search_params
 from django.shortcuts import render
-from pypdf import PdfReader
-import re
 from django.conf import settings
-
-client = OpenAI()
+from django.db import connection
+from django.utils import timezone
+from psycopg_pool import PoolTimeout
+from django.utils.dateparse import parse_datetime
 
 @csrf_exempt
 def retrieve(request):
@@ -21,34 +33,109 @@ def retrieve(request):
     query = body.get("query", "")
     k = int(body.get("k", 5))
 
-    q_emb = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=query,
-    ).data[0].embedding
+    try:
+        mode = resolve_mode(body.get("mode"), query)
+        index_params = search_params(body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    stages = Stages("retrieve")
+    with stages("embed"):
+        q_emb = embed_query(query) if mode != "lexical" else None
 
-    chunks = (
-        Chunk.objects
-        .exclude(embedding=None)
-        .annotate(distance=CosineDistance("embedding", q_emb))
-        .order_by("distance")[:k]
-    )
+    with stages("retrieve"):
+        chunks = search_chunks(query, q_emb, k, mode=mode, **index_params)
+    stages.finish()
 
     return JsonResponse({
         "query": query,
-        "results": [
-            {
-                "document_id": c.document_id,
-                "chunk_index": c.chunk_index,
-                "text": c.text,
-                "distance": float(c.distance),
-            }
-            for c in chunks
-        ]
+        "mode": mode,
+        "results": [_chunk_source(c) for c in chunks]
     })
 
+def _resolve_document_id(request, body, question):
+    """
+    Picks the document a question is scoped to.
+    Returns (document_id, None), or (None, error JsonResponse).
+    """
+    # Determining doc intent 
+    q = question.lower()
+    doc_intent = any(p in q for p in [
+        "summarize", "summary", "this pdf", "the pdf", "this document", "the document"
+    ])
+
+    # Priority: body doc_id > session doc_id > latest doc (if doc_intent)
+    raw_doc_id = body.get("document_id")
+    session_doc_id = request.session.get("current_document_id")
+
+    effective_document_id = None
+
+    if raw_doc_id not in (None, "", 0):
+        try:
+            effective_document_id = int(raw_doc_id)
+        except (TypeError, ValueError):
+            return None, JsonResponse({"error": "document_id must be an integer"}, status=400)
+    elif session_doc_id:
+        effective_document_id = int(session_doc_id)
+    elif doc_intent:
+        latest_doc = Document.objects.order_by("-id").first()
+        if latest_doc:
+            effective_document_id = latest_doc.id
+
+    if effective_document_id is None:
+        return None, JsonResponse(
+            {"error": "no_document_selected", "message": "Select or ingest a document first."},
+            status=400
+        )
+
+    return effective_document_id, None
+
+def _chunk_source(c):
+    return {
+        "document_id": c.document_id,
+        "chunk_index": c.chunk_index,
+        "page": c.page,
+        "text": c.text,
+        "distance": float(c.distance) if c.distance is not None else None,
+        "score": float(c.score) if c.score is not None else None,  # rank in lexical/hybrid mode
+    }
+
+def _span_source(span, rank):
+    """
+    One source per "[source N]" of the prompt: a run of neighbouring chunks, merged.
+    chunk_index/page are the first chunk's, *_end the last one's; distance/score are the best-ranked chunk's.
+    """
+    best = min(span, key=rank.index)
+    pages = [c.page for c in span if c.page is not None]
+    return {
+        **_chunk_source(best),
+        "chunk_index": span[0].chunk_index,
+        "chunk_index_end": span[-1].chunk_index,
+        "page": pages[0] if pages else None,
+        "page_end": pages[-1] if pages else None,
+        "text": span_text(span),
+    }
+
+def _answer_input(question, chunks):
+    """
+    Prompt for the answer, with the sources cut to RAG_CONTEXT_TOKEN_BUDGET.
+    Returns (input, one source per "[source N]" label in label order, {"prompt_tokens", "context_chunks"}).
+    """
+    context = build_context(chunks)
+    messages = [
+        {"role": "system", "content": "Answer using ONLY the provided sources. If the sources don't contain the answer, say: I don't know."},
+        {"role": "user", "content": f"Question: {question}\n\nSources:\n{context['text']}"},
+    ]
+    stats = {
+        "prompt_tokens": sum(count_tokens(m["content"]) for m in messages),
+        "context_chunks": len(context["chunks"]),
+    }
+    return messages, [_span_source(span, context["chunks"]) for span in context["spans"]], stats
+
 @csrf_exempt
 def ask(request):
     t0 = time.perf_counter()
+    stages = Stages("ask")
     log = None
 
     try:
@@ -62,56 +149,56 @@ def ask(request):
         if not question:
             return JsonResponse({"error": "question is required"}, status=400)
 
-        # Determining doc intent 
-        q = question.lower()
-        doc_intent = any(p in q for p in [
-            "summarize", "summary", "this pdf", "the pdf", "this document", "the document"
-        ])
-
-        # Priority: body doc_id > session doc_id > latest doc (if doc_intent)
-        raw_doc_id = body.get("document_id")
-        session_doc_id = request.session.get("current_document_id")
-
-        effective_document_id = None
-
-        if raw_doc_id not in (None, "", 0):
-            try:
-                effective_document_id = int(raw_doc_id)
-            except (TypeError, ValueError):
-                return JsonResponse({"error": "document_id must be an integer"}, status=400)
-        elif session_doc_id:
-            effective_document_id = int(session_doc_id)
-        elif doc_intent:
-            latest_doc = Document.objects.order_by("-id").first()
-            if latest_doc:
-                effective_document_id = latest_doc.id
-
-        if effective_document_id is None:
-            return JsonResponse(
-                {"error": "no_document_selected", "message": "Select or ingest a document first."},
-                status=400
-            )
-
-        # 1) embed question
-        q_emb = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=question,
-        ).data[0].embedding
-
-        # 2) retrieve top-k (scoped)
-        qs = Chunk.objects.exclude(embedding=None).filter(document_id=effective_document_id)
-        chunks = (
-            qs.annotate(distance=CosineDistance("embedding", q_emb))
-              .order_by("distance")[:k]
-        )
+        effective_document_id, error = _resolve_document_id(request, body, question)
+        if error:
+            return error
 
         max_distance = float(body.get("max_distance", 0.95))  # scoped default
 
-        best = chunks[0] if chunks else None
-        best_distance = float(best.distance) if best else None
+        try:
+            mode = resolve_mode(body.get("mode"), question)
+            index_params = search_params(body)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        # the answer cache is keyed on the question embedding, which lexical mode skips
+        use_cache = body.get("cache", True) is not False and mode != "lexical"
+        rerank = body.get("rerank", True) is not False
+
+        # 1) embed question (cached) like the document's chunks; lexical mode doesn't need it
+        doc_version, generation = document_state(effective_document_id)
+        with stages("embed"):
+            q_emb = embed_query(question, generation) if mode != "lexical" else None
+
+        # 2) reuse the answer to a near-identical question on the same document version
+        hit = None
+        if use_cache and doc_version is not None:
+            with stages("answer_cache"):
+                hit = lookup_answer(effective_document_id, doc_version, q_emb, k, mode, rerank, max_distance)
+
+        if hit:
+            log = QueryLog(
+                question=question,
+                k=k,
+                document_id=effective_document_id,
+                max_distance=max_distance,
+                best_distance=hit.best_distance,
+                answer=hit.answer,
+                sources=hit.sources,
+                latency_ms=int((time.perf_counter() - t0) * 1000),
+                cached=True,
+            )
+            return JsonResponse({"question": question, "answer": hit.answer, "sources": hit.sources, "cached": True})
+
+        # 3) retrieve top-k (scoped), re-ranked for diversity
+        with stages("retrieve"):
+            chunks = rerank_search(
+                question, q_emb, k, rerank=rerank, document_id=effective_document_id, mode=mode, generation=generation, **index_params,
+            )
+        best_distance = min_distance(chunks)
 
-        # log early
-        log = QueryLog.objects.create(
+        # log early (written once, by the query log writer, when the request is done)
+        log = QueryLog(
             question=question,
             k=k,
             document_id=effective_document_id,
@@ -119,33 +206,22 @@ def ask(request):
             best_distance=best_distance,
         )
 
-        if not best or float(best.distance) > max_distance:
-            latency_ms = int((time.perf_counter() - t0) * 1000)
+        if not chunks or (best_distance is not None and best_distance > max_distance):
             log.answer = "I don't know."
             log.sources = []
-            log.latency_ms = latency_ms
-            log.save(update_fields=["answer", "sources", "latency_ms"])
+            log.latency_ms = int((time.perf_counter() - t0) * 1000)
             return JsonResponse({"answer": "I don't know.", "sources": []})
 
-        sources = [
-            {
-                "document_id": c.document_id,
-                "chunk_index": c.chunk_index,
-                "text": c.text,
-                "distance": float(c.distance),
-            }
-            for c in chunks
-        ]
-        context = "\n\n".join([f"[source {i+1}] {c.text}" for i, c in enumerate(chunks)])
-
-        # 3) answer grounded in sources
-        resp = client.responses.create(
-            model="gpt-4.1-mini",
-            input=[
-                {"role": "system", "content": "Answer using ONLY the provided sources. If the sources don't contain the answer, say: I don't know."},
-                {"role": "user", "content": f"Question: {question}\n\nSources:\n{context}"},
-            ],
-        )
+        # 4) answer grounded in the sources that fit the token budget
+        with stages("context"):
+            answer_input, sources, prompt_stats = _answer_input(question, chunks)
+        PROMPT_TOKENS.observe(prompt_stats["prompt_tokens"], view="ask")
+        _release_connection()
+        with stages("generate"):
+            resp = client.responses.create(
+                model="gpt-4.1-mini",
+                input=answer_input,
+            )
 
         answer = resp.output_text
         latency_ms = int((time.perf_counter() - t0) * 1000)
@@ -153,48 +229,372 @@ def ask(request):
         log.answer = answer
         log.sources = sources
         log.latency_ms = latency_ms
-        log.save(update_fields=["answer", "sources", "latency_ms"])
+        log.prompt_tokens = prompt_stats["prompt_tokens"]
+        log.context_chunks = prompt_stats["context_chunks"]
 
-        return JsonResponse({"question": question, "answer": answer, "sources": sources})
+        if use_cache and doc_version is not None:
+            store_answer(effective_document_id, doc_version, question, q_emb, k, mode, rerank, best_distance, answer, sources)
+
+        return JsonResponse({"question": question, "answer": answer, "sources": sources, "cached": False})
 
     except Exception as e:
-        latency_ms = int((time.perf_counter() - t0) * 1000)
         if log:
             log.error = repr(e)
+            log.latency_ms = int((time.perf_counter() - t0) * 1000)
+        return _error_response(e)
+
+    finally:
+        if log:
+            _log_stages(log, stages)
+            with stages("log_write"):
+                query_logs.submit(log)
+        stages.finish()
+
+def _log_stages(log, stages):
+    log.embed_ms = stages.ms("embed")
+    log.retrieve_ms = stages.ms("retrieve")
+    log.context_ms = stages.ms("context")
+    log.generate_ms = stages.ms("generate")
+
+def _release_connection():
+    """
+    Hands this thread's pooled database connection back before a long LLM call, so a slow
+    generation doesn't keep one of the RAG_DB_POOL_MAX_SIZE connections; the next query takes
+    one again. A no-op without the pool (persistent connections) or inside a transaction.
+    """
+    if connection.settings_dict["OPTIONS"].get("pool") and not connection.in_atomic_block:
+        connection.close()
+
+def _error_response(e):
+    # overload is temporary: a 503 the client can retry, not an internal error
+    if isinstance(e, OVERLOADED) or isinstance(e.__cause__, PoolTimeout):
+        return JsonResponse({"error": "busy", "details": repr(e)}, status=503, headers={"Retry-After": "1"})
+    return JsonResponse({"error": "internal_error", "details": repr(e)}, status=500)
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@csrf_exempt
+def ask_stream(request):
+    """
+    Same as ask, but answers as Server-Sent Events:
+    - "sources" as soon as retrieval is done
+    - "token" for each piece of the answer as the model generates it
+    - "done" with latency stats (or "error" if something fails mid-stream)
+    """
+    t0 = time.perf_counter()
+
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    try:
+        body = json.loads(request.body.decode("utf-8") or "{}")
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "invalid_json"}, status=400)
+
+    question = (body.get("question") or "").strip()
+    k = int(body.get("k", 5))
+
+    if not question:
+        return JsonResponse({"error": "question is required"}, status=400)
+
+    effective_document_id, error = _resolve_document_id(request, body, question)
+    if error:
+        return error
+
+    max_distance = float(body.get("max_distance", 0.95))  # scoped default
+
+    try:
+        mode = resolve_mode(body.get("mode"), question)
+        index_params = search_params(body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    # the answer cache is keyed on the question embedding, which lexical mode skips
+    use_cache = body.get("cache", True) is not False and mode != "lexical"
+    rerank = body.get("rerank", True) is not False
+
+    def events():
+        stages = Stages("ask_stream")
+        log = None
+        try:
+            doc_version, generation = document_state(effective_document_id)
+            with stages("embed"):
+                q_emb = embed_query(question, generation) if mode != "lexical" else None
+
+            hit = None
+            if use_cache and doc_version is not None:
+                with stages("answer_cache"):
+                    hit = lookup_answer(effective_document_id, doc_version, q_emb, k, mode, rerank, max_distance)
+
+            if hit:
+                latency_ms = int((time.perf_counter() - t0) * 1000)
+                log = QueryLog(
+                    question=question,
+                    k=k,
+                    document_id=effective_document_id,
+                    max_distance=max_distance,
+                    best_distance=hit.best_distance,
+                    answer=hit.answer,
+                    sources=hit.sources,
+                    latency_ms=latency_ms,
+                    cached=True,
+                )
+                yield _sse("sources", {"sources": hit.sources})
+                yield _sse("token", {"text": hit.answer})
+                yield _sse("done", {"latency_ms": latency_ms, "cached": True})
+                return
+
+            with stages("retrieve"):
+                chunks = rerank_search(
+                    question, q_emb, k, rerank=rerank, document_id=effective_document_id, mode=mode, generation=generation, **index_params,
+                )
+            best_distance = min_distance(chunks)
+
+            log = QueryLog(
+                question=question,
+                k=k,
+                document_id=effective_document_id,
+                max_distance=max_distance,
+                best_distance=best_distance,
+            )
+
+            if not chunks or (best_distance is not None and best_distance > max_distance):
+                latency_ms = int((time.perf_counter() - t0) * 1000)
+                log.answer = "I don't know."
+                log.sources = []
+                log.latency_ms = latency_ms
+                yield _sse("sources", {"sources": []})
+                yield _sse("token", {"text": "I don't know."})
+                yield _sse("done", {"latency_ms": latency_ms, "cached": False})
+                return
+
+            with stages("context"):
+                answer_input, sources, prompt_stats = _answer_input(question, chunks)
+            PROMPT_TOKENS.observe(prompt_stats["prompt_tokens"], view="ask_stream")
+            _release_connection()
+            sources_ms = int((time.perf_counter() - t0) * 1000)
+            yield _sse("sources", {"sources": sources})
+
+            with stages("generate"):
+                stream = client.responses.create(
+                    model="gpt-4.1-mini",
+                    input=answer_input,
+                    stream=True,
+                )
+
+            pieces = []
+            first_token_ms = None
+            # generate is the time spent waiting on the model, not on a slow client reading the stream
+            for event in stages.iterate("generate", stream):
+                if event.type != "response.output_text.delta":
+                    continue
+                if first_token_ms is None:
+                    first_token_ms = int((time.perf_counter() - t0) * 1000)
+                pieces.append(event.delta)
+                yield _sse("token", {"text": event.delta})
+
+            answer = "".join(pieces)
+            latency_ms = int((time.perf_counter() - t0) * 1000)
+
+            log.answer = answer
+            log.sources = sources
             log.latency_ms = latency_ms
-            log.save(update_fields=["error", "latency_ms"])
-        return JsonResponse({"error": "internal_error", "details": repr(e)}, status=500)
+            log.prompt_tokens = prompt_stats["prompt_tokens"]
+            log.context_chunks = prompt_stats["context_chunks"]
+
+            if use_cache and doc_version is not None:
+                store_answer(effective_document_id, doc_version, question, q_emb, k, mode, rerank, best_distance, answer, sources)
+
+            yield _sse("done", {
+                "latency_ms": latency_ms,
+                "sources_ms": sources_ms,
+                "first_token_ms": first_token_ms,
+                "cached": False,
+            })
+
+        except Exception as e:
+            if log:
+                log.error = repr(e)
+                log.latency_ms = int((time.perf_counter() - t0) * 1000)
+            yield _sse("error", {"error": "internal_error", "details": repr(e)})
+
+        finally:
+            # also runs when the client disconnects mid-stream
+            if log:
+                _log_stages(log, stages)
+                with stages("log_write"):
+                    query_logs.submit(log)
+            stages.finish()
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+    return response
+
+def _generate_answer(answer_input):
+    return client.responses.create(model="gpt-4.1-mini", input=answer_input).output_text
 
-def chunk_text(text: str, max_chars: int = 900, overlap: int = 200):
+@csrf_exempt
+def ask_batch(request):
     """
-    - splits on sentences/paragraphs
-    - packs into chunks up to max_chars
-    - overlaps last 'overlap' chars between chunks
+    Answers many questions in one request:
+    {"questions": ["...", {"question": "...", "document_id": 3}, ...], ...ask options}
+    - questions without a document_id use the body's (or the session's) document
+    - one embedding call per embedding generation, one retrieval round trip for questions
+      about small documents, answers generated RAG_ASK_BATCH_CONCURRENCY at a time
+    - results come back in order (with "error" on the items that failed), logged in one INSERT
     """
-    text = (text or "").strip()
-    if not text:
-        return []
+    t0 = time.perf_counter()
 
-    # Split into sentence-ish units 
-    parts = [p.strip() for p in re.split(r'(?<=[.!?])\s+|\n+', text) if p.strip()]
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
 
-    chunks = []
-    buf = ""
+    try:
+        body = json.loads(request.body.decode("utf-8") or "{}")
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "invalid_json"}, status=400)
+
+    items = body.get("questions")
+    if not isinstance(items, list) or not items:
+        return JsonResponse({"error": "questions must be a non-empty list"}, status=400)
+    if len(items) > settings.RAG_ASK_BATCH_MAX_QUESTIONS:
+        return JsonResponse({"error": f"at most {settings.RAG_ASK_BATCH_MAX_QUESTIONS} questions per batch"}, status=400)
+
+    k = int(body.get("k", 5))
+    max_distance = float(body.get("max_distance", 0.95))  # scoped default
+    rerank = body.get("rerank", True) is not False
 
-    for p in parts:
-        if not buf:
-            buf = p
-        elif len(buf) + 1 + len(p) <= max_chars:
-            buf = f"{buf} {p}"
-        else:
-            chunks.append(buf.strip())
-            tail = buf[-overlap:] if overlap > 0 else ""
-            buf = f"{tail} {p}".strip()
+    try:
+        resolve_mode(body.get("mode"), "")  # rejects unknown modes before any work
+        index_params = search_params(body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-    if buf.strip():
-        chunks.append(buf.strip())
+    stages = Stages("ask_batch")
+    try:
+        results = []
+        pending = []  # questions that still need an answer
+        states = {}   # document_id -> (version, generation)
+
+        for item in items:
+            if isinstance(item, str):
+                item = {"question": item}
+            question = (item.get("question") or "").strip() if isinstance(item, dict) else ""
+            result = {"question": question}
+            results.append(result)
+            if not question:
+                result["error"] = "question is required"
+                continue
+
+            scope = {"document_id": item.get("document_id", body.get("document_id"))}
+            document_id, error = _resolve_document_id(request, scope, question)
+            if error:
+                result.update(json.loads(error.content))
+                continue
+
+            if document_id not in states:
+                states[document_id] = document_state(document_id)
+            version, generation = states[document_id]
+            mode = resolve_mode(body.get("mode"), question)
+            result["document_id"] = document_id
+            pending.append({
+                "result": result,
+                "version": version,
+                "use_cache": body.get("cache", True) is not False and mode != "lexical" and version is not None,
+                "search": {"query": question, "q_emb": None, "document_id": document_id, "mode": mode, "generation": generation},
+            })
+
+        # 1) embed the questions: one call per embedding generation, cached ones skipped
+        by_generation = {}
+        for p in pending:
+            if p["search"]["mode"] != "lexical":
+                by_generation.setdefault(p["search"]["generation"], []).append(p)
+        with stages("embed"):
+            for generation, group in by_generation.items():
+                for p, q_emb in zip(group, embed_queries([p["search"]["query"] for p in group], generation)):
+                    p["search"]["q_emb"] = q_emb
+
+        # 2) reuse answers to near-identical questions on the same document version
+        logs = []
+        to_search = []
+        for p in pending:
+            search = p["search"]
+            hit = None
+            if p["use_cache"]:
+                with stages("answer_cache"):
+                    hit = lookup_answer(search["document_id"], p["version"], search["q_emb"], k, search["mode"], rerank, max_distance)
+            if hit:
+                p["result"].update({"answer": hit.answer, "sources": hit.sources, "cached": True})
+                logs.append(QueryLog(
+                    question=search["query"], k=k, document_id=search["document_id"], max_distance=max_distance,
+                    best_distance=hit.best_distance, answer=hit.answer, sources=hit.sources, cached=True,
+                ))
+            else:
+                to_search.append(p)
+
+        # 3) retrieve for the rest in as few queries as possible
+        with stages("retrieve"):
+            found = rerank_search_batch([p["search"] for p in to_search], k, rerank=rerank, **index_params)
+
+        to_generate = []
+        for p, chunks in zip(to_search, found):
+            p["best_distance"] = min_distance(chunks)
+            if not chunks or (p["best_distance"] is not None and p["best_distance"] > max_distance):
+                p["result"].update({"answer": "I don't know.", "sources": [], "cached": False})
+                p["prompt_stats"] = {}
+            else:
+                with stages("context"):
+                    p["input"], p["result"]["sources"], p["prompt_stats"] = _answer_input(p["search"]["query"], chunks)
+                PROMPT_TOKENS.observe(p["prompt_stats"]["prompt_tokens"], view="ask_batch")
+                p["result"]["cached"] = False
+                to_generate.append(p)
+
+        # 4) answers, RAG_ASK_BATCH_CONCURRENCY calls in flight (threads: no DB access in there)
+        _release_connection()
+        with stages("generate"), ThreadPoolExecutor(max_workers=max(1, settings.RAG_ASK_BATCH_CONCURRENCY)) as pool:
+            futures = [(p, pool.submit(_generate_answer, p["input"])) for p in to_generate]
+            for p, future in futures:
+                try:
+                    p["result"]["answer"] = future.result()
+                except Exception as e:
+                    p["result"]["error"] = repr(e)
+
+        latency_ms = int((time.perf_counter() - t0) * 1000)  # the whole batch, on every row
+        answers = []
+        for p in to_search:
+            search, result = p["search"], p["result"]
+            logs.append(QueryLog(
+                question=search["query"],
+                k=k,
+                document_id=search["document_id"],
+                max_distance=max_distance,
+                best_distance=p["best_distance"],
+                answer=result.get("answer", ""),
+                sources=result.get("sources", []),
+                error=result.get("error", ""),
+                prompt_tokens=p["prompt_stats"].get("prompt_tokens"),
+                context_chunks=p["prompt_stats"].get("context_chunks"),
+            ))
+            if p["use_cache"] and "input" in p and "error" not in result:
+                answers.append({
+                    "document_id": search["document_id"], "document_version": p["version"], "question": search["query"],
+                    "q_emb": search["q_emb"], "k": k, "mode": search["mode"], "rerank": rerank, "best_distance": p["best_distance"],
+                    "answer": result["answer"], "sources": result["sources"],
+                })
+        for log in logs:
+            log.latency_ms = latency_ms
+        with stages("log_write"):
+            query_logs.submit(*logs)
+        store_answers(answers)
 
-    return chunks
+        return JsonResponse({"results": results, "latency_ms": latency_ms})
+
+    except Exception as e:
+        return _error_response(e)
+
+    finally:
+        stages.finish()
 
 @csrf_exempt
 def ingest_text(request):
@@ -211,7 +611,9 @@ def ingest_text(request):
         title = (body.get("title") or "Untitled").strip()
         text = body.get("text") or ""
 
-        parts = chunk_text(text)
+        stages = Stages("ingest_text")
+        with stages("chunk"):
+            parts = chunk_text(text)
         if not parts:
             return JsonResponse({"error": "No text to ingest"}, status=400)
 
@@ -221,27 +623,14 @@ def ingest_text(request):
         request.session["current_document_id"] = doc.id
         request.session.modified = True
 
-        # If doc already exists, wipe old chunks so this is an "update"
-        if not created:
-            Chunk.objects.filter(document=doc).delete()
-
-        # Embedding in one call (cheaper/faster than one-by-one)
-        embs = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=parts,
-        ).data
-
-        for i, (chunk_str, item) in enumerate(zip(parts, embs)):
-            Chunk.objects.create(
-                document=doc,
-                chunk_index=i,
-                text=chunk_str,
-                embedding=item.embedding,
-            )
+        # If doc already exists this is an "update": unchanged chunks are kept,
+        # only new/changed text gets embedded (in batched calls)
+        stats = ingest_chunks(doc, parts, stages=stages)
+        stages.finish()
 
         return JsonResponse({
             "document_id": doc.id,
-            "chunks_created": len(parts),
+            **stats,
             "title": doc.title,
             "status": "created" if created else "updated",
             "current_document_id": doc.id,
@@ -250,52 +639,59 @@ def ingest_text(request):
     except Exception as e:
         return JsonResponse({"error": "internal_error", "details": repr(e)}, status=500)
 
+def _upload_too_large(request):
+    """
+    413 response when the request body is over RAG_MAX_UPLOAD_BYTES (None if it fits).
+    Checks Content-Length before request.FILES is touched, so an oversized upload is never spooled.
+    Bodies without one (chunked) are counted as they are read by config.asgi.LimitBody.
+    """
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > settings.RAG_MAX_UPLOAD_BYTES:
+        return JsonResponse({"error": "File too large", "max_bytes": settings.RAG_MAX_UPLOAD_BYTES}, status=413)
+    return None
+
 @csrf_exempt
 def ingest_pdf(request):
     if request.method != "POST":
         return JsonResponse({"error": "POST only"}, status=405)
 
+    too_large = _upload_too_large(request)
+    if too_large:
+        return too_large
+
     if "file" not in request.FILES:
         return JsonResponse({"error": "Missing file field"}, status=400)
 
     uploaded = request.FILES["file"]
     title = (request.POST.get("title") or uploaded.name or "Untitled").strip()
 
-    reader = PdfReader(uploaded)
-    text = "\n".join([(page.extract_text() or "") for page in reader.pages]).strip()
+    # pages are extracted in parallel and streamed straight into the chunker
+    stages = Stages("ingest_pdf")
+    with upload_path(uploaded, suffix=".pdf") as path:
+        extracted = stages.iterate("pdf_extract", iter_pdf_pages(path))
+        chunked = list(stages.iterate("chunk", chunk_pages(extracted)))
 
-    if not text:
+    if not chunked:
         return JsonResponse({"error": "Could not extract text from PDF"}, status=400)
 
-    parts = chunk_text(text)
-    if not parts:
-        return JsonResponse({"error": "No text to ingest"}, status=400)
+    parts = [chunk_str for chunk_str, _ in chunked]
+    pages = [page for _, page in chunked]
 
     doc, created = Document.objects.get_or_create(title=title, source="pdf")
 
     request.session["current_document_id"] = doc.id
     request.session.modified = True
 
-    if not created:
-        Chunk.objects.filter(document=doc).delete()
-
-    embs = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=parts,
-    ).data
-
-    for i, (chunk_str, item) in enumerate(zip(parts, embs)):
-        Chunk.objects.create(
-            document=doc,
-            chunk_index=i,
-            text=chunk_str,
-            embedding=item.embedding,
-        )
+    stats = ingest_chunks(doc, parts, pages=pages, stages=stages)
+    stages.finish()
 
     return JsonResponse({
         "document_id": doc.id,
         "title": doc.title,
-        "chunks_created": len(parts),
+        **stats,
         "status": "created" if created else "updated",
         "current_document_id": request.session["current_document_id"],
     })
@@ -305,6 +701,10 @@ def ingest_file(request):
     if request.method != "POST":
         return JsonResponse({"error": "POST only"}, status=405)
 
+    too_large = _upload_too_large(request)
+    if too_large:
+        return too_large
+
     if "file" not in request.FILES:
         return JsonResponse({"error": "Missing file field"}, status=400)
 
@@ -316,49 +716,94 @@ def ingest_file(request):
     if not (filename.endswith(".txt") or filename.endswith(".md")):
         return JsonResponse({"error": "Only .txt or .md supported"}, status=400)
 
-    # Read bytes -> text
+    # Read bytes -> text -> chunks, one block at a time
+    stages = Stages("ingest_file")
     try:
-        raw = uploaded.read()
-        text = raw.decode("utf-8", errors="ignore").strip()
+        with stages("chunk"):
+            parts = chunk_blocks(uploaded.chunks(settings.RAG_UPLOAD_READ_BYTES))
     except Exception as e:
         return JsonResponse({"error": "Could not read file", "details": repr(e)}, status=400)
 
-    if not text:
-        return JsonResponse({"error": "Empty file"}, status=400)
-
-    parts = chunk_text(text)
     if not parts:
-        return JsonResponse({"error": "No text to ingest"}, status=400)
+        return JsonResponse({"error": "Empty file"}, status=400)
 
     doc, created = Document.objects.get_or_create(title=title, source="text_file")
 
     request.session["current_document_id"] = doc.id
     request.session.modified = True
 
-    if not created:
-        Chunk.objects.filter(document=doc).delete()
-
-    embs = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=parts,
-    ).data
-
-    for i, (chunk_str, item) in enumerate(zip(parts, embs)):
-        Chunk.objects.create(
-            document=doc,
-            chunk_index=i,
-            text=chunk_str,
-            embedding=item.embedding,
-        )
+    stats = ingest_chunks(doc, parts, stages=stages)
+    stages.finish()
 
     return JsonResponse({
         "document_id": doc.id,
         "title": doc.title,
-        "chunks_created": len(parts),
+        **stats,
         "status": "created" if created else "updated",
         "current_document_id": request.session["current_document_id"],
     })
 
+@csrf_exempt
+def ingest_async(request):
+    """
+    Queues a .pdf/.txt/.md upload for the ingest_worker command and returns right away.
+    Poll /api/jobs/<job_id>/ for progress.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    too_large = _upload_too_large(request)
+    if too_large:
+        return too_large
+
+    if "file" not in request.FILES:
+        return JsonResponse({"error": "Missing file field"}, status=400)
+
+    uploaded = request.FILES["file"]
+    title = (request.POST.get("title") or uploaded.name or "Untitled").strip()
+
+    filename = (uploaded.name or "").lower()
+    if filename.endswith(".pdf"):
+        kind = "pdf"
+    elif filename.endswith(".txt") or filename.endswith(".md"):
+        kind = "text_file"
+    else:
+        return JsonResponse({"error": "Only .pdf, .txt or .md supported"}, status=400)
+
+    job = enqueue_upload(uploaded, title, kind)
+
+    request.session["current_document_id"] = job.document_id
+    request.session.modified = True
+
+    return JsonResponse({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}/",
+        "document_id": job.document_id,
+        "title": title,
+        "current_document_id": job.document_id,
+    }, status=202)
+
+@require_GET
+def job_status(request, job_id):
+    job = IngestJob.objects.filter(id=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
+
+    return JsonResponse({
+        "job_id": job.id,
+        "status": job.status,
+        "kind": job.kind,
+        "document_id": job.document_id,
+        "stage": job.stage,
+        "progress": job.progress,
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    })
+
 @csrf_exempt
 def documents(request):
     if request.method != "GET":
@@ -374,6 +819,7 @@ def documents(request):
                 "id": d.id,
                 "title": d.title,
                 "source": d.source,
+                "chunk_count": d.chunk_count,
                 "created_at": d.created_at.isoformat(),
             }
             for d in docs
@@ -445,6 +891,7 @@ def reset_data(request):
 
     chunks_deleted, _ = Chunk.objects.all().delete()
     docs_deleted, _ = Document.objects.all().delete()
+    query_logs.flush()
     logs_deleted, _ = QueryLog.objects.all().delete()
 
     request.session.pop("current_document_id", None)
@@ -462,13 +909,27 @@ def reset_data(request):
 
 @require_GET
 def logs(request):
-    limit = int(request.GET.get("limit", 20))
+    """
+    Latest query logs, newest first. Pages with ?before=<next_before of the previous page>
+    (keyset pagination on id: every page is an index range read, however deep).
+    """
+    try:
+        limit = int(request.GET.get("limit", 20))
+        before = int(request.GET["before"]) if request.GET.get("before") else None
+    except ValueError:
+        return JsonResponse({"error": "limit and before must be integers"}, status=400)
     limit = max(1, min(limit, 100)) 
 
-    rows = QueryLog.objects.order_by("-id")[:limit]
+    # include this process's buffered rows, e.g. the question just asked
+    query_logs.flush()
+    rows = QueryLog.objects.order_by("-id")
+    if before is not None:
+        rows = rows.filter(id__lt=before)
+    rows = list(rows[:limit])
 
     return JsonResponse({
-        "count": rows.count(),
+        "count": len(rows),
+        "next_before": rows[-1].id if len(rows) == limit else None,
         "logs": [
             {
                 "id": r.id,
@@ -480,7 +941,61 @@ def logs(request):
                 "best_distance": r.best_distance,
                 "error": r.error,
                 "latency_ms": r.latency_ms,
+                "embed_ms": r.embed_ms,
+                "retrieve_ms": r.retrieve_ms,
+                "context_ms": r.context_ms,
+                "generate_ms": r.generate_ms,
+                "cached": r.cached,
+                "prompt_tokens": r.prompt_tokens,
+                "context_chunks": r.context_chunks,
             }
             for r in rows
         ]
-    })
\ No newline at end of file
+    })
+
+@require_GET
+def log_stats(request):
+    """
+    Aggregated query analytics over a time window, computed in SQL (see api/log_stats.py):
+    - ?since=&until= ISO datetimes (default: the last 24 hours), ?bucket=minute|hour|day|week
+    - ?document_id= restricts everything to one document
+    """
+    try:
+        until = _parse_time(request.GET.get("until")) or timezone.now()
+        since = _parse_time(request.GET.get("since")) or until - timedelta(hours=24)
+        document_id = int(request.GET["document_id"]) if request.GET.get("document_id") else None
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    bucket = request.GET.get("bucket", "hour")
+
+    query_logs.flush()
+    try:
+        stats = query_stats(since, until, bucket, document_id)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse({
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "bucket": bucket,
+        "document_id": document_id,
+        **stats,
+    })
+
+def _parse_time(value):
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"invalid datetime {value!r} (expected ISO 8601)")
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus scrape endpoint (text format) for this process:
+    - rag_request_seconds / rag_stage_seconds: latency histograms per view and stage
+    - rag_prompt_tokens: answer prompt sizes
+    - rag_cache_lookups_total: hits and misses of the answer, question embedding and chunk embedding caches
+    """
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -7,10 +7,55 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import json
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+
+class _TooLarge(Exception):
+    pass
+
+
+class LimitBody:
+    """
+    Answers 413 once a request body passes RAG_MAX_UPLOAD_BYTES. Django reads the whole body
+    (spooling it to disk) before any view runs, and a chunked request has no Content-Length
+    for api.views._upload_too_large to check, so the bytes are counted as they arrive.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        max_bytes = settings.RAG_MAX_UPLOAD_BYTES
+        received = 0
+
+        async def counted_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise _TooLarge
+            return message
+
+        try:
+            await self.app(scope, counted_receive, send)
+        except _TooLarge:
+            # raised while Django reads the body, before it has sent anything
+            body = json.dumps({"error": "File too large", "max_bytes": max_bytes}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 413,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+
+
+application = LimitBody(get_asgi_application())
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -78,18 +79,59 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connections come from a psycopg_pool per worker process (RAG_DB_POOL_MIN_SIZE..RAG_DB_POOL_MAX_SIZE,
+# waiting up to RAG_DB_POOL_TIMEOUT seconds for a free one) instead of a new connection per request.
+# A request holds a pooled connection until it finishes, except that the ask views hand it back
+# before generating the answer, so RAG_DB_POOL_MAX_SIZE bounds the requests doing database work at
+# once per process, not the questions in flight; a request that waits RAG_DB_POOL_TIMEOUT seconds
+# for a connection gets a 503.
+# RAG_DB_POOL=0 turns the pool off; RAG_DB_CONN_MAX_AGE then keeps connections open between requests.
+# On those long-lived connections the vector search query runs as a server-side prepared statement
+# once it has been executed RAG_DB_PREPARE_THRESHOLD times; set it to "" behind a transaction-mode
+# PgBouncer, which can't keep prepared statements
+RAG_DB_POOL = os.getenv("RAG_DB_POOL", "1") == "1"
+RAG_DB_PREPARE_THRESHOLD = os.getenv("RAG_DB_PREPARE_THRESHOLD", "0")
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'ragdb',
-        'USER': 'raguser',
-        'PASSWORD': 'ragpass',
-        'HOST': '127.0.0.1',
-        'PORT': '5432',
+        'NAME': os.getenv("POSTGRES_DB", "ragdb"),
+        'USER': os.getenv("POSTGRES_USER", "raguser"),
+        'PASSWORD': os.getenv("POSTGRES_PASSWORD", "ragpass"),
+        'HOST': os.getenv("POSTGRES_HOST", "127.0.0.1"),
+        'PORT': os.getenv("POSTGRES_PORT", "5432"),
+        # the pool replaces persistent connections (Django requires CONN_MAX_AGE = 0 with it)
+        'CONN_MAX_AGE': 0 if RAG_DB_POOL else int(os.getenv("RAG_DB_CONN_MAX_AGE", "60")),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.getenv("RAG_DB_POOL_MIN_SIZE", "2")),
+                'max_size': int(os.getenv("RAG_DB_POOL_MAX_SIZE", "10")),
+                'timeout': float(os.getenv("RAG_DB_POOL_TIMEOUT", "10")),
+            } if RAG_DB_POOL else False,
+            'prepare_threshold': int(RAG_DB_PREPARE_THRESHOLD) if RAG_DB_PREPARE_THRESHOLD else None,
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Optional Redis cache shared by all workers (set RAG_QUERY_CACHE_SHARED=shared to use it)
+if os.getenv("REDIS_URL"):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv("REDIS_URL"),
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -130,3 +172,155 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# RAG settings
+
+# Rows per INSERT when writing chunks during ingestion
+RAG_INGEST_BATCH_SIZE = int(os.getenv("RAG_INGEST_BATCH_SIZE", "500"))
+
+# Who computes embeddings: "openai" (API), "local" (sentence-transformers model on this
+# machine, no network round trip) or "hash" (deterministic fake for tests/benchmarks)
+RAG_EMBEDDING_PROVIDER = os.getenv("RAG_EMBEDDING_PROVIDER", "openai")
+_EMBEDDING_DEFAULTS = {
+    "openai": ("text-embedding-3-small", "1536"),
+    "local": ("sentence-transformers/all-MiniLM-L6-v2", "384"),
+    "hash": ("words", "1536"),
+}.get(RAG_EMBEDDING_PROVIDER, ("", "1536"))
+
+# Embedding model and vector size for new chunks and unscoped questions. text-embedding-3
+# models can return fewer dimensions (e.g. 512); other models use their native size.
+# Each chunk records the model/dimensions it was embedded with; `manage.py reembed`
+# moves existing documents over after a change
+RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", _EMBEDDING_DEFAULTS[0])
+RAG_EMBEDDING_DIMENSIONS = int(os.getenv("RAG_EMBEDDING_DIMENSIONS", _EMBEDDING_DEFAULTS[1]))
+
+# Local provider: torch device ("cpu", "cuda") and backend ("torch", or "onnx" for ONNX Runtime)
+RAG_LOCAL_EMBEDDING_DEVICE = os.getenv("RAG_LOCAL_EMBEDDING_DEVICE", "cpu")
+RAG_LOCAL_EMBEDDING_BACKEND = os.getenv("RAG_LOCAL_EMBEDDING_BACKEND", "torch")
+
+# Inputs per embedding call (the OpenAI API accepts up to 2048)
+RAG_EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "256"))
+
+# Background ingestion: where uploads wait for a worker, and how often idle workers poll.
+# A running job's worker bumps its heartbeat every third of the lease; a job whose heartbeat
+# is older than the lease (the worker was killed) is requeued, up to RAG_JOB_MAX_ATTEMPTS claims
+RAG_JOB_UPLOAD_DIR = Path(os.getenv("RAG_JOB_UPLOAD_DIR", BASE_DIR / "job_uploads"))
+RAG_WORKER_POLL_SECONDS = float(os.getenv("RAG_WORKER_POLL_SECONDS", "1.0"))
+RAG_JOB_LEASE_SECONDS = float(os.getenv("RAG_JOB_LEASE_SECONDS", "120"))
+RAG_JOB_MAX_ATTEMPTS = int(os.getenv("RAG_JOB_MAX_ATTEMPTS", "3"))
+
+# PDF extraction: size of the process pool shared by all uploads (0 = one per CPU, started
+# on first use from a forkserver), pages per pool task, and the page count below which
+# extraction stays in-process
+RAG_PDF_WORKERS = int(os.getenv("RAG_PDF_WORKERS", "0"))
+RAG_PDF_PAGES_PER_TASK = int(os.getenv("RAG_PDF_PAGES_PER_TASK", "8"))
+RAG_PDF_PARALLEL_MIN_PAGES = int(os.getenv("RAG_PDF_PARALLEL_MIN_PAGES", "16"))
+
+# Question embedding cache: max entries per process, TTL in seconds, and an
+# optional CACHES alias (e.g. a Redis cache) shared between workers
+RAG_QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "1024"))
+RAG_QUERY_CACHE_TTL = int(os.getenv("RAG_QUERY_CACHE_TTL", "3600"))
+RAG_QUERY_CACHE_SHARED = os.getenv("RAG_QUERY_CACHE_SHARED", "")
+
+# Answer cache: max cosine distance between a new question and a cached one
+# (same document version, k, mode and rerank) for the cached answer to be reused. 0 disables it.
+RAG_ANSWER_CACHE_DISTANCE = float(os.getenv("RAG_ANSWER_CACHE_DISTANCE", "0.05"))
+
+# Answer cache size: entries kept per (document version, k, mode, rerank), newest first, and
+# their max age in seconds (0 = no expiry). Hit counts are written every RAG_ANSWER_CACHE_HIT_BATCH
+# hits or RAG_ANSWER_CACHE_HIT_FLUSH_SECONDS seconds, whichever comes first
+RAG_ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "200"))
+RAG_ANSWER_CACHE_TTL_SECONDS = int(os.getenv("RAG_ANSWER_CACHE_TTL_SECONDS", "604800"))
+RAG_ANSWER_CACHE_HIT_BATCH = int(os.getenv("RAG_ANSWER_CACHE_HIT_BATCH", "50"))
+RAG_ANSWER_CACHE_HIT_FLUSH_SECONDS = float(os.getenv("RAG_ANSWER_CACHE_HIT_FLUSH_SECONDS", "30"))
+
+# Retrieval: default mode (vector, lexical, hybrid or auto), candidates fetched per
+# list in hybrid mode (x k), and the reciprocal rank fusion constant
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "vector")
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "4"))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+# Vector index on Chunk.embedding: "hnsw" or "ivfflat", with its build parameters.
+# Migrations build the default (HNSW, m=16, ef_construction=64); after changing these
+# run `manage.py vector_index` to build the index they describe and drop the old one
+RAG_VECTOR_INDEX = os.getenv("RAG_VECTOR_INDEX", "hnsw")
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", "16"))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "64"))
+RAG_IVFFLAT_LISTS = int(os.getenv("RAG_IVFFLAT_LISTS", "100"))
+
+# Default search effort per query (higher = better recall, slower). Requests can
+# override it with "ef_search" (HNSW) or "probes" (IVFFlat)
+RAG_HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "40"))
+RAG_IVFFLAT_PROBES = int(os.getenv("RAG_IVFFLAT_PROBES", "1"))
+
+# Document-scoped retrieval: documents with up to RAG_SCOPED_EXACT_MAX_CHUNKS chunks are
+# searched exactly; larger ones use the vector index with iterative scans on pgvector 0.8+
+# ("relaxed_order", "strict_order" or "off"). `manage.py scoped_indexes` builds per-document
+# partial indexes for documents with at least RAG_SCOPED_INDEX_MIN_CHUNKS chunks
+RAG_SCOPED_EXACT_MAX_CHUNKS = int(os.getenv("RAG_SCOPED_EXACT_MAX_CHUNKS", "2000"))
+RAG_ITERATIVE_SCAN = os.getenv("RAG_ITERATIVE_SCAN", "relaxed_order")
+RAG_SCOPED_INDEX_MIN_CHUNKS = int(os.getenv("RAG_SCOPED_INDEX_MIN_CHUNKS", "50000"))
+
+# Vector index storage: "full" (float32), "halfvec" (half precision, ~2x smaller index) or
+# "binary" (1 bit per dimension, ~32x smaller). Compact indexes only produce candidates:
+# RAG_RERANK_CANDIDATES x k of them are re-ranked on the full vectors. Needs pgvector 0.7+,
+# and like the other index settings a `manage.py vector_index` after changing it
+RAG_VECTOR_STORAGE = os.getenv("RAG_VECTOR_STORAGE", "full")
+RAG_RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", "8"))
+
+# Re-ranking before generation: ask fetches RAG_MMR_CANDIDATES x k chunks and keeps k of them
+# by Maximal Marginal Relevance (RAG_MMR_LAMBDA: 1.0 = relevance only, lower = more diverse),
+# which drops near-duplicates from overlapping chunks. RAG_CROSS_ENCODER_MODEL (e.g.
+# "cross-encoder/ms-marco-MiniLM-L-6-v2", needs sentence-transformers) scores relevance locally.
+# RAG_MMR_CANDIDATES=1 turns the stage off; requests can skip it with "rerank": false
+RAG_MMR_CANDIDATES = int(os.getenv("RAG_MMR_CANDIDATES", "3"))
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+RAG_CROSS_ENCODER_MODEL = os.getenv("RAG_CROSS_ENCODER_MODEL", "")
+
+# Answer prompt: the sources are capped at RAG_CONTEXT_TOKEN_BUDGET tokens, counted with
+# tiktoken's RAG_TOKENIZER_ENCODING when tiktoken is installed (else ~4 characters per token)
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "3000"))
+RAG_TOKENIZER_ENCODING = os.getenv("RAG_TOKENIZER_ENCODING", "o200k_base")
+
+# Uploads: files over FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to a temp file (FILE_UPLOAD_TEMP_DIR)
+# instead of memory, and bodies over RAG_MAX_UPLOAD_BYTES are rejected with 413 before they're read
+# (by Content-Length, or under ASGI by counting the bytes received for chunked bodies).
+# Text files are decoded and chunked RAG_UPLOAD_READ_BYTES at a time; PDFs are memory-mapped
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv("RAG_UPLOAD_SPOOL_BYTES", "2621440"))
+FILE_UPLOAD_TEMP_DIR = os.getenv("RAG_UPLOAD_TEMP_DIR") or None
+RAG_MAX_UPLOAD_BYTES = int(os.getenv("RAG_MAX_UPLOAD_BYTES", "268435456"))
+RAG_UPLOAD_READ_BYTES = int(os.getenv("RAG_UPLOAD_READ_BYTES", "65536"))
+
+# OpenAI gateway (api/llm.py): one pooled HTTP client per process with at most
+# RAG_OPENAI_MAX_CONNECTIONS requests in flight (others wait RAG_OPENAI_POOL_TIMEOUT seconds for a
+# connection), per-operation timeouts, RAG_OPENAI_MAX_RETRIES retries with backoff on 429/5xx, and
+# token buckets of RAG_OPENAI_EMBED_RPS / RAG_OPENAI_GENERATE_RPS requests per second (0 = unlimited).
+# Requests that would queue longer than RAG_OPENAI_MAX_QUEUE_SECONDS fail fast with a 503
+RAG_OPENAI_MAX_CONNECTIONS = int(os.getenv("RAG_OPENAI_MAX_CONNECTIONS", "32"))
+RAG_OPENAI_POOL_TIMEOUT = float(os.getenv("RAG_OPENAI_POOL_TIMEOUT", "10"))
+RAG_OPENAI_CONNECT_TIMEOUT = float(os.getenv("RAG_OPENAI_CONNECT_TIMEOUT", "5"))
+RAG_OPENAI_EMBED_TIMEOUT = float(os.getenv("RAG_OPENAI_EMBED_TIMEOUT", "15"))
+RAG_OPENAI_GENERATE_TIMEOUT = float(os.getenv("RAG_OPENAI_GENERATE_TIMEOUT", "60"))
+RAG_OPENAI_MAX_RETRIES = int(os.getenv("RAG_OPENAI_MAX_RETRIES", "3"))
+RAG_OPENAI_EMBED_RPS = float(os.getenv("RAG_OPENAI_EMBED_RPS", "0"))
+RAG_OPENAI_GENERATE_RPS = float(os.getenv("RAG_OPENAI_GENERATE_RPS", "0"))
+RAG_OPENAI_MAX_QUEUE_SECONDS = float(os.getenv("RAG_OPENAI_MAX_QUEUE_SECONDS", "10"))
+
+# Chunking: chunk size and overlap in RAG_CHUNK_TOKENIZER units, "chars" (characters) or
+# "tiktoken" (tokens of RAG_TOKENIZER_ENCODING, ~4 characters each without tiktoken).
+# Changing them only affects new ingests
+RAG_CHUNK_TOKENIZER = os.getenv("RAG_CHUNK_TOKENIZER", "chars")
+RAG_CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "900"))
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+
+# QueryLog rows are buffered per process and written in batches by a background thread
+# (api/query_log.py) every RAG_QUERYLOG_FLUSH_SECONDS or RAG_QUERYLOG_BATCH_SIZE rows, whichever
+# comes first; a crash loses at most that window. RAG_QUERYLOG_FLUSH_SECONDS=0 writes them inline
+RAG_QUERYLOG_BATCH_SIZE = int(os.getenv("RAG_QUERYLOG_BATCH_SIZE", "100"))
+RAG_QUERYLOG_FLUSH_SECONDS = float(os.getenv("RAG_QUERYLOG_FLUSH_SECONDS", "2"))
+RAG_QUERYLOG_MAX_PENDING = int(os.getenv("RAG_QUERYLOG_MAX_PENDING", "10000"))
+
+# /api/ask/batch/: most questions per request, and how many answers are generated at once
+RAG_ASK_BATCH_MAX_QUESTIONS = int(os.getenv("RAG_ASK_BATCH_MAX_QUESTIONS", "200"))
+RAG_ASK_BATCH_CONCURRENCY = int(os.getenv("RAG_ASK_BATCH_CONCURRENCY", "8"))
@@ -19,10 +19,13 @@ from django.urls import path
 from django.urls import path, include
 from django.views.generic import RedirectView
 
+from api.views import metrics
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", include("api.urls")),
+    path("metrics", metrics),  # Prometheus scrape target
     path("", RedirectView.as_view(url="/api/", permanent=False)),
 
 ]
@@ -0,0 +1,169 @@
+"""
+Compares how many concurrent /ask requests the WSGI and ASGI paths can serve.
+
+1) Start a fake OpenAI server (fixed latency, deterministic embeddings):
+     python loadtest/ask_concurrency.py fake-openai --port 9100 --delay 0.5
+
+2) Start the app against it, e.g. in two shells:
+     OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=x gunicorn config.wsgi -w 4 -b 127.0.0.1:8000  # pip install gunicorn
+     OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=x uvicorn config.asgi:application --port 8001
+
+3) Ingest a document, then fire the same load at both paths:
+     python loadtest/ask_concurrency.py run --document-id 1 --concurrency 200 --requests 1000 \\
+         --url http://127.0.0.1:8000/api/ask/ --url http://127.0.0.1:8001/api/async/ask/
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import statistics
+import struct
+import time
+
+import httpx
+
+DIMENSIONS = 1536
+
+
+def fake_embedding(text, dimensions=DIMENSIONS):
+    # deterministic unit-ish vector from the text hash, so repeated runs retrieve the same chunks
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    values = []
+    while len(values) < dimensions:
+        seed = hashlib.sha256(seed).digest()
+        values.extend(v / 2**31 for v in struct.unpack("<8i", seed))
+    return values[:dimensions]
+
+
+def fake_response(path, payload):
+    if path.endswith("/embeddings"):
+        inputs = payload.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return {
+            "object": "list",
+            "model": payload.get("model"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(t, payload.get("dimensions", DIMENSIONS))}
+                for i, t in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+    if path.endswith("/responses"):
+        return {
+            "id": "resp_fake",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": payload.get("model"),
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": "msg_fake",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": "Fake answer.", "annotations": []}],
+            }],
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+        }
+    return None
+
+
+async def serve_fake_openai(port, delay):
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = {k.lower(): v.strip() for k, _, v in (h.partition(":") for h in header_lines if h)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                await asyncio.sleep(delay)  # simulated upstream latency
+
+                result = fake_response(path, json.loads(body or b"{}"))
+                status = "200 OK" if result is not None else "404 Not Found"
+                data = json.dumps(result or {"error": "not found"}).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port, backlog=4096)
+    print(f"fake OpenAI listening on http://127.0.0.1:{port}/v1 (delay {delay}s)")
+    async with server:
+        await server.serve_forever()
+
+
+async def run_load(url, document_id, concurrency, total):
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        async def one(i):
+            nonlocal errors
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    # unique questions, cache off and no distance cutoff (fake embeddings are random),
+                    # so every request pays for embedding and generation
+                    resp = await client.post(url, json={
+                        "question": f"Load test question {i}?",
+                        "document_id": document_id,
+                        "cache": False,
+                        "max_distance": 2.0,
+                    })
+                    if resp.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(total)])
+        elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    return {
+        "url": url,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fake = sub.add_parser("fake-openai", help="Run a local fake OpenAI API.")
+    fake.add_argument("--port", type=int, default=9100)
+    fake.add_argument("--delay", type=float, default=0.5, help="Seconds each upstream call takes.")
+
+    run = sub.add_parser("run", help="Send concurrent /ask requests and report throughput.")
+    run.add_argument("--url", action="append", required=True, help="Ask endpoint; repeat to compare several.")
+    run.add_argument("--document-id", type=int, required=True)
+    run.add_argument("--concurrency", type=int, default=100)
+    run.add_argument("--requests", type=int, default=500)
+
+    args = parser.parse_args()
+    if args.command == "fake-openai":
+        asyncio.run(serve_fake_openai(args.port, args.delay))
+    else:
+        for url in args.url:
+            print(json.dumps(asyncio.run(run_load(url, args.document_id, args.concurrency, args.requests))))
+
+
+if __name__ == "__main__":
+    main()